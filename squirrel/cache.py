@@ -0,0 +1,150 @@
+"""Cache
+
+This module contains the local read-through cache of the Squirrel program.
+Fields of stashed versions read from MongoDB are kept in a SQLite file,
+keyed by database, collection, name, version and content hash, so repeated
+reads of the same code object are answered without the server.
+
+Examples
+    python -m unittest tests.test_cache
+"""
+import time
+import sqlite3
+import threading
+from pathlib import Path, PurePath
+from typing import Tuple
+
+from squirrel.config import *
+
+
+class ObjectCache():
+    """Least recently used cache of version fields, capped in bytes.
+
+    An entry younger than ttl seconds is served as is. An older one must be
+    revalidated by the caller, by checking that the stored content hash is
+    still the one it was cached with, see validate.
+    """
+    schema = [
+        "CREATE TABLE IF NOT EXISTS entries ("
+        " db TEXT NOT NULL,"
+        " collection TEXT NOT NULL,"
+        " name TEXT NOT NULL,"
+        " version TEXT NOT NULL,"
+        " field TEXT NOT NULL,"
+        " hash TEXT NOT NULL,"
+        " value TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " accessed REAL NOT NULL,"
+        " validated REAL NOT NULL,"
+        " PRIMARY KEY (db, collection, name, version, field))",
+        "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)",
+    ]
+
+    def __init__(self, path: Path, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+
+    def get(self, key: Tuple[str, str, str, str, str]) -> Tuple[str, str, bool]:
+        """Look up a cached field.
+
+        Parameters
+        ----------
+        key : Tuple[str, str, str, str, str]
+            Database, collection, name, version name and field.
+
+        Returns
+        -------
+        Tuple[str, str, bool]
+            Value, content hash and whether the entry is younger than ttl,
+            or None if the field is not cached.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT value, hash, validated FROM entries"
+                " WHERE db = ? AND collection = ? AND name = ? AND version = ? AND field = ?",
+                key).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE entries SET accessed = ?"
+                " WHERE db = ? AND collection = ? AND name = ? AND version = ? AND field = ?",
+                (now, *key))
+        value, content_hash, validated = row
+        return value, content_hash, now - validated < self.ttl
+
+    def validate(self, key: Tuple[str, str, str, str, str]):
+        """Mark an entry as checked against the server just now."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE entries SET validated = ?"
+                " WHERE db = ? AND collection = ? AND name = ? AND version = ? AND field = ?",
+                (time.time(), *key))
+
+    def put(self, key: Tuple[str, str, str, str, str], content_hash: str, value: str):
+        """Cache a field, evicting the least recently used entries over the size cap."""
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (db, collection, name, version, field, hash, value, size, accessed, validated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, content_hash, value, size, now, now))
+            total = self.connection.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self.connection.execute(
+                "SELECT rowid, size FROM entries ORDER BY accessed").fetchall()
+            evicted = []
+            for rowid, entry_size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                total -= entry_size
+            self.connection.executemany("DELETE FROM entries WHERE rowid = ?", evicted)
+
+    def invalidate(self, db_name: str, collection: str = None, name: str = None):
+        """Drop the cached fields of a code object, a collection or a database."""
+        query = "DELETE FROM entries WHERE db = ?"
+        params = [db_name]
+        if collection is not None:
+            query += " AND collection = ?"
+            params.append(collection)
+        if name is not None:
+            query += " AND name = ?"
+            params.append(name)
+        with self.lock, self.connection:
+            self.connection.execute(query, params)
+
+    def close(self):
+        self.connection.close()
+
+
+# cache shared by every storage in this process, see get_cache
+object_cache = None
+
+
+def get_cache() -> ObjectCache:
+    """Return the cache shared by this process, or None if caching is off."""
+    global object_cache
+    if CACHE_MAX_BYTES <= 0:
+        return None
+    if object_cache is None:
+        try:
+            object_cache = ObjectCache(PurePath(CACHE_DIR, CACHE_NAME))
+        except (OSError, sqlite3.Error) as e:
+            print(e)
+            return None
+    return object_cache
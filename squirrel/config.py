@@ -1,4 +1,5 @@
-from pygments.formatters.terminal256 import Terminal256Formatter
+import os
+import tempfile
 from pathlib import Path, PurePath
 
 
@@ -12,11 +13,71 @@ TEST_DELETEME = Path(PurePath(TESTS, 'deleteme'))
 TEST_DB = 'deleteme_code_library'
 DB_NAME = 'python_code_library'
 
+MONGO_URI = os.getenv('SQUIRREL_MONGO_URI', 'mongodb://localhost:27017')
+MONGO_POOL_SIZE = int(os.getenv('SQUIRREL_MONGO_POOL_SIZE', '10'))
+MONGO_TIMEOUT_MS = int(os.getenv('SQUIRREL_MONGO_TIMEOUT_MS', '500'))
+
+# a MongoDB database name, or a 'sqlite:///path' URL for a local file
+SQLITE_SCHEME = 'sqlite:///'
+DATABASE = os.getenv('SQUIRREL_DATABASE', DB_NAME)
+
+# seconds for which server availability and the list of databases are
+# trusted without asking the server again, the client's heartbeats (every
+# 10 seconds) keep availability fresh while it is in use
+AVAILABILITY_TTL = float(os.getenv('SQUIRREL_AVAILABILITY_TTL', '15'))
+
 COLLECTIONS = {
     'function': 'functions',
     'class': 'classes'
 }
 
+# 'embedded' keeps versions in an array on each document, 'split' keeps
+# them in a collection of their own
+LAYOUTS = ['embedded', 'split']
+STORAGE_LAYOUT = os.getenv('SQUIRREL_LAYOUT', 'embedded')
+
+# store versions in MongoDB as line deltas of the previous version, with a
+# full keyframe every this many versions, 0 stores every version in full
+KEYFRAME_INTERVAL = int(os.getenv('SQUIRREL_KEYFRAME_INTERVAL', '0'))
+
+# times a delta stash is tried when another stash changes the object first
+DELTA_ATTEMPTS = 3
+
+VERSION_COLLECTIONS = {
+    'functions': 'function_versions',
+    'classes': 'class_versions'
+}
+
+# fields of a version replaced when it is stashed again under the same name
+VERSION_FIELDS = ['docstring', 'source', 'hash', 'lines', 'imports', 'free_names', 'dependencies', 'fingerprint']
+
+# relative weight of each field when ranking search matches
+TEXT_WEIGHTS = {
+    'name': 10,
+    'docstring': 5,
+    'source': 1
+}
+SNIPPET_LENGTH = 120
+FIND_PAGE_SIZE = 10
+
+# documents read or written per round trip by export and import
+BATCH_SIZE = int(os.getenv('SQUIRREL_BATCH_SIZE', '1000'))
+
+# fields of versions read from MongoDB are cached on disk, and read again
+# from the server once they are older than CACHE_TTL seconds and changed
+CACHE_DIR = Path(os.getenv(
+    'SQUIRREL_CACHE_DIR',
+    PurePath(os.getenv('XDG_CACHE_HOME', PurePath(Path.home(), '.cache')), 'squirrel')))
+CACHE_NAME = 'objects.db'
+CACHE_MAX_BYTES = int(os.getenv('SQUIRREL_CACHE_SIZE', str(64 * 1024 * 1024)))
+CACHE_TTL = float(os.getenv('SQUIRREL_CACHE_TTL', '60'))
+CACHED_FIELDS = ['source', 'docstring', 'imports']
+
+# stashes made while MongoDB is unreachable wait here to be replayed
+JOURNAL_PATH = Path(os.getenv(
+    'SQUIRREL_JOURNAL',
+    PurePath(os.getenv('XDG_STATE_HOME', PurePath(Path.home(), '.local', 'state')), 'squirrel', 'journal.ndjson')))
+
 avoid_directories = [
     'bin',
     'data',
@@ -26,7 +87,22 @@ avoid_directories = [
     '.pytest_cache'
 ]
 
-TERM_FORMATTER = Terminal256Formatter(style='monokai')
+# symbol indexes of searched trees, one file per tree, see index.get_index_path
+INDEX_DIR = Path(PurePath(CACHE_DIR, 'indexes'))
+INDEX_VERSION = 2
+
+# searches over fewer files than this are not worth a process pool
+PARALLEL_THRESHOLD = 64
+
+# the server's socket is kept in a directory only this user can use
+SOCKET_PATH = Path(os.getenv(
+    'SQUIRREL_SOCKET',
+    PurePath(os.getenv('XDG_RUNTIME_DIR') or PurePath(tempfile.gettempdir(), f"squirrel-{os.getuid()}"),
+             'squirrel.sock')))
+WATCH_INTERVAL = 1.0
+
+# pygments style of code shown in the terminal
+TERM_STYLE = 'monokai'
 
 class ERROR:
     bad_command = 'invalid command!'
@@ -35,6 +111,19 @@ class ERROR:
     bad_argument = "invalid argument. try 'package.module.function' or 'module.function' or 'function'"
     no_arg = 'no argument provided'
     no_commas = 'invalid arguments. comma separated args not allowed'
+    bad_jobs = 'number of jobs must be at least 1'
+    server_running = 'a squirrel server is already listening at'
+    bad_db_command = 'invalid database command!'
+    bad_page = 'page and limit must be at least 1'
+    bad_batch_size = 'batch size must be at least 1'
+    no_path = 'no file provided'
+    bad_keyframe_interval = 'keyframe interval must be at least 0'
+    bad_diff = 'invalid arguments. try NAME VERSION VERSION'
+    write_conflict = 'changed by another stash, try again'
+    socket_directory = 'the socket directory must belong to you and be private'
+    untrusted_socket = 'not forwarding to a socket owned by another user'
+    missing_base = 'skipped, the version its delta is based on is missing'
+    bad_database = 'cannot open database'
 
 class colors:
     HEADER = '\033[95m'
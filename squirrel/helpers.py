@@ -5,15 +5,21 @@ This module contains the helper function definitions for the Squirrel program.
 Examples
     python -m unittest tests.test_helpers
 """
+import os
+import re
 import sys
 import ast
+import mmap
+import builtins
+import difflib
+import hashlib
+import textwrap
 from pprint import pprint
+from functools import lru_cache
+from itertools import islice, repeat
 from pathlib import Path, PurePath
-from typing import Any, List, Union
-from collections import OrderedDict
-
-from pygments import highlight
-from pygments.lexers import PythonLexer
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, Union
+from collections import OrderedDict, deque
 
 from squirrel.config import *
 
@@ -81,7 +87,7 @@ def get_docstring(code_segment: str, obj_name: str, obj_type: str):
         return None
 
     citizens = {
-        'function': ast.FunctionDef,
+        'function': (ast.FunctionDef, ast.AsyncFunctionDef),
         'class': ast.ClassDef,
     }
 
@@ -91,7 +97,7 @@ def get_docstring(code_segment: str, obj_name: str, obj_type: str):
         nodes = [node for node in ast_object.body if isinstance(
             node, citizens[obj_type])]
         lookup = {node.name: node for node in nodes}
-        target_node = lookup[obj_name]
+        target_node = lookup[obj_name.split('.')[-1]]
     except Exception as e:
         message(get_current_func_name(), e)
         return None
@@ -99,6 +105,73 @@ def get_docstring(code_segment: str, obj_name: str, obj_type: str):
         return ast.get_docstring(target_node)
 
 
+def hash_source(source: str) -> str:
+    """Hash source code after normalising line endings and trailing whitespace.
+
+    Parameters
+    ----------
+    source : str
+        Source code of a code object.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the content of the source.
+    """
+    lines = [lin.rstrip() for lin in source.splitlines()]
+    normalised = '\n'.join(lines).strip('\n')
+    return hashlib.sha256(normalised.encode()).hexdigest()
+
+
+def make_delta(base: str, target: str) -> list:
+    """Describe target source as line edits of base source.
+
+    The delta is a list of operations applied in order: a positive int
+    copies that many lines of base, a negative int skips that many lines of
+    base and a str is inserted as is.
+
+    Parameters
+    ----------
+    base : str
+        Source code of the previous version.
+    target : str
+        Source code of the new version.
+
+    Returns
+    -------
+    list
+        Operations rebuilding target from base, see apply_delta.
+    """
+    a = base.splitlines(keepends=True)
+    b = target.splitlines(keepends=True)
+    delta = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            delta.append(i2 - i1)
+            continue
+        if i2 > i1:
+            delta.append(i1 - i2)
+        if j2 > j1:
+            delta.append(''.join(b[j1:j2]))
+    return delta
+
+
+def apply_delta(base: str, delta: list) -> str:
+    """Rebuild source code from base source and a delta made by make_delta."""
+    lines = base.splitlines(keepends=True)
+    result = []
+    i = 0
+    for op in delta:
+        if isinstance(op, str):
+            result.append(op)
+        elif op > 0:
+            result += lines[i:i + op]
+            i += op
+        else:
+            i -= op
+    return ''.join(result)
+
+
 def filter_dict(dt: dict, callback):
     new = dict()
 
@@ -160,14 +233,64 @@ def get_py_files(d: Path) -> List[Path]:
             and Path(_).suffix in ['.py']]
 
 
-def seek_py_files(py_files: List[Union[Path, str]], dirs: List[Union[Path, str]]):
-    if len(dirs) == 0:
-        return list(py_files)
+def is_avoided_directory(name: str) -> bool:
+    return name in avoid_directories or name.endswith('egg-info')
+
+
+def walk_py_files(d: Union[Path, str]) -> Iterator[Path]:
+    """Yield the Python files below a directory, breadth first.
 
-    py_files += get_py_files(dirs[0])
-    dirs = dirs[1:] + get_valid_directories(dirs[0])
+    Directories in avoid_directories and egg-info directories are pruned.
+    Each directory is visited once, so symlinks that loop back into the
+    tree are not followed again.
 
-    return seek_py_files(py_files, dirs)
+    Parameters
+    ----------
+    d : Union[Path, str]
+        Pathname of the directory to walk.
+
+    Yields
+    ------
+    Path
+        Pathname of a Python file.
+    """
+    try:
+        st = os.stat(d)
+    except OSError:
+        return
+
+    seen = {(st.st_dev, st.st_ino)}
+    queue = deque([d])
+
+    while queue:
+        current = queue.popleft()
+        try:
+            with os.scandir(current) as entries:
+                entries = list(entries)
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if is_avoided_directory(entry.name):
+                        continue
+                    st = entry.stat()
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    queue.append(entry.path)
+                elif entry.name.endswith('.py') and entry.is_file():
+                    yield Path(entry.path)
+            except OSError:
+                continue
+
+
+def seek_py_files(py_files: List[Union[Path, str]], dirs: List[Union[Path, str]]):
+    result = list(py_files)
+    for d in dirs:
+        result += walk_py_files(d)
+    return result
 
 
 def return_colon(lbl):
@@ -176,11 +299,34 @@ def return_colon(lbl):
     return ':'
 
 
+@lru_cache(maxsize=None)
+def get_term_formatter():
+    """Build the pygments formatter on first use, pygments is slow to import."""
+    from pygments.formatters.terminal256 import Terminal256Formatter
+    return Terminal256Formatter(style=TERM_STYLE)
+
+
+def highlight_code(code: str, lexer: str = 'python') -> str:
+    from pygments import highlight
+    from pygments.lexers import DiffLexer, PythonLexer
+    lexers = {
+        'python': PythonLexer,
+        'diff': DiffLexer
+    }
+    return highlight(code, lexers[lexer](), get_term_formatter())
+
+
 def display_code(code: str, label: str = ''):
     header = f"{label}{return_colon(label)}"
     body = code
     print(f"\n{header}")
-    print(highlight(body, PythonLexer(), TERM_FORMATTER))
+    print(highlight_code(body))
+
+
+def display_diff(diff: str, label: str = ''):
+    header = f"{label}{return_colon(label)}"
+    print(f"\n{header}")
+    print(highlight_code(diff, 'diff'))
 
 
 def display(a: Any, label: str = ''):
@@ -194,25 +340,324 @@ def modulify(st: str) -> str:
     return f"{st.strip()}.py"
 
 
-def get_code_segment_from_file_contents(contents: str, name: str, citizen: str = 'function') -> str:
+def get_code_segment_from_file_contents(contents: str, name: str, citizen: str = 'function', module: ast.Module = None) -> str:
+    segments = get_code_segments_from_file_contents(contents, [(name, citizen)], module)
+    return segments.get((name, citizen))
+
+
+def get_code_segments_from_file_contents(contents: str, targets: List[Tuple[str, str]], module: ast.Module = None) -> dict:
+    """Extract several code objects from Python source with a single parse.
+
+    Parameters
+    ----------
+    contents : str
+        Python source code.
+    targets : List[Tuple[str, str]]
+        Pairs of (name, citizen) to look for. Names may be qualified to
+        reach methods and nested definitions, e.g. 'Class.method'.
+    module : ast.Module, optional
+        The contents already parsed, so they are not parsed again.
+
+    Returns
+    -------
+    dict
+        Source code keyed by (name, citizen) for each target that was found.
+    """
+    lookup = get_qualified_names(module if module is not None else ast.parse(contents))
+
+    result = {}
+    for target in targets:
+        if target in lookup:
+            result[target] = get_definition_source(contents, lookup[target])
+    return result
+
+
+def get_citizen(node: ast.AST) -> str:
     citizens = {
-        'function': ast.FunctionDef,
-        'class': ast.ClassDef,
+        ast.FunctionDef: 'function',
+        ast.AsyncFunctionDef: 'function',
+        ast.ClassDef: 'class',
+    }
+    return citizens.get(type(node))
+
+
+def get_qualified_names(module: ast.AST) -> dict:
+    """Map every function and class in a module to its qualified name.
+
+    Methods and nested definitions are named after the definitions that
+    enclose them, e.g. 'Class.method' or 'outer.inner'. The table is built
+    with a single ast.walk. Later definitions replace earlier ones with the
+    same name, as they do at runtime.
+
+    Parameters
+    ----------
+    module : ast.AST
+        Parsed Python source.
+
+    Returns
+    -------
+    dict
+        Nodes keyed by (qualified name, citizen).
+    """
+    prefixes = {module: ''}
+    table = {}
+
+    for node in ast.walk(module):
+        prefix = prefixes.get(node, '')
+        citizen = get_citizen(node)
+        if citizen is not None:
+            key = (f"{prefix}{node.name}", citizen)
+            if key not in table or table[key].lineno < node.lineno:
+                table[key] = node
+            prefix = f"{prefix}{node.name}."
+        for child in ast.iter_child_nodes(node):
+            prefixes[child] = prefix
+
+    return table
+
+
+def get_definition_source(contents: str, node: Any) -> str:
+    """Return the source of a definition, dedented if it was nested."""
+    segment = ast.get_source_segment(contents, node, padded=True)
+    if node.col_offset:
+        segment = textwrap.dedent(segment)
+    return segment
+
+
+def get_import_statements(module: ast.AST) -> OrderedDict:
+    """Map each name bound by a top level import to a statement importing it alone.
+
+    Parameters
+    ----------
+    module : ast.AST
+        Parsed module.
+
+    Returns
+    -------
+    OrderedDict
+        Import statement keyed by the name it binds, in source order.
+    """
+    statements = OrderedDict()
+    for node in module.body:
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                bound = alias.asname or alias.name.split('.')[0]
+                statement = f"import {alias.name}"
+                statements[bound] = f"{statement} as {alias.asname}" if alias.asname else statement
+        if isinstance(node, ast.ImportFrom):
+            source = '.' * node.level + (node.module or '')
+            for alias in node.names:
+                if alias.name == '*':
+                    continue
+                statement = f"from {source} import {alias.name}"
+                statements[alias.asname or alias.name] = (
+                    f"{statement} as {alias.asname}" if alias.asname else statement)
+    return statements
+
+
+def get_free_names(tree: ast.AST) -> List[str]:
+    """Names a code object reads but does not bind itself, other than builtins.
+
+    Names are listed in the order they are first read. Scopes are not told
+    apart, a name bound anywhere in the code object counts as bound
+    everywhere in it.
+    """
+    bound = set()
+    loaded = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                loaded.append(node)
+            else:
+                bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.alias):
+            bound.add(node.asname or node.name.split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+    names = [node.id for node in sorted(loaded, key=lambda node: (node.lineno, node.col_offset))]
+    return [name for name in OrderedDict.fromkeys(names) if name not in bound and name not in dir(builtins)]
+
+
+def get_dependencies(contents: str, source: str, module: ast.Module = None) -> dict:
+    """Analyze what a code object needs from the module it is defined in.
+
+    Parameters
+    ----------
+    contents : str
+        Source code of the module defining the code object, or None if
+        it is not known.
+    source : str
+        Source code of the code object.
+    module : ast.Module, optional
+        The module contents already parsed, so they are not parsed again.
+
+    Returns
+    -------
+    dict
+        'free_names' the code object reads without binding them,
+        'imports' of the module that bind any of them, one statement per
+        name, and 'dependencies', the functions and classes defined at the
+        top level of the module that it uses.
+    """
+    analysis = {'free_names': [], 'imports': [], 'dependencies': []}
+    try:
+        free_names = get_free_names(ast.parse(source))
+        if module is None:
+            module = ast.parse(contents) if contents else ast.Module(body=[], type_ignores=[])
+    except (SyntaxError, ValueError):
+        return analysis
+
+    statements = get_import_statements(module)
+    siblings = {node.name for node in module.body if get_citizen(node) is not None}
+    analysis['free_names'] = free_names
+    analysis['imports'] = [statement for bound, statement in statements.items() if bound in free_names]
+    analysis['dependencies'] = [name for name in free_names if name in siblings and name not in statements]
+    return analysis
+
+
+def get_definition_pattern(name: str, citizen: str = 'function') -> re.Pattern:
+    """Compile a bytes pattern matching the definition line of a code object.
+
+    The pattern may match lines that are not definitions, such as ones
+    inside strings, but never misses a real one.
+    """
+    return get_definitions_pattern(((name, citizen),))
+
+
+@lru_cache(maxsize=None)
+def get_definitions_pattern(targets: Tuple[Tuple[str, str], ...]) -> re.Pattern:
+    """Compile a bytes pattern matching the definition line of any target."""
+    keywords = {
+        'function': rb'(?:async[ \t]+)?def',
+        'class': rb'class',
     }
+    alternatives = [
+        keywords[citizen] + rb'[ \t]+' + re.escape(name.split('.')[-1].encode())
+        for name, citizen in targets
+    ]
+    return re.compile(
+        rb'^[ \t]*(?:' + rb'|'.join(alternatives) + rb')(?![0-9A-Za-z_])',
+        re.MULTILINE)
 
-    module = ast.parse(contents)
 
+def file_might_define(p: Path, pattern: re.Pattern) -> bool:
+    """Check a memory mapped file for a definition pattern without parsing it."""
     try:
-        nodes = [node for node in module.body if isinstance(
-            node, citizens[citizen])]
-        lookup = {node.name: node for node in nodes}
-        target_node = lookup[name]
-    except Exception as e:
-        message(get_current_func_name(), e)
-        return None
-    else:
-        #print('NODE\n', target_node)
-        return ast.get_source_segment(contents, target_node, padded=True)
+        with open(p, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                return pattern.search(contents) is not None
+    except (OSError, ValueError):
+        return False
+
+
+def find_in_file(p: Path, name: str, citizen: str = 'function') -> str:
+    """Find code object source by name in a Python file.
+
+    Unlike Squirrel.find_function this never exits, files that cannot be
+    read or parsed are treated as not containing the object. Files are only
+    parsed if file_might_define finds a candidate definition line. It is
+    safe to run in a worker process.
+    """
+    found = find_many_in_file(p, ((name, citizen),)).get((name, citizen))
+    return found[1] if found else None
+
+
+def find_many_in_file(p: Path, targets: Tuple[Tuple[str, str], ...]) -> dict:
+    """Find several code objects in a Python file, parsing it at most once.
+
+    Parameters
+    ----------
+    p : Path
+        Python file to search.
+    targets : Tuple[Tuple[str, str], ...]
+        Pairs of (name, citizen) to look for.
+
+    Returns
+    -------
+    dict
+        Pairs of (path, source code) keyed by (name, citizen) for each
+        target that was found.
+    """
+    if not file_might_define(p, get_definitions_pattern(tuple(targets))):
+        return {}
+    try:
+        contents = Path(p).read_text()
+        segments = get_code_segments_from_file_contents(contents, targets)
+        return {target: (p, code) for target, code in segments.items()}
+    except (OSError, UnicodeDecodeError, SyntaxError, ValueError):
+        return {}
+
+
+def get_default_jobs() -> int:
+    return os.cpu_count() or 1
+
+
+def parallel_imap(func: Callable, items: Iterable, jobs: int = 1, *args) -> Iterator[Tuple[Any, Any]]:
+    """Apply a function to every item, spread across worker processes.
+
+    Items are consumed lazily in batches and pairs of (item, result) are
+    yielded in the order of items whatever order the workers finish in. The
+    next batch is submitted before the current one is yielded, so closing
+    the generator early only wastes one batch of work. Inputs smaller than
+    PARALLEL_THRESHOLD are handled in this process.
+
+    Parameters
+    ----------
+    func : Callable
+        Module level function called as func(item, *args).
+    items : Iterable
+        Items to process.
+    jobs : int
+        Number of worker processes.
+
+    Yields
+    ------
+    Tuple[Any, Any]
+        Each item and its result.
+    """
+    items = iter(items)
+
+    if jobs is None or jobs <= 1:
+        for item in items:
+            yield item, func(item, *args)
+        return
+
+    batch = list(islice(items, PARALLEL_THRESHOLD))
+    if len(batch) < PARALLEL_THRESHOLD:
+        for item in batch:
+            yield item, func(item, *args)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    executor = ProcessPoolExecutor(max_workers=jobs)
+
+    def submit(batch):
+        chunksize = max(1, len(batch) // (jobs * 4))
+        return zip(batch, executor.map(func, batch, *[repeat(arg) for arg in args], chunksize=chunksize))
+
+    try:
+        pending = submit(batch)
+        while pending is not None:
+            batch = list(islice(items, PARALLEL_THRESHOLD * jobs))
+            following = submit(batch) if batch else None
+            yield from pending
+            pending = following
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def parallel_map(func: Callable, items: Iterable, jobs: int = 1, *args) -> List:
+    """Apply a function to every item, spread across worker processes.
+
+    Returns the results of parallel_imap as a list in the order of items.
+    """
+    return [result for _, result in parallel_imap(func, items, jobs, *args)]
 
 
 def return_file_content_as_string(p: Path) -> str:
@@ -283,7 +728,7 @@ def return_argument_parts(st: str, obj: str) -> OrderedDict:
         return None
 
     for k, v in qualifiers.items():
-        if v > 2 or '' in st.split(k):
+        if '' in st.split(k):
             print(f"{ERROR.bad_argument} NOT '{st}'")
             return None
 
@@ -299,8 +744,9 @@ def return_argument_parts(st: str, obj: str) -> OrderedDict:
             result[st.split(k)[1]] = None
             return result
 
-        if v == 2 and len(st.split(k)) == 3:
+        if v >= 2 and len(st.split(k)) >= 3:
+            # anything after package.module is a qualified name such as Class.method
             result["package"] = st.split(k)[0]
             result["module"] = st.split(k)[1]
-            result[obj] = st.split(k)[2]
+            result[obj] = '.'.join(st.split(k)[2:])
             return result
@@ -0,0 +1,350 @@
+"""Squirrel Index
+
+This module contains the workspace symbol index for the Squirrel program.
+The index maps code object names to the file and line span that define them
+and is kept on disk so that bare-name lookups do not have to parse the tree.
+
+Examples
+    python -m unittest tests.test_index
+"""
+import os
+import ast
+import json
+from types import SimpleNamespace
+from pathlib import Path, PurePath
+from typing import List, Tuple
+
+from squirrel.config import *
+from squirrel.helpers import *
+
+
+# indexes already read by this process, keyed by resolved directory
+loaded_indexes = {}
+
+
+def new_index() -> dict:
+    return {'version': INDEX_VERSION, 'files': {}}
+
+
+def get_index_path(directory: Path) -> Path:
+    """Path of the symbol index of a tree.
+
+    Indexes are kept in INDEX_DIR, not in the tree, under a name derived
+    from the resolved directory.
+    """
+    directory = Path(directory).resolve()
+    return Path(PurePath(INDEX_DIR, f"{directory.name}-{hash_source(str(directory))[:16]}.json"))
+
+
+def load_index(directory: Path) -> dict:
+    """Read the symbol index stored in a directory.
+
+    Indexes are kept in memory once read, so a long running process such
+    as the lookup server only reads each one once.
+
+    Parameters
+    ----------
+    directory : Path
+        Root directory of the indexed tree.
+
+    Returns
+    -------
+    dict
+        The stored index or an empty index if none is usable.
+    """
+    key = str(Path(directory).resolve())
+    if key in loaded_indexes:
+        return loaded_indexes[key]
+
+    try:
+        idx = json.loads(get_index_path(directory).read_text())
+    except (OSError, ValueError):
+        idx = None
+    if not isinstance(idx, dict) or idx.get('version') != INDEX_VERSION:
+        idx = new_index()
+
+    loaded_indexes[key] = idx
+    return idx
+
+
+def save_index(directory: Path, idx: dict):
+    p = get_index_path(directory)
+    tmp = p.with_name(f"{p.name}.tmp")
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps({'version': idx['version'], 'files': idx['files']}))
+        os.replace(tmp, p)
+    except OSError as e:
+        print(e)
+
+
+def get_file_signature(p: Path) -> List[int]:
+    st = os.stat(p)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def get_symbols_from_file_contents(contents: str) -> List[dict]:
+    """List the functions and classes defined in Python source.
+
+    Methods and nested definitions are listed under their qualified name,
+    e.g. 'Class.method'.
+
+    Parameters
+    ----------
+    contents : str
+        Python source code.
+
+    Returns
+    -------
+    List[dict]
+        Name, type and span of each definition in source order.
+    """
+    try:
+        module = ast.parse(contents)
+    except (SyntaxError, ValueError):
+        return []
+
+    symbols = [
+        {
+            'name': name,
+            'type': citizen,
+            'lineno': node.lineno,
+            'col_offset': node.col_offset,
+            'end_lineno': node.end_lineno,
+            'end_col_offset': node.end_col_offset
+        }
+        for (name, citizen), node in get_qualified_names(module).items()
+    ]
+    return sorted(symbols, key=lambda i: (i['lineno'], i['col_offset']))
+
+
+def index_file(p: Path) -> List[dict]:
+    try:
+        contents = Path(p).read_text()
+    except (OSError, UnicodeDecodeError):
+        return []
+    return get_symbols_from_file_contents(contents)
+
+
+def refresh_index(directory: Path, idx: dict = None, jobs: int = 1) -> dict:
+    """Bring the symbol index of a directory up to date.
+
+    Files are only parsed again when their mtime or size changed since they
+    were last indexed. Entries for files that no longer exist are dropped.
+
+    Parameters
+    ----------
+    directory : Path
+        Root directory of the indexed tree.
+    idx : dict, optional
+        Previously loaded index, read from disk if not given.
+    jobs : int, optional
+        Number of worker processes used to parse changed files.
+
+    Returns
+    -------
+    dict
+        The refreshed index.
+    """
+    directory = Path(directory)
+
+    if idx is None:
+        idx = load_index(directory)
+
+    old_files = idx['files']
+    new_files = {}
+    stale = []
+
+    for fd in walk_py_files(directory):
+        key = Path(fd).relative_to(directory).as_posix()
+        try:
+            signature = get_file_signature(fd)
+        except OSError:
+            continue
+        entry = old_files.get(key)
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature, 'symbols': []}
+            stale.append((fd, entry))
+        new_files[key] = entry
+
+    symbols = parallel_map(index_file, [fd for fd, _ in stale], jobs)
+    for (_, entry), syms in zip(stale, symbols):
+        entry['symbols'] = syms
+
+    if stale or new_files.keys() != old_files.keys():
+        idx['files'] = new_files
+        idx.pop('names', None)
+        save_index(directory, idx)
+
+    return idx
+
+
+def get_changed_files(directory: Path, idx: dict) -> dict:
+    """Reindex the files of an index that changed since they were indexed.
+
+    Only files already in the index are checked and the tree is not walked,
+    new files are picked up by the next lookup that misses. The index is not
+    modified, see apply_changed_files.
+
+    Returns
+    -------
+    dict
+        Pairs of (old entry, new entry) keyed by file, the new entry None for
+        files that no longer exist.
+    """
+    changes = {}
+    for key, entry in list(idx['files'].items()):
+        p = Path(PurePath(directory, key))
+        try:
+            signature = get_file_signature(p)
+        except OSError:
+            changes[key] = (entry, None)
+            continue
+        if signature != entry['signature']:
+            changes[key] = (entry, {'signature': signature, 'symbols': index_file(p)})
+    return changes
+
+
+def apply_changed_files(directory: Path, idx: dict, changes: dict):
+    """Swap the entries found by get_changed_files into an index.
+
+    Entries updated by a lookup since they were checked are left as they are.
+    """
+    applied = False
+    for key, (old, new) in changes.items():
+        if idx['files'].get(key) is not old:
+            continue
+        if new is None:
+            del idx['files'][key]
+        else:
+            idx['files'][key] = new
+        applied = True
+    if applied:
+        idx.pop('names', None)
+        save_index(directory, idx)
+
+
+def get_name_table(idx: dict) -> dict:
+    """Map (name, citizen) to the symbols defining it across the whole index.
+
+    The table is built once per loaded index and dropped whenever its files
+    change, so repeated lookups do not rescan every file entry.
+    """
+    if 'names' not in idx:
+        table = {}
+        for key, entry in idx['files'].items():
+            for symbol in entry['symbols']:
+                table.setdefault((symbol['name'], symbol['type']), []).append((key, symbol))
+        idx['names'] = table
+    return idx['names']
+
+
+def lookup_symbol(idx: dict, name: str, citizen: str = 'function') -> List[Tuple[str, dict]]:
+    return get_name_table(idx).get((name, citizen), [])
+
+
+def get_symbol_source(contents: str, symbol: dict) -> str:
+    return get_definition_source(contents, SimpleNamespace(**symbol))
+
+
+def is_fresh(directory: Path, idx: dict, key: str) -> bool:
+    try:
+        return get_file_signature(PurePath(directory, key)) == idx['files'][key]['signature']
+    except (OSError, KeyError):
+        return False
+
+
+def find_symbol_in_file(directory: Path, p: Path, name: str, citizen: str = 'function') -> str:
+    """Find code object source by qualified name in one file of an indexed tree.
+
+    The file's entry in the index is refreshed if it changed, so only the
+    first lookup in a file pays for parsing it.
+
+    Parameters
+    ----------
+    directory : Path
+        Root directory of the indexed tree.
+    p : Path
+        Python file to search.
+    name : str
+        Qualified name of the code object, e.g. 'Class.method'.
+    citizen : str
+        Either 'function' or 'class'.
+
+    Returns
+    -------
+    str
+        Source code for the definition or None if it was not found.
+    """
+    directory = Path(directory)
+    try:
+        key = Path(p).relative_to(directory).as_posix()
+    except ValueError:
+        return find_in_file(p, name, citizen)
+
+    idx = load_index(directory)
+    if not is_fresh(directory, idx, key):
+        idx['files'][key] = {'signature': get_file_signature(p), 'symbols': index_file(p)}
+        idx.pop('names', None)
+        save_index(directory, idx)
+
+    for hit_key, symbol in lookup_symbol(idx, name, citizen):
+        if hit_key == key:
+            return get_symbol_source(Path(p).read_text(), symbol)
+    return None
+
+
+def find_symbols_in_index(directory: Path, targets: List[Tuple[str, str]], jobs: int = 1, all_matches: bool = False) -> dict:
+    """Find the source of several code objects using the directory's symbol index.
+
+    If the first indexed hit of every target is in an unchanged file those
+    are sliced straight from disk. Otherwise the index is refreshed once for
+    all targets, so an edited file is never passed over for a later one. Each
+    file holding a hit is read once however many targets it defines.
+
+    Parameters
+    ----------
+    directory : Path
+        Root directory of the indexed tree.
+    targets : List[Tuple[str, str]]
+        Pairs of (name, citizen) to look for.
+    jobs : int, optional
+        Number of worker processes used if the index must be refreshed.
+    all_matches : bool, optional
+        Return every definition of each target instead of the first one.
+
+    Returns
+    -------
+    dict
+        List of (path, source) pairs keyed by (name, citizen), empty for
+        targets not found.
+    """
+    idx = load_index(directory)
+    hits = None
+
+    if not all_matches:
+        hits = {}
+        for name, citizen in targets:
+            found = lookup_symbol(idx, name, citizen)[:1]
+            if found == [] or not is_fresh(directory, idx, found[0][0]):
+                hits = None
+                break
+            hits[(name, citizen)] = found
+
+    if hits is None:
+        idx = refresh_index(directory, idx, jobs)
+        hits = {}
+        for name, citizen in targets:
+            found = lookup_symbol(idx, name, citizen)
+            hits[(name, citizen)] = found if all_matches else found[:1]
+
+    contents = {}
+    result = {}
+    for target, found in hits.items():
+        result[target] = []
+        for key, symbol in found:
+            p = Path(PurePath(directory, key))
+            if key not in contents:
+                contents[key] = p.read_text()
+            result[target].append((p, get_symbol_source(contents[key], symbol)))
+    return result
@@ -0,0 +1,129 @@
+"""Journal
+
+This module contains the offline stash journal of the Squirrel program.
+Stashes made while MongoDB cannot be reached are appended to a local file,
+one JSON object per line, and replayed in bulk once it can.
+
+Examples
+    squirrel db flush
+    python -m unittest tests.test_journal
+"""
+import os
+import fcntl
+from contextlib import contextmanager
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Tuple
+from bson import json_util
+
+from squirrel.config import *
+from squirrel.storage import JSON_OPTIONS, open_storage, get_fingerprint
+
+
+class Journal():
+    """Append-only file of stashes waiting for their database.
+
+    Every append is synced to disk once, however many stashes it holds.
+    Appends and replays take an exclusive lock on the file, so concurrent
+    runs neither interleave lines nor replay the same stash twice.
+    """
+
+    def __init__(self, path: Path = JOURNAL_PATH):
+        self.path = Path(path)
+
+    @contextmanager
+    def locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a+', encoding='utf-8') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, records: List[dict]):
+        with self.locked() as f:
+            f.writelines(json_util.dumps(record, json_options=JSON_OPTIONS) + '\n' for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def is_empty(self) -> bool:
+        try:
+            return self.path.stat().st_size == 0
+        except OSError:
+            return True
+
+
+def journal_entries(database: str, layout: str, keyframe_interval: int, entries: List[dict], journal: Journal = None):
+    """Keep stashes for a database in the journal, see Storage.stash for entries."""
+    journal = journal or Journal()
+    settings = {'database': database, 'layout': layout, 'keyframe_interval': keyframe_interval}
+    journal.append([{**settings, **entry} for entry in entries])
+
+
+def has_journal(journal: Journal = None) -> bool:
+    return not (journal or Journal()).is_empty()
+
+
+def replay_journal(batch_size: int = BATCH_SIZE, journal: Journal = None) -> Tuple[int, int]:
+    """Stash every journaled entry whose database can now be reached.
+
+    Entries are stashed in bulk, one batch per database. An entry stays in
+    the journal until its stored hash is confirmed to match.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        Number of writes sent together.
+    journal : Journal, optional
+        Journal to replay, the default one if not given.
+
+    Returns
+    -------
+    Tuple[int, int]
+        Number of entries replayed and number left in the journal.
+    """
+    journal = journal or Journal()
+    if journal.is_empty():
+        return 0, 0
+
+    with journal.locked() as f:
+        f.seek(0)
+        records = [json_util.loads(line, json_options=JSON_OPTIONS) for line in f if line.strip()]
+
+        groups = OrderedDict()
+        for record in records:
+            key = (record['database'], record['layout'], record['keyframe_interval'])
+            groups.setdefault(key, []).append(record)
+
+        remaining = []
+        for key, entries in groups.items():
+            storage = open_storage(*key)
+            if storage is None or not storage.is_available():
+                remaining += entries
+                continue
+            storage.stash(entries, batch_size)
+            remaining += get_unconfirmed(storage, entries)
+
+        f.seek(0)
+        f.truncate()
+        f.writelines(json_util.dumps(record, json_options=JSON_OPTIONS) + '\n' for record in remaining)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return len(records) - len(remaining), len(remaining)
+
+
+def get_unconfirmed(storage, entries: List[dict]) -> List[dict]:
+    """Entries whose version is not stored with the journaled fields.
+
+    Only the last entry for each version counts, earlier ones were replaced
+    by it.
+    """
+    stored = storage.get_stored_fingerprints(entries)
+    last = OrderedDict()
+    for entry in entries:
+        key = (entry['collection'], entry['name'], entry['version']['version_name'])
+        last.pop(key, None)
+        last[key] = entry
+    return [entry for key, entry in last.items() if stored.get(key) != get_fingerprint(entry)]
@@ -0,0 +1,122 @@
+"""Plant
+
+This module contains the plant command of the Squirrel program. Stashed
+code objects are written into a Python file in one read-modify-write:
+the target is parsed once, definitions it already has are replaced in
+place and the rest are appended, along with the imports they need.
+
+Examples
+    squirrel plant module.py FUNCTION CLASS
+    python -m unittest tests.test_plant
+"""
+import os
+import ast
+import tempfile
+import textwrap
+from pathlib import Path
+from typing import List, Tuple
+
+from squirrel.helpers import get_qualified_names, get_import_statements
+
+
+def get_import_line(module: ast.Module) -> int:
+    """Line after which new imports go.
+
+    That is the last top level import, or else the module docstring, or
+    the top of the file.
+    """
+    line = 0
+    for index, node in enumerate(module.body):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            line = node.end_lineno
+        elif index == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) \
+                and isinstance(node.value.value, str):
+            line = node.end_lineno
+    return line
+
+
+def plant_sources(contents: str, objects: List[Tuple[str, str, str, List[str]]]) -> str:
+    """Write code objects into the source of a module.
+
+    A definition the module already has is replaced by line span, at its
+    indentation, keeping its decorators. Other objects are appended to
+    the module. Import statements the module does not have yet are added
+    after its imports.
+
+    Parameters
+    ----------
+    contents : str
+        Source of the target module.
+    objects : List[Tuple[str, str, str, List[str]]]
+        Name, citizen, source and import statements of each code object.
+
+    Returns
+    -------
+    str
+        The new source of the module.
+    """
+    module = ast.parse(contents)
+    definitions = get_qualified_names(module)
+    imported = set(get_import_statements(module).values())
+    lines = contents.splitlines(keepends=True)
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+
+    edits = []
+    appended = []
+    missing_imports = []
+    for name, citizen, source, imports in objects:
+        source = source.rstrip('\n') + '\n'
+        node = definitions.get((name, citizen))
+        if node is None:
+            appended.append(source)
+        else:
+            edits.append((node.lineno, node.end_lineno, textwrap.indent(source, ' ' * node.col_offset)))
+        for statement in imports or []:
+            if statement not in imported and statement not in missing_imports:
+                missing_imports.append(statement)
+
+    if missing_imports:
+        line = get_import_line(module)
+        edits.append((line + 1, line, ''.join(f"{statement}\n" for statement in missing_imports)))
+
+    # spans are replaced from the bottom up so earlier line numbers stay valid
+    for start, end, text in sorted(edits, reverse=True):
+        lines[start - 1:end] = [text]
+
+    body = ''.join(lines).rstrip('\n')
+    for source in appended:
+        body = f"{body}\n\n\n{source.rstrip()}" if body else source.rstrip()
+    return body.rstrip('\n') + '\n' if body else ''
+
+
+def write_atomically(p: Path, contents: str):
+    """Replace a file's contents, so it is never seen half written."""
+    p = Path(p)
+    fd, temp = tempfile.mkstemp(dir=p.parent, prefix=f".{p.name}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(contents)
+        if p.exists():
+            os.chmod(temp, p.stat().st_mode)
+        os.replace(temp, p)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def plant(p: Path, objects: List[Tuple[str, str, str, List[str]]]) -> str:
+    """Plant code objects into a Python file, creating it if it is missing.
+
+    See plant_sources for objects.
+
+    Returns
+    -------
+    str
+        The new contents of the file.
+    """
+    p = Path(p)
+    contents = p.read_text() if p.exists() else ''
+    planted = plant_sources(contents, objects)
+    write_atomically(p, planted)
+    return planted
@@ -6,42 +6,270 @@ Examples
     python -m unittest tests.test_queries
 """
 import sys
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
 from pprint import pprint
-from typing import List
+from typing import Iterator, List
 from bson import ObjectId
 from pymongo import MongoClient
 from pymongo.database import Database
-from pymongo.errors import ServerSelectionTimeoutError
-from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ServerSelectionTimeoutError
+from pymongo import ReturnDocument, UpdateOne, ASCENDING, TEXT, monitoring
+from pymongo.server_type import SERVER_TYPE
 
 from squirrel.helpers import *
 
 
+# shared by every query in this process, see get_client
+client = None
+
+
+def configure_client(uri: str = None, pool_size: int = None):
+    """Change the settings used for the shared client.
+
+    The current client, if any, is closed and a new one is created with
+    the new settings on next use.
+
+    Parameters
+    ----------
+    uri : str, optional
+        MongoDB connection string.
+    pool_size : int, optional
+        Maximum number of connections kept by the client.
+    """
+    global client, MONGO_URI, MONGO_POOL_SIZE
+    if uri is not None:
+        MONGO_URI = uri
+    if pool_size is not None:
+        MONGO_POOL_SIZE = pool_size
+    if client is not None:
+        client.close()
+        client = None
+    forget_health()
+
+
+def get_client() -> MongoClient:
+    """Return the client shared by every query in this process.
+
+    The client is created on first use. pymongo clients are thread safe and
+    pool their connections, so reusing one avoids a new handshake and new
+    monitor threads per query.
+    """
+    global client
+    if client is None:
+        client = MongoClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            event_listeners=[HealthListener()])
+    return client
+
+
+# whether the shared client last saw a usable server, and when, see is_reachable
+health = {'available': False, 'checked': None}
+
+# databases known to exist and when the list was last read, see has_database
+known_databases = set()
+listed_databases = {'checked': None}
+
+
+def set_health(available: bool):
+    health['available'] = available
+    health['checked'] = time.monotonic()
+
+
+def forget_health():
+    health['checked'] = None
+    listed_databases['checked'] = None
+    known_databases.clear()
+    failed_indexes.clear()
+
+
+def is_fresh(checked: float) -> bool:
+    return checked is not None and time.monotonic() - checked < AVAILABILITY_TTL
+
+
+class HealthListener(monitoring.ServerHeartbeatListener, monitoring.TopologyListener):
+    """Track server availability from the shared client's monitor.
+
+    The client checks its servers in the background, so availability is
+    known without sending a ping of our own.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        set_health(True)
+
+    def failed(self, event):
+        set_health(False)
+
+    def opened(self, event):
+        pass
+
+    def description_changed(self, event):
+        # servers not checked yet are Unknown without an error
+        description = event.new_description
+        servers = description.server_descriptions().values()
+        if any(server.server_type != SERVER_TYPE.Unknown or server.error is not None for server in servers):
+            set_health(description.has_writable_server())
+
+    def closed(self, event):
+        pass
+
+
+def get_collection(db_name: str, collection: str):
+    """Return a collection of the shared client.
+
+    The first time a code collection of a database is used, the indexes of
+    that database are created, see ensure_indexes. If that fails it is not
+    tried again for the availability TTL, so an unreachable server costs
+    one server selection timeout rather than one per query. The failure is
+    not printed, the query that follows reports it.
+    """
+    if db_name not in indexed_databases and collection in CODE_COLLECTIONS \
+            and not is_fresh(failed_indexes.get(db_name)):
+        indexed_databases.add(db_name)
+        if ensure_indexes(db_name, quiet=True) is None:
+            indexed_databases.discard(db_name)
+            failed_indexes[db_name] = time.monotonic()
+    return get_client()[db_name][collection]
+
+
+# indexes already created by this process, see ensure_indexes
+created_indexes = set()
+
+# databases whose indexes were ensured by this process, see get_collection
+indexed_databases = set()
+
+# when ensuring the indexes of a database last failed, see get_collection
+failed_indexes = {}
+
+CODE_COLLECTIONS = [*COLLECTIONS.values(), *VERSION_COLLECTIONS.values()]
+
+
+def get_index_specs(collection: str) -> List[tuple]:
+    """List the indexes of a code collection as (keys, options) pairs."""
+    if collection in VERSION_COLLECTIONS.values():
+        return [
+            ([('object_id', ASCENDING), ('version_name', ASCENDING)], {'unique': True}),
+            ([('object_id', ASCENDING), ('created', ASCENDING)], {}),
+            ([('name', ASCENDING), ('version_name', ASCENDING)], {}),
+            ([('hash', ASCENDING)], {}),
+            ([('name', TEXT), ('docstring', TEXT), ('source', TEXT)], {'weights': TEXT_WEIGHTS})
+        ]
+    return [
+        ([('name', ASCENDING)], {'unique': True}),
+        ([('qualified_name', ASCENDING)], {}),
+        ([('name', ASCENDING), ('versions.version_name', ASCENDING)], {}),
+        ([('versions.created', ASCENDING)], {}),
+        ([('versions.hash', ASCENDING)], {}),
+        ([('name', TEXT), ('versions.docstring', TEXT), ('versions.source', TEXT)],
+         {'weights': {f"versions.{k}" if k != 'name' else k: v for k, v in TEXT_WEIGHTS.items()}})
+    ]
+
+
+def ensure_indexes(db_name: str, force: bool = False, quiet: bool = False) -> List[str]:
+    """Create the indexes of every code collection in a database.
+
+    Lookups by name, qualified name, version name and creation date are
+    served by an index instead of a collection scan. Creating an index that
+    already exists is a no-op on the server, and indexes created by this
+    process are not sent again unless force is set.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    force : bool, optional
+        Send every index to the server even if this process created it.
+    quiet : bool, optional
+        Do not print the error if it failed.
+
+    Returns
+    -------
+    List[str]
+        Names of the indexes sent to the server or None if it failed.
+    """
+    names = []
+    try:
+        db = get_client()[db_name]
+        for collection in CODE_COLLECTIONS:
+            for keys, kwargs in get_index_specs(collection):
+                key = (db_name, collection, tuple(keys))
+                if key in created_indexes and not force:
+                    continue
+                names.append(db[collection].create_index(keys, **kwargs))
+                created_indexes.add(key)
+    except Exception as e:
+        if not quiet:
+            print(e)
+        return None
+    else:
+        return names
+
+
 def has_database(db_name: str) -> bool:
-    if has_client():
-        return db_name in MongoClient().list_database_names()
-    return False
+    """Check whether a database exists.
+
+    Databases seen once are remembered for the life of the process. The
+    list of databases is read again only if it is older than the
+    availability TTL.
+    """
+    if db_name in known_databases:
+        return True
+    if not has_client():
+        return False
+    if not is_fresh(listed_databases['checked']):
+        try:
+            known_databases.update(get_client().list_database_names())
+        except Exception as e:
+            print(e)
+            return False
+        listed_databases['checked'] = time.monotonic()
+    return db_name in known_databases
 
 
 def has_client(client_uri: str = None) -> bool:
-    timeout = 500
     try:
-        running_client = MongoClient(
-            client_uri, serverSelectionTimeoutMS=timeout)
+        if client_uri is None or client_uri == MONGO_URI:
+            if not is_reachable():
+                raise ServerSelectionTimeoutError(f"no server reachable at {MONGO_URI}")
+        else:
+            with MongoClient(client_uri, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS) as running_client:
+                running_client.admin.command('ping')
     except ServerSelectionTimeoutError as e:
         print("no running mongo instance detected!")
         print("run 'service mongod status'")
         return False
     else:
-        ver = running_client.server_info().get('version')
-        #print(f"MongoDB version {ver} available!")
         return True
 
 
+def is_reachable() -> bool:
+    """Check quietly whether the shared client can reach a server.
+
+    The answer is kept for AVAILABILITY_TTL seconds, and refreshed for free
+    by the client's own heartbeats, so only the first call of a run, or one
+    after a quiet spell, sends a ping.
+    """
+    client = get_client()
+    if is_fresh(health['checked']):
+        return health['available']
+    try:
+        client.admin.command('ping')
+    except Exception:
+        set_health(False)
+    else:
+        set_health(True)
+    return health['available']
+
+
 def create_database(db_name: str, collection: str, *initial: dict) -> Database:
     try:
-        client = MongoClient()
-        db = client[db_name]
+        db = get_client()[db_name]
         col = db[collection]
     except Exception as e:
         print(e)
@@ -57,9 +285,7 @@ def create_database(db_name: str, collection: str, *initial: dict) -> Database:
 
 def insert_item(db_name: str, collection: str, item: dict, **kwargs) -> ObjectId:
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -75,9 +301,7 @@ def insert_item(db_name: str, collection: str, item: dict, **kwargs) -> ObjectId
 
 def insert_many_items(db_name: str, collection: str, *items):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -99,9 +323,7 @@ def insert_unique_item(db_name: str, collection: str, query: dict):
 
 def item_exists(db_name: str, collection: str, query: dict) -> bool:
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return False
@@ -111,9 +333,7 @@ def item_exists(db_name: str, collection: str, query: dict) -> bool:
 
 def get_item(db_name: str, collection: str, it: dict, **kwargs):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -123,9 +343,7 @@ def get_item(db_name: str, collection: str, it: dict, **kwargs):
 
 def get_many_items(db_name: str, collection: str, **kwargs):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -135,9 +353,7 @@ def get_many_items(db_name: str, collection: str, **kwargs):
 
 def get_all_items_in_collection(db_name: str, collection: str) -> List:
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
         cursor = col.find({})
     except Exception as e:
         print(e)
@@ -151,11 +367,42 @@ def get_all_items_in_collection(db_name: str, collection: str) -> List:
         return result
 
 
+def iter_collection(db_name: str, collection: str, batch_size: int = BATCH_SIZE) -> Iterator[dict]:
+    """Yield every document of a collection without holding them all in memory.
+
+    Documents are fetched from the server batch_size at a time. Errors while
+    iterating are raised, so a partial read is never mistaken for a whole one.
+    """
+    col = get_collection(db_name, collection)
+    with col.find({}, batch_size=batch_size) as cursor:
+        yield from cursor
+
+
+def insert_batch(db_name: str, collection: str, items: List[dict]) -> int:
+    """Insert documents in one unordered bulk write.
+
+    Documents that fail, e.g. with a duplicate _id, do not stop the others.
+
+    Returns
+    -------
+    int
+        Number of documents inserted or None if the write failed.
+    """
+    if items == []:
+        return 0
+    try:
+        col = get_collection(db_name, collection)
+        return len(col.insert_many(items, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        return e.details['nInserted']
+    except Exception as e:
+        print(e)
+        return None
+
+
 def update_item(db_name: str, collection: str, to_update: dict, changes: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -166,9 +413,7 @@ def update_item(db_name: str, collection: str, to_update: dict, changes: dict):
 
 def update_many(db_name: str, collection: str, query: dict, changes: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -179,9 +424,7 @@ def update_many(db_name: str, collection: str, query: dict, changes: dict):
 
 def insert_embedded_document(db_name: str, collection: str, query: dict, new_item: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -192,9 +435,7 @@ def insert_embedded_document(db_name: str, collection: str, query: dict, new_ite
 
 def find_one_and_update(db_name: str, collection: str, fil: dict, update: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -214,9 +455,7 @@ def find_one_and_update(db_name: str, collection: str, fil: dict, update: dict):
 
 def add_field(db_name: str, collection: str, it: dict, new_value: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -227,9 +466,7 @@ def add_field(db_name: str, collection: str, it: dict, new_value: dict):
 
 def remove_one(db_name: str, collection: str, item: dict, **kwargs):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -245,9 +482,7 @@ def remove_one(db_name: str, collection: str, item: dict, **kwargs):
 
 def remove_many(db_name: str, collection: str, fil: dict, **kwargs):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -263,9 +498,7 @@ def remove_many(db_name: str, collection: str, fil: dict, **kwargs):
 
 def query(db_name: str, collection: str, query: dict):
     try:
-        client = MongoClient()
-        db = client[db_name]
-        col = db[collection]
+        col = get_collection(db_name, collection)
     except Exception as e:
         print(e)
         return None
@@ -273,82 +506,835 @@ def query(db_name: str, collection: str, query: dict):
         return col.find(query)
 
 
-def handle_code_change(db_name, col: str, incoming: dict, existing: dict, named: str) -> dict:
+def get_versions_collection(collection: str) -> str:
+    return VERSION_COLLECTIONS.get(collection, f"{collection}_versions")
+
+
+class UnitOfWork():
+    """Writes to one database collected to be sent together.
+
+    Operations are sent with one ordered bulk_write per collection and
+    batch, instead of one round trip each. Versions of the split layout are
+    sent after their code objects, whose _ids are then fetched with one
+    query per collection. If a flush fails, failed is set, so the caller
+    can tell after the unit is closed.
+    """
+
+    def __init__(self, db_name: str, batch_size: int = BATCH_SIZE):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.operations = OrderedDict()
+        self.split_versions = OrderedDict()
+        self.pending = 0
+        self.collected = 0
+        self.failed = False
+
+    def add(self, collection: str, operation):
+        self.operations.setdefault(collection, []).append(operation)
+        self.count()
+
+    def add_split_version(self, collection: str, name: str, version_name: str, update: dict):
+        self.split_versions.setdefault(collection, []).append((name, version_name, update))
+        self.count()
+
+    def count(self):
+        self.pending += 1
+        self.collected += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """Send every collected write.
+
+        Returns
+        -------
+        int
+            Number of operations sent or None if a write failed.
+        """
+        operations, self.operations = self.operations, OrderedDict()
+        split_versions, self.split_versions = self.split_versions, OrderedDict()
+        self.pending = 0
+        sent = 0
+
+        try:
+            for collection, ops in operations.items():
+                col = get_collection(self.db_name, collection)
+                for i in range(0, len(ops), self.batch_size):
+                    col.bulk_write(ops[i:i + self.batch_size], ordered=True)
+                sent += len(ops)
+
+            for collection, versions in split_versions.items():
+                names = list(OrderedDict.fromkeys(name for name, _, _ in versions))
+                col = get_collection(self.db_name, collection)
+                ids = {doc['name']: doc['_id'] for doc in col.find({'name': {'$in': names}}, {'name': 1})}
+                ops = [
+                    UpdateOne({'object_id': ids[name], 'version_name': version_name}, update, upsert=True)
+                    for name, version_name, update in versions
+                ]
+                col = get_collection(self.db_name, get_versions_collection(collection))
+                for i in range(0, len(ops), self.batch_size):
+                    col.bulk_write(ops[i:i + self.batch_size], ordered=True)
+                sent += len(ops)
+        except Exception as e:
+            print(e)
+            self.failed = True
+            return None
+        else:
+            return sent
+
+
+# unit of work collecting the writes of this process, see unit_of_work
+active_unit = None
+
+
+def get_unit_of_work(db_name: str) -> UnitOfWork:
+    if active_unit is not None and active_unit.db_name == db_name:
+        return active_unit
+    return None
+
+
+@contextmanager
+def unit_of_work(db_name: str, batch_size: int = BATCH_SIZE):
+    """Collect the writes made to a database and send them in bulk on exit.
+
+    Writes are sent early whenever batch_size of them are collected. A unit
+    of work opened while one is active for the same database joins it.
+
+    Examples
+        with unit_of_work(DB_NAME):
+            upsert_version(DB_NAME, 'functions', 'a', 'function', version_a)
+            upsert_version(DB_NAME, 'functions', 'b', 'function', version_b)
+    """
+    global active_unit
+    if get_unit_of_work(db_name) is not None:
+        yield active_unit
+        return
+
+    previous, active_unit = active_unit, UnitOfWork(db_name, batch_size)
+    unit = active_unit
+    try:
+        yield unit
+    finally:
+        active_unit = previous
+        unit.flush()
+
+
+def write(db_name: str, collection: str, operation):
+    """Send one write operation, or leave it to the active unit of work.
+
+    Returns
+    -------
+    BulkWriteResult
+        Result of the write, or None if it failed or was collected.
+    """
+    unit = get_unit_of_work(db_name)
+    if unit is not None:
+        unit.add(collection, operation)
+        return None
+    try:
+        col = get_collection(db_name, collection)
+        return col.bulk_write([operation])
+    except Exception as e:
+        print(e)
+        return None
+
+
+def get_version_hashes(db_name: str, collection: str, names: List[str], layout: str = None,
+                       field: str = 'hash') -> dict:
+    """Fetch the content hash of every version of several code objects at once.
+
+    Pass field='fingerprint' for the hash of every stored field instead.
+
+    Returns
+    -------
+    dict
+        Hash keyed by (name, version_name), or None if the query failed.
+    """
+    try:
+        if (layout or STORAGE_LAYOUT) == 'split':
+            col = get_collection(db_name, get_versions_collection(collection))
+            return {
+                (ver['name'], ver['version_name']): ver.get(field)
+                for ver in col.find({'name': {'$in': names}}, {'name': 1, 'version_name': 1, field: 1})
+            }
+
+        col = get_collection(db_name, collection)
+        projection = {'name': 1, 'versions.version_name': 1, f'versions.{field}': 1}
+        return {
+            (doc['name'], ver['version_name']): ver.get(field)
+            for doc in col.find({'name': {'$in': names}}, projection)
+            for ver in doc.get('versions', [])
+        }
+    except Exception as e:
+        print(e)
+        return None
+
+
+def upsert_split_version(db_name: str, collection: str, name: str, obj_type: str, version: dict, qualified_name: str = None):
+    """Stash a version of a code object using the split layout.
+
+    The object document only holds the name and type. Each version is a
+    document of its own in the versions collection, keyed by the object's
+    _id and the version name, so documents no longer grow with history.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the object collection.
+    name : str
+        Name of the code object.
+    obj_type : str
+        Either 'function' or 'class'.
+    version : dict
+        Version to stash, see schemas.version_instance.
+    qualified_name : str, optional
+        Dotted path of the code object, kept as is if not given.
+
+    Returns
+    -------
+    UpdateResult
+        Result of the version update, or None if it failed or was left to
+        the active unit of work.
+    """
+    changes = filter_dict(version, lambda elem: elem[0] not in ['created', 'version_name'])
+    if qualified_name is None:
+        update = {'$setOnInsert': {'name': name, 'type': obj_type, 'qualified_name': name}}
+    else:
+        update = {'$setOnInsert': {'name': name, 'type': obj_type}, '$set': {'qualified_name': qualified_name}}
+
+    version_update = {
+        '$set': {**changes, 'name': name},
+        '$setOnInsert': {'created': version['created']}
+    }
+
+    unit = get_unit_of_work(db_name)
+    if unit is not None:
+        unit.add(collection, UpdateOne({'name': name}, update, upsert=True))
+        unit.add_split_version(collection, name, version['version_name'], version_update)
+        return None
+
+    try:
+        col = get_collection(db_name, collection)
+        obj = col.find_one_and_update(
+            {'name': name},
+            update,
+            projection={'_id': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        versions = get_collection(db_name, get_versions_collection(collection))
+        return versions.update_one(
+            {'object_id': obj['_id'], 'version_name': version['version_name']},
+            version_update,
+            upsert=True
+        )
+    except Exception as e:
+        print(e)
+        return None
+
+
+def upsert_version(db_name: str, collection: str, name: str, obj_type: str, version: dict, qualified_name: str = None):
+    """Stash a version of a code object in a single round trip.
+
+    The document is created if it is missing. A version whose name is new is
+    appended to it, otherwise the source and docstring of the version with
+    that name are updated in place. Uses an update pipeline, which needs
+    MongoDB 4.2 or later.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the collection.
+    name : str
+        Name of the code object.
+    obj_type : str
+        Either 'function' or 'class'.
+    version : dict
+        Version to stash, see schemas.version_instance.
+    qualified_name : str, optional
+        Dotted path of the code object, kept as is if not given.
+
+    Returns
+    -------
+    BulkWriteResult
+        Result of the update, or None if it failed or was left to the active
+        unit of work.
+    """
+    # values are wrapped in $literal so that text starting with '$' is not
+    # read as a field path
+    versions = {'$ifNull': ['$versions', []]}
+    exists = {'$in': [version['version_name'], {'$ifNull': ['$versions.version_name', []]}]}
+    changes = {
+        field: {'$literal': version[field]}
+        for field in VERSION_FIELDS if field in version
+    }
+    pipeline = [
+        {'$set': {
+            'name': {'$literal': name},
+            'type': {'$literal': obj_type},
+            'qualified_name': (
+                {'$ifNull': ['$qualified_name', {'$literal': name}]} if qualified_name is None
+                else {'$literal': qualified_name}),
+            'versions': {'$cond': [
+                exists,
+                {'$map': {
+                    'input': versions,
+                    'as': 'v',
+                    'in': {'$cond': [
+                        {'$eq': ['$$v.version_name', {'$literal': version['version_name']}]},
+                        {'$mergeObjects': ['$$v', changes]},
+                        '$$v'
+                    ]}
+                }},
+                {'$concatArrays': [versions, [{'$literal': version}]]}
+            ]}
+        }}
+    ]
+
+    return write(db_name, collection, UpdateOne({'name': name}, pipeline, upsert=True))
+
+
+def get_versions(db_name: str, collection: str, name: str, layout: str = None) -> List[dict]:
+    """Fetch every version of a code object in the order they were stashed."""
+    if (layout or STORAGE_LAYOUT) == 'split':
+        try:
+            col = get_collection(db_name, get_versions_collection(collection))
+            return list(col.find({'name': name}).sort([('created', ASCENDING), ('_id', ASCENDING)]))
+        except Exception as e:
+            print(e)
+            return None
+
+    try:
+        col = get_collection(db_name, collection)
+        document = col.find_one({'name': name}, {'versions': 1})
+    except Exception as e:
+        print(e)
+        return None
+    if document is None:
+        return []
+    return document.get('versions', [])
+
+
+def rebuild_source(versions: List[dict], version_name: str) -> str:
+    """Rebuild the source of a version from its keyframe and the deltas after it.
+
+    Parameters
+    ----------
+    versions : List[dict]
+        Every version of the code object.
+    version_name : str
+        Name of the version to rebuild.
+
+    Returns
+    -------
+    str
+        Source code of the version or None if a version in its chain is missing.
+    """
+    by_name = {ver['version_name']: ver for ver in versions}
+    deltas = []
+    ver = by_name.get(version_name)
+    while ver is not None and 'source' not in ver:
+        if 'delta' not in ver:
+            return None
+        deltas.append(ver['delta'])
+        ver = by_name.get(ver.get('base'))
+    if ver is None:
+        return None
+
+    source = ver['source']
+    for delta in reversed(deltas):
+        source = apply_delta(source, delta)
+    return source
+
+
+def encode_version(version: dict, previous: dict, previous_source: str, interval: int) -> dict:
+    """Store a version as a delta against the previous one where it pays off.
+
+    A full keyframe is stored if there is no previous version, if the chain
+    of deltas since the last keyframe would reach interval, or if the delta
+    is no smaller than the source.
     """
-    Updates the document for a specified code object. 
-    A named update results in a new version. An unnamed 
-    update results in an update to the selected version 
-    or the latest version by default.
+    version = filter_dict(version, lambda elem: elem[0] not in ['delta', 'base', 'depth'])
+    if previous is None or previous.get('depth', 0) + 1 >= interval:
+        return {**version, 'depth': 0}
+
+    delta = make_delta(previous_source, version['source'])
+    if len(str(delta)) >= len(version['source']):
+        return {**version, 'depth': 0}
+
+    encoded = filter_dict(version, lambda elem: elem[0] != 'source')
+    return {**encoded, 'base': previous['version_name'], 'delta': delta, 'depth': previous.get('depth', 0) + 1}
+
+
+def upsert_delta_version(db_name: str, collection: str, name: str, obj_type: str, version: dict,
+                         interval: int, layout: str = None, qualified_name: str = None):
+    """Stash a version of a code object as a delta against its predecessor.
+
+    Every interval versions a full keyframe is stored, so rebuilding any
+    version applies fewer than interval deltas. Versions stored as deltas of
+    a version that is changed in place become keyframes first, so they
+    still rebuild to the same source.
+
+    With the embedded layout a new version is pushed onto the document, and
+    a version changed in place and the keyframes made for it are updated
+    with arrayFilters, so the other versions are never written back. The
+    update only applies if the versions are still the ones it was worked out
+    from, otherwise they are read again, up to DELTA_ATTEMPTS times.
+
+    The latest version keeps its source even if it is stored as a delta, so
+    it is found by search_code and read without rebuilding it. The source of
+    the version before it is dropped once it is no longer the latest.
 
     Parameters
     ----------
-    col : str
-        [description]
-    incoming : dict
-        [description]
-    latest : dict
-        [description]
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the object collection.
+    name : str
+        Name of the code object.
+    obj_type : str
+        Either 'function' or 'class'.
+    version : dict
+        Version to stash, see schemas.version_instance.
+    interval : int
+        Number of versions between keyframes.
+    layout : str, optional
+        Layout of versions, see config.LAYOUTS.
+    qualified_name : str, optional
+        Dotted path of the code object, kept as is if not given.
 
     Returns
     -------
     dict
-        [description]
+        The stored version or None if the stash failed.
     """
-    name               = existing['name']
-    incoming_version   = incoming['versions'][-1]
-    incoming_docstring = incoming_version['docstring']
-    incoming_source    = incoming_version['source']
-
-    ver_names = [ver['version_name'] for ver in existing['versions']]
-    
-    if named not in ver_names:
-        insert_embedded_document(
-            db_name=db_name,
-            collection=col,
-            query={"name": name},
-            new_item={"versions": incoming_version}
+    version_name = version['version_name']
+    for _ in range(DELTA_ATTEMPTS):
+        versions = get_versions(db_name, collection, name, layout)
+        if versions is None:
+            return None
+
+        existing = next((ver for ver in versions if ver['version_name'] == version_name), None)
+        others = [ver for ver in versions if ver['version_name'] != version_name]
+        previous = others[-1] if others else None
+        previous_source = rebuild_source(versions, previous['version_name']) if previous else None
+
+        stored = encode_version(version, previous, previous_source, interval)
+        if existing is not None:
+            stored['created'] = existing['created']
+        latest = existing is None or versions[-1]['version_name'] == version_name
+        if latest:
+            stored['source'] = version['source']
+        # the version before a new one is no longer the latest
+        superseded = previous if existing is None and previous is not None and 'delta' in previous else None
+
+        keyframes = []
+        for ver in others:
+            if ver.get('base') == version_name:
+                source = rebuild_source(versions, ver['version_name'])
+                keyframe = filter_dict(ver, lambda elem: elem[0] not in ['delta', 'base'])
+                keyframes.append({**keyframe, 'source': source, 'depth': 0})
+
+        if (layout or STORAGE_LAYOUT) == 'split':
+            changed = [stored, *keyframes]
+            if superseded is not None:
+                changed.append(filter_dict(superseded, lambda elem: elem[0] != 'source'))
+            return replace_split_versions(db_name, collection, name, obj_type, changed, qualified_name)
+
+        # the update only applies to the versions read above
+        if existing is None and versions == []:
+            query = {'name': name, 'versions.0': {'$exists': False}}
+        elif existing is None:
+            query = {'name': name, 'versions': {'$size': len(versions)}}
+        else:
+            query = {'name': name, 'versions': {
+                '$size': len(versions),
+                '$elemMatch': {'version_name': version_name, 'hash': existing.get('hash')}
+            }}
+
+        changes = {'type': obj_type}
+        if qualified_name is not None or versions == []:
+            changes['qualified_name'] = qualified_name or name
+        array_filters = []
+        unset = {}
+        if existing is None:
+            update = {'$push': {'versions': stored}}
+        else:
+            changes['versions.$[stored]'] = stored
+            array_filters.append({'stored.version_name': version_name})
+            update = {}
+        for i, keyframe in enumerate(keyframes):
+            changes[f"versions.$[keyframe{i}].source"] = keyframe['source']
+            changes[f"versions.$[keyframe{i}].depth"] = 0
+            unset.update({f"versions.$[keyframe{i}].delta": '', f"versions.$[keyframe{i}].base": ''})
+            array_filters.append({f"keyframe{i}.version_name": keyframe['version_name']})
+        update['$set'] = changes
+        if unset:
+            update['$unset'] = unset
+
+        try:
+            col = get_collection(db_name, collection)
+            result = col.update_one(query, update, upsert=versions == [], array_filters=array_filters or None)
+            if superseded is not None and result.matched_count:
+                # dropping the source of a delta is safe whatever was stashed since
+                col.update_one(
+                    {'name': name},
+                    {'$unset': {'versions.$[superseded].source': ''}},
+                    array_filters=[{'superseded.version_name': superseded['version_name'],
+                                    'superseded.delta': {'$exists': True}}])
+        except DuplicateKeyError:
+            continue
+        except Exception as e:
+            print(e)
+            return None
+        if result.matched_count or result.upserted_id is not None:
+            return stored
+
+    print(error(get_current_func_name(), ERROR.write_conflict, name))
+    return None
+
+
+def replace_split_versions(db_name: str, collection: str, name: str, obj_type: str,
+                           versions: List[dict], qualified_name: str = None):
+    """Write whole version documents of a code object stored with the split layout."""
+    if qualified_name is None:
+        update = {'$setOnInsert': {'name': name, 'type': obj_type, 'qualified_name': name}}
+    else:
+        update = {'$setOnInsert': {'name': name, 'type': obj_type}, '$set': {'qualified_name': qualified_name}}
+
+    try:
+        col = get_collection(db_name, collection)
+        obj = col.find_one_and_update(
+            {'name': name},
+            update,
+            projection={'_id': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
         )
-        return
-    
-    for version in existing['versions']:
-        version_name         = version['version_name']
-        existing_docstring   = version['docstring']
-        existing_source      = version['source']
-        if incoming_docstring != existing_docstring:
-            update_item(
-                db_name,
-                col,
-                {
-                    "name": name,
-                    "versions.version_name": named
-                },
-                {"versions.$.docstring": incoming_docstring}
-            )
-        if incoming_source != existing_source:
-            update_item(
-                db_name,
-                col,
-                {
-                    "name": name,
-                    "versions.version_name": named
-                },
-                {"versions.$.source": incoming_source}
+        col = get_collection(db_name, get_versions_collection(collection))
+        for ver in versions:
+            ver = filter_dict(ver, lambda elem: elem[0] != '_id')
+            col.replace_one(
+                {'object_id': obj['_id'], 'version_name': ver['version_name']},
+                {**ver, 'object_id': obj['_id'], 'name': name},
+                upsert=True
             )
+    except Exception as e:
+        print(e)
+        return None
+    else:
+        return versions[0]
+
 
+def get_version_field(db: str, field: str, citizen: str, name: str, version: str, layout: str = None):
+    """Fetch one field of one version of a code object.
+
+    Only the requested version is sent by the server, whatever the layout,
+    unless its source is stored as a delta and has to be rebuilt from the
+    versions before it.
+    """
+    collection = COLLECTIONS[citizen]
+    ver = None
 
-def get_version_field(db: str, field: str, citizen: str, name: str, version: str):
-    document = get_item(
-        db,
-        COLLECTIONS[citizen], 
-        {"name": name}, 
-        **{'name': 1, 'type': 1, 'versions': 1}
+    if (layout or STORAGE_LAYOUT) == 'split':
+        ver = get_item(
+            db,
+            get_versions_collection(collection),
+            {"name": name, "version_name": version},
+            **{field: 1, 'delta': 1}
         )
-    for ver in document['versions']:
-        if ver['version_name'] == version:
-            result = ver[field]
-            return result
+    else:
+        document = get_item(
+            db,
+            collection,
+            {"name": name},
+            **{'versions': {'$elemMatch': {'version_name': version}}}
+            )
+        if document is not None:
+            ver = next(iter(document.get('versions', [])), None)
+
+    if ver is None:
+        return None
+    if field == 'source' and 'source' not in ver and 'delta' in ver:
+        versions = get_versions(db, collection, name, layout)
+        return rebuild_source(versions or [], version)
+    return ver.get(field)
+
 
+def get_versions_of(db_name: str, collection: str, names: List[str], version: str,
+                    layout: str = None, fallback: bool = False) -> dict:
+    """Fetch one version of several code objects in a single query.
 
+    Sources stored as deltas are rebuilt from the versions before them.
 
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the object collection.
+    names : List[str]
+        Names of the code objects.
+    version : str
+        Name of the version.
+    layout : str, optional
+        Layout of versions, see config.LAYOUTS.
+    fallback : bool, optional
+        Use the latest version of code objects that have none named version.
+
+    Returns
+    -------
+    dict
+        Version keyed by the name of each code object that has it, or None
+        if the query failed.
+    """
+    try:
+        if (layout or STORAGE_LAYOUT) == 'split':
+            col = get_collection(db_name, get_versions_collection(collection))
+            query = {'name': {'$in': names}}
+            if not fallback:
+                query['version_name'] = version
+            found = {}
+            for ver in col.find(query).sort([('created', ASCENDING), ('_id', ASCENDING)]):
+                if found.get(ver['name'], {}).get('version_name') != version:
+                    found[ver['name']] = ver
+        elif fallback:
+            col = get_collection(db_name, collection)
+            named = {'$filter': {
+                'input': '$versions',
+                'as': 'v',
+                'cond': {'$eq': ['$$v.version_name', {'$literal': version}]}
+            }}
+            documents = col.aggregate([
+                {'$match': {'name': {'$in': names}}},
+                {'$project': {'name': 1, 'version': {'$ifNull': [
+                    {'$arrayElemAt': [named, 0]},
+                    {'$arrayElemAt': ['$versions', -1]}
+                ]}}}
+            ])
+            found = {doc['name']: doc['version'] for doc in documents if doc.get('version')}
+        else:
+            col = get_collection(db_name, collection)
+            documents = col.find(
+                {'name': {'$in': names}, 'versions.version_name': version},
+                {'name': 1, 'versions': {'$elemMatch': {'version_name': version}}})
+            found = {doc['name']: doc['versions'][0] for doc in documents if doc.get('versions')}
+    except Exception as e:
+        print(e)
+        return None
+
+    for name, ver in found.items():
+        if 'source' not in ver and 'delta' in ver:
+            versions = get_versions(db_name, collection, name, layout) or []
+            ver['source'] = rebuild_source(versions, ver['version_name'])
+    return found
+
+
+def get_named_versions(db_name: str, collection: str, name: str, version_names: List[str],
+                       fields: List[str], layout: str = None) -> dict:
+    """Fetch some fields of a few versions of a code object.
+
+    The versions are picked out on the server with a $filter, and only the
+    fields asked for are sent. A line count missing from versions stashed
+    before it was recorded is worked out on the server as well.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the object collection.
+    name : str
+        Name of the code object.
+    version_names : List[str]
+        Names of the versions.
+    fields : List[str]
+        Fields of each version to fetch, see schemas.version_instance.
+    layout : str, optional
+        Layout of versions, see config.LAYOUTS.
 
+    Returns
+    -------
+    dict
+        Fields keyed by version name for each version found, or None if
+        the query failed.
+    """
+    # a source stored as a delta is rebuilt from the versions before it
+    projected = list(OrderedDict.fromkeys(['version_name', *fields, *(['delta'] if 'source' in fields else [])]))
+    lines = {'$cond': [
+        {'$eq': [{'$type': '$$v.source'}, 'string']},
+        {'$size': {'$split': ['$$v.source', '\n']}},
+        None
+    ]}
+    expressions = {
+        field: {'$ifNull': ['$$v.lines', lines]} if field == 'lines' else f"$$v.{field}"
+        for field in projected
+    }
+
+    try:
+        if (layout or STORAGE_LAYOUT) == 'split':
+            col = get_collection(db_name, get_versions_collection(collection))
+            versions = col.aggregate([
+                {'$match': {'name': name, 'version_name': {'$in': version_names}}},
+                {'$replaceRoot': {'newRoot': {'$let': {'vars': {'v': '$$ROOT'}, 'in': expressions}}}}
+            ])
+        else:
+            col = get_collection(db_name, collection)
+            documents = col.aggregate([
+                {'$match': {'name': name}},
+                {'$project': {'_id': 0, 'versions': {'$map': {
+                    'input': {'$filter': {
+                        'input': '$versions',
+                        'as': 'v',
+                        'cond': {'$in': ['$$v.version_name', {'$literal': version_names}]}
+                    }},
+                    'as': 'v',
+                    'in': expressions
+                }}}}
+            ])
+            versions = [ver for doc in documents for ver in doc.get('versions') or []]
+        found = {ver['version_name']: ver for ver in versions}
+    except Exception as e:
+        print(e)
+        return None
+
+    for version_name, ver in found.items():
+        if 'source' in fields and ver.get('source') is None and ver.get('delta') is not None:
+            ver['source'] = rebuild_source(get_versions(db_name, collection, name, layout) or [], version_name)
+        ver.pop('delta', None)
+    return found
+
+
+def get_closure(db_name: str, names: List[str], version: str, layout: str = None) -> OrderedDict:
+    """Fetch code objects together with everything they depend on.
+
+    The dependency graph is walked a level at a time. Each level is one
+    query per collection on the indexed name field, for every code object
+    the level reached, since $graphLookup can only follow references within
+    one collection and a function may depend on a class. Dependencies use
+    their version named version, or else their latest one.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    names : List[str]
+        Names of the code objects, looked up as functions and classes.
+    version : str
+        Name of the version of the code objects.
+    layout : str, optional
+        Layout of versions, see config.LAYOUTS.
+
+    Returns
+    -------
+    OrderedDict
+        Version keyed by (name, citizen), the requested code objects first,
+        or None if a query failed.
+    """
+    closure = OrderedDict()
+    seen = set()
+    level = list(OrderedDict.fromkeys(names))
+    depth = 0
+    while level:
+        seen.update(level)
+        reached = []
+        for citizen, collection in COLLECTIONS.items():
+            found = get_versions_of(db_name, collection, level, version, layout, fallback=depth > 0)
+            if found is None:
+                return None
+            for name in level:
+                if name in found and (name, citizen) not in closure:
+                    closure[(name, citizen)] = found[name]
+                    reached += found[name].get('dependencies') or []
+        level = [name for name in OrderedDict.fromkeys(reached) if name not in seen]
+        depth += 1
+    return closure
+
+
+def search_code(db_name: str, collection: str, terms: str, limit: int, skip: int = 0, layout: str = None) -> List[dict]:
+    """Rank the code objects of a collection by how well they match search terms.
+
+    Uses the collection's text index. Only the name, version name, score and
+    a snippet of each match are sent by the server, never whole documents.
+    With the split layout each code object is listed once, with the version
+    that matched best. Sources of versions stored as deltas are not indexed,
+    only those of keyframes and of the latest version are, and a snippet of
+    a delta is rebuilt here.
+
+    Parameters
+    ----------
+    db_name : str
+        Name of the database.
+    collection : str
+        Name of the object collection.
+    terms : str
+        Words to search for in names, docstrings and sources.
+    limit : int
+        Maximum number of matches.
+    skip : int, optional
+        Number of best matches to leave out.
+    layout : str, optional
+        Layout of versions, see config.LAYOUTS.
+
+    Returns
+    -------
+    List[dict]
+        Matches ordered by descending score, or None if the search failed.
+    """
+    objects = collection
+    if (layout or STORAGE_LAYOUT) == 'split':
+        collection = get_versions_collection(collection)
+        grouping = [
+            {'$sort': {'score': -1, 'created': -1}},
+            {'$group': {'_id': '$name', 'name': {'$first': '$name'}, 'score': {'$first': '$score'},
+                        'version': {'$first': '$$ROOT'}}}
+        ]
+        version = 1
+    else:
+        grouping = []
+        version = {'$arrayElemAt': ['$versions', -1]}
+
+    text = {'$cond': [
+        {'$gt': [{'$strLenCP': {'$ifNull': ['$version.docstring', '']}}, 0]},
+        '$version.docstring',
+        {'$ifNull': ['$version.source', '']}
+    ]}
+    pipeline = [
+        {'$match': {'$text': {'$search': terms}}},
+        {'$set': {'score': {'$meta': 'textScore'}}},
+        *grouping,
+        {'$sort': {'score': -1, 'name': 1}},
+        {'$skip': skip},
+        {'$limit': limit},
+        {'$project': {
+            '_id': 0,
+            'name': 1,
+            'score': 1,
+            'version': version
+        }},
+        {'$project': {
+            'name': 1,
+            'score': 1,
+            'version_name': '$version.version_name',
+            'snippet': {'$substrCP': [text, 0, SNIPPET_LENGTH]},
+            'delta': {'$cond': [{'$eq': [{'$type': '$version.source'}, 'missing']}, '$version.delta', '$$REMOVE']}
+        }}
+    ]
+
+    try:
+        col = get_collection(db_name, collection)
+        matches = list(col.aggregate(pipeline))
+    except Exception as e:
+        print(e)
+        return None
 
+    for match in matches:
+        if match.pop('delta', None) is not None and match['snippet'] == '':
+            versions = get_versions(db_name, objects, match['name'], layout) or []
+            match['snippet'] = (rebuild_source(versions, match['version_name']) or '')[:SNIPPET_LENGTH]
+    return matches
@@ -1,5 +1,6 @@
 document = {
     'name': '',
+    'qualified_name': '',
     'type': '',
     'versions': []
 }
@@ -8,5 +9,11 @@ version_instance = {
     'created': '',
     'version_name':'',
     'docstring':'',
-    'source': ''
+    'source': '',
+    'hash': '',
+    'lines': 0,
+    'imports': [],
+    'free_names': [],
+    'dependencies': [],
+    'fingerprint': ''
 }
@@ -0,0 +1,197 @@
+"""Squirrel Server
+
+This module contains the lookup server for the Squirrel program. The server
+keeps symbol indexes, imported modules and the terminal formatter in memory
+and answers scope and stash requests forwarded by the command line over a
+Unix socket.
+
+Examples
+    squirrel serve
+    squirrel scope FUNCTION
+"""
+import os
+import json
+import stat
+import signal
+import socket
+import struct
+import threading
+import socketserver
+from pathlib import Path
+from typing import Callable
+
+from squirrel.config import *
+from squirrel.helpers import error, get_current_func_name
+from squirrel.index import loaded_indexes, get_changed_files, apply_changed_files
+
+
+class SquirrelRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'status': 2, 'stdout': '', 'stderr': f"{e}\n"}
+        else:
+            with self.server.lock:
+                response = self.server.handler(request)
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class SquirrelServer(socketserver.UnixStreamServer):
+    def __init__(self, path: Path, handler: Callable[[dict], dict]):
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        super().__init__(str(path), SquirrelRequestHandler)
+
+    def server_bind(self):
+        # created private, so no other user can connect before a chmod
+        umask = os.umask(0o077)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+
+def watch_indexes(server: SquirrelServer, interval: float):
+    """Poll the files of every loaded index and reindex those that changed.
+
+    Runs until the server is stopped, so lookups find indexes already fresh.
+    Files are checked without holding the server lock, which is only taken
+    to swap in the new entries, and the tree is never walked.
+    """
+    while not server.stopped.wait(interval):
+        for directory, idx in list(loaded_indexes.items()):
+            changes = get_changed_files(directory, idx)
+            if changes:
+                with server.lock:
+                    apply_changed_files(directory, idx, changes)
+
+
+def make_private_directory(p: Path) -> bool:
+    """Create a directory only this user can use, or check that it is one."""
+    p = Path(p)
+    try:
+        p.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = os.lstat(p)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def is_own_socket(path: Path) -> bool:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def get_peer_uid(sock: socket.socket) -> int:
+    """User id of the process at the other end of a Unix socket, or None where it cannot be told."""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def is_server_running(path: Path = SOCKET_PATH) -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(path))
+    except OSError:
+        return False
+    return True
+
+
+def serve(handler: Callable[[dict], dict], path: Path = SOCKET_PATH, interval: float = WATCH_INTERVAL):
+    """Answer forwarded requests on a Unix socket until interrupted.
+
+    Parameters
+    ----------
+    handler : Callable[[dict], dict]
+        Runs one request and returns its exit status and captured output.
+    path : Path
+        Pathname of the socket.
+    interval : float
+        Seconds between polls of the indexed files.
+    """
+    path = Path(path)
+    if not make_private_directory(path.parent):
+        print(error(get_current_func_name(), ERROR.socket_directory, path.parent))
+        return
+    if path.exists():
+        if is_server_running(path):
+            print(f"{ERROR.server_running} {path}")
+            return
+        path.unlink()
+
+    server = SquirrelServer(path, handler)
+    watcher = threading.Thread(target=watch_indexes, args=(server, interval), daemon=True)
+    watcher.start()
+    signal.signal(signal.SIGTERM, interrupt)
+    print(f"squirrel listening at {path}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopped.set()
+        server.server_close()
+        if path.exists():
+            path.unlink()
+
+
+def forward(options: dict, path: Path = SOCKET_PATH) -> dict:
+    """Send parsed command line options to a running server.
+
+    Nothing is sent unless both the socket and the process listening on it
+    belong to this user.
+
+    Parameters
+    ----------
+    options : dict
+        Arguments passed at the command line.
+    path : Path
+        Pathname of the socket.
+
+    Returns
+    -------
+    dict
+        Exit status and captured output, or None if no server is listening.
+    """
+    if not Path(path).exists():
+        return None
+    if not is_own_socket(path):
+        print(error(get_current_func_name(), ERROR.untrusted_socket, path))
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+        peer = get_peer_uid(sock)
+    except OSError:
+        sock.close()
+        return None
+    if peer not in [None, os.getuid()]:
+        sock.close()
+        print(error(get_current_func_name(), ERROR.untrusted_socket, path))
+        return None
+
+    request = {'options': options, 'cwd': os.getcwd()}
+    try:
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as reader:
+            return json.loads(reader.readline())
+    except (OSError, ValueError) as e:
+        return {'status': 1, 'stdout': '', 'stderr': f"{e}\n"}
+    finally:
+        sock.close()
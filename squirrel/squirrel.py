@@ -14,22 +14,40 @@ Examples
     squirrel stash FUNCTION
     squirrel stash FUNCTION -v VERSION-NAME
     squirrel stash FUNCTION -v NEW-VERSION-NAME
+    squirrel stash FUNCTION -s sqlite:///library.db
+    squirrel plant module.py FUNCTION CLASS -v VERSION-NAME
+    squirrel plant module.py FUNCTION --with-deps
+    squirrel diff FUNCTION VERSION-NAME OTHER-VERSION-NAME --stat
+    squirrel find TERMS --page 2
+    squirrel export library.ndjson.gz
+    squirrel import library.ndjson.gz --batch-size 500
+    squirrel serve
+    squirrel db ensure-indexes
+    squirrel db flush
 """
+import io
 import os
 import sys
 import ast
 import json
+import difflib
 import argparse
+from copy import deepcopy
 from pprint import pprint
+from contextlib import redirect_stdout, redirect_stderr
 from datetime import datetime
 from pathlib import Path, PurePath
-from pymongo import MongoClient
 from squirrel.config import *
 from squirrel.helpers import *
-from squirrel.queries import *
 from squirrel.schemas import *
+from squirrel.index import find_symbol_in_file, find_symbols_in_index
+from squirrel.plant import plant
+from squirrel.server import serve, forward
 from squirrel.fragments import squirrely
 
+# squirrel.storage and squirrel.journal pull in pymongo and bson, so they are
+# imported by the code paths that use a library, not by every command
+
 
 class Squirrel():
     def __init__(self, parser, options: dict):    
@@ -51,20 +69,35 @@ class Squirrel():
         self.directory = self.options['directory']
         self.database = self.options['database']
         self.version = self.options['version']
+        self.layout = self.options.get('layout') or STORAGE_LAYOUT
+        self.keyframe_interval = KEYFRAME_INTERVAL
+        self.use_index = True
+        self.jobs = get_default_jobs()
+        self.all_matches = bool(self.options.get('all_matches'))
         self.functions = []
         self.classes = []
         self.payloads = []
+        self.documents = []
+        self.modules = {}
+        self.batch_size = BATCH_SIZE
 
         self.validate_command()
         self.set_directory()
         self.set_database()
         self.set_version()
+        self.set_index()
+        self.set_jobs()
+        self.set_keyframe_interval()
+        self.set_batch_size()
         self.parse_and_clean_arguments()
         self.make_payloads('function')
         self.make_payloads('class')
 
-        for payload in self.payloads:
-            self.evaluate_payload(payload)
+        # documents built before a failing payload are still stashed
+        try:
+            self.evaluate_payloads(self.payloads)
+        finally:
+            self.save_documents()
             
     def __str__(self):
         return (
@@ -91,12 +124,34 @@ class Squirrel():
     
     def set_database(self):
         if self.options['database'] is None:
-            self.database = DB_NAME
+            self.database = DATABASE
     
     def set_version(self):
         if self.options['version'] is None:
             self.version = 'default'
+
+    def set_index(self):
+        if self.options.get('no_index'):
+            self.use_index = False
+
+    def set_jobs(self):
+        if self.options.get('jobs') is not None:
+            if self.options['jobs'] < 1:
+                self.parser.error(ERROR.bad_jobs)
+            self.jobs = self.options['jobs']
     
+    def set_keyframe_interval(self):
+        if self.options.get('keyframe_interval') is not None:
+            if self.options['keyframe_interval'] < 0:
+                self.parser.error(ERROR.bad_keyframe_interval)
+            self.keyframe_interval = self.options['keyframe_interval']
+
+    def set_batch_size(self):
+        if self.options.get('batch_size') is not None:
+            if self.options['batch_size'] < 1:
+                self.parser.error(ERROR.bad_batch_size)
+            self.batch_size = self.options['batch_size']
+
     def parse_and_clean_arguments(self):
         cmds = self.options['commands']
         cla = self.options['classes']
@@ -160,50 +215,124 @@ class Squirrel():
         if payload['package'] is not None and payload['module'] is not None:
             message(get_current_func_name(), "package.module.function specified!")
             try:
-                source_segment = citizens[payload['type']](
-                    PurePath(payload['directory'], payload['package'], modulify(payload['module'])), payload[payload['type']])
+                p = Path(PurePath(payload['directory'], payload['package'], modulify(payload['module'])))
+                source_segment = citizens[payload['type']](p, payload[payload['type']])
             except Exception as e:
                 self.parser.error(error(get_current_func_name(), f"{type(e)} {e}"))
             else:
-                self.run_command(source_segment, payload)
+                self.run_command(source_segment, payload, p)
 
         if payload['package'] is None and payload['module'] is not None:
             message(get_current_func_name(),"module.function specified!")
             try:
                 m = self.search_packages_for_module(payload['directory'], payload['module'])
-                source_segment = citizens[payload['type']](PurePath(payload['directory'], m), payload[payload['type']])
+                p = Path(PurePath(payload['directory'], m))
+                source_segment = citizens[payload['type']](p, payload[payload['type']])
             except Exception as e:
                 self.parser.error(error(get_current_func_name(), f"{type(e)} {e}"))
             else:
-                self.run_command(source_segment, payload)
+                self.run_command(source_segment, payload, p)
 
         if payload['package'] is None and payload['module'] is None:
             message(get_current_func_name(), "function specified!") 
-            init_p = get_py_files(payload['directory'])
-            init_d = get_valid_directories(payload['directory'])
-            py_files = seek_py_files(init_p, init_d)
+            found = self.resolve_names([payload])
+            self.run_results(found[self.get_target(payload)], payload)
+
+    def evaluate_payloads(self, payloads: List[OrderedDict]):
+        """Evaluate payloads, resolving all bare names in one pass over the tree."""
+        payloads = [self.qualify_payload(p) for p in payloads]
+        bare = [p for p in payloads if p['package'] is None and p['module'] is None]
+        found = self.resolve_names(bare)
+
+        for payload in payloads:
+            if payload['package'] is None and payload['module'] is None:
+                self.run_results(found[self.get_target(payload)], payload)
+            else:
+                self.evaluate_payload(payload)
+
+    def qualify_payload(self, payload: OrderedDict) -> OrderedDict:
+        """Read dotted arguments whose module does not exist as qualified names.
+
+        'module.Class.method' is parsed as package.module.function. If there
+        is no such module the parts are shifted so that Class.method is
+        looked up in module, and likewise 'Class.method' becomes a bare
+        qualified name.
+        """
+        obj = payload['type']
+        dr = payload['directory']
+
+        if payload['package'] is not None and payload['module'] is not None:
+            if Path(PurePath(dr, payload['package'], modulify(payload['module']))).is_file():
+                return payload
+            payload = {**payload, 'package': None, 'module': payload['package'],
+                       obj: f"{payload['module']}.{payload[obj]}"}
+
+        if payload['package'] is None and payload['module'] is not None:
+            if any(Path(PurePath(pkg, modulify(payload['module']))).is_file() for pkg in self.search_packages(dr)):
+                return payload
+            payload = {**payload, 'module': None, obj: f"{payload['module']}.{payload[obj]}"}
 
-            result = None
+        return payload
 
+    def get_target(self, payload: OrderedDict) -> tuple:
+        return (payload[payload['type']], payload['type'])
+
+    def resolve_names(self, payloads: List[OrderedDict]) -> dict:
+        """Find the source of bare-name payloads, reading each file at most once.
+
+        Parameters
+        ----------
+        payloads : List[OrderedDict]
+            Payloads without package or module.
+
+        Returns
+        -------
+        dict
+            List of (path, source) pairs keyed by (name, citizen).
+        """
+        found = {self.get_target(p): [] for p in payloads}
+        directories = OrderedDict()
+        for payload in payloads:
+            directories.setdefault(payload['directory'], []).append(self.get_target(payload))
+
+        for directory, targets in directories.items():
+            targets = list(OrderedDict.fromkeys(targets))
             try:
-                for fd in py_files:
-                    code = citizens[payload['type']](fd, payload[payload['type']])
-                    if code is not None:
+                if self.use_index:
+                    found.update(find_symbols_in_index(
+                        directory, targets, self.jobs, self.all_matches))
+                    continue
+
+                remaining = set(targets)
+                py_files = walk_py_files(directory)
+                for fd, codes in parallel_imap(find_many_in_file, py_files, self.jobs, tuple(targets)):
+                    for target, hit in codes.items():
+                        if target not in remaining and not self.all_matches:
+                            continue
                         message(get_current_func_name(),f"found segment at {str(fd)}!")
-                        result = code
+                        found[target].append(hit)
+                        remaining.discard(target)
+                    if not remaining and not self.all_matches:
+                        break
             except Exception as e:
-                self.parser.error(error(get_current_func_name(), f"{type(e)} {e}", payload[payload['type']]))
-            else:
-                self.run_command(result, payload)
+                self.parser.error(error(get_current_func_name(), f"{type(e)} {e}", ', '.join(t[0] for t in targets)))
+
+        return found
+
+    def run_results(self, results: List[Tuple[Path, str]], payload: OrderedDict):
+        if results == []:
+            self.run_command(None, payload)
+        for p, code in results:
+            self.run_command(code, payload, p)
 
-    def run_command(self, source: str, payload: OrderedDict):
+    def run_command(self, source: str, payload: OrderedDict, p: Path = None):
         label = f"{self.command}ing {payload['type']}: {payload[payload['type']]}"
         if source is not None:
             self.result = source
             if self.command == 'scope':
                 display_code(source, label)
             if self.command == 'stash':
-                self.change_database(source, payload)
+                self.change_database(source, payload, p)
             return source
         print(f"{payload['type']} {payload[payload['type']]} not found!")
         return False
@@ -215,8 +344,9 @@ class Squirrel():
         ----------
         p : Path
             Python file to search.
-        class_name : str
-            Name of function definition.
+        func_name : str
+            Name of function definition, qualified for methods and nested
+            functions, e.g. 'Class.method'.
 
         Returns
         -------
@@ -224,8 +354,11 @@ class Squirrel():
             Source code for function definition.
         """
         try:
-            module = return_file_content_as_string(p)
-            code_segment = get_code_segment_from_file_contents(module, func_name)
+            if self.use_index and Path(p).is_file():
+                code_segment = find_symbol_in_file(self.directory, p, func_name)
+            else:
+                contents, module = self.parse_module(p)
+                code_segment = get_code_segment_from_file_contents(contents, func_name, module=module)
         except Exception as e:
             parser.error(message(get_current_func_name(), e, func_name))
         else:
@@ -239,7 +372,7 @@ class Squirrel():
         p : Path
             Python file to search.
         class_name : str
-            Name of class definition.
+            Name of class definition, qualified for nested classes.
 
         Returns
         -------
@@ -247,9 +380,12 @@ class Squirrel():
             Source code for class definition.
         """
         try:
-            source_code = return_file_content_as_string(p)
-            code = get_code_segment_from_file_contents(
-                source_code, class_name, citizen='class')
+            if self.use_index and Path(p).is_file():
+                code = find_symbol_in_file(self.directory, p, class_name, 'class')
+            else:
+                contents, module = self.parse_module(p)
+                code = get_code_segment_from_file_contents(
+                    contents, class_name, citizen='class', module=module)
         except Exception as e:
             self.parser.error(error(get_current_func_name(), f"{type(e)} {e}", class_name))
         else:
@@ -351,70 +487,109 @@ class Squirrel():
                 self.parser.error(error(
                     get_current_func_name(), 'package not found', pkg))
 
-    def change_database(self, source, payload):
-        document = self.build_document(source, payload)
-        target_collection = COLLECTIONS[document['type']]
-        
-        if not has_database(self.database):
-            create_database(self.database, target_collection)
-            it = insert_item(self.database, target_collection, document)
+    def change_database(self, source, payload, p=None):
+        self.documents.append(self.build_document(source, payload, p))
+
+    def save_documents(self):
+        """Stash the documents built during this run together.
+
+        If the server cannot be reached, or writing to it fails, the stashes
+        are kept in the local journal instead, to be replayed by 'squirrel
+        db flush' or by the next stash that reaches it.
+        """
+        if self.documents == []:
             return
-        
-        obj = {'name': document['name']}
-        
-        if has_database(self.database):
-            item = get_item(
-                self.database,
-                target_collection,
-                obj,
-                **{'name': 1, 'type': 1, 'versions': 1}
-            )
-
-            if item is not None:
-                exists = True
-            if item is None:
-                exists = False
-
-            if not exists:
-                insert_item(self.database, target_collection, document)
-                return
-            
-            if exists:
-                item = get_item(
-                    self.database, 
-                    target_collection,
-                    obj, 
-                    **{'name': 1, 'type': 1,'versions':1}
-                )
-                handle_code_change(
-                    db_name=self.database,
-                    col=target_collection,
-                    incoming=document,
-                    existing=item,
-                    named=self.version
-                )
-                return            
-
-    def build_document(self, source: str, payload: OrderedDict):     
+        entries = [
+            {
+                'collection': COLLECTIONS[doc['type']],
+                'name': doc['name'],
+                'type': doc['type'],
+                'version': doc['versions'][-1],
+                'qualified_name': self.get_qualified_name(doc)
+            }
+            for doc in self.documents
+        ]
+        self.documents = []
+        from squirrel.storage import open_storage
+        from squirrel.journal import journal_entries, has_journal, replay_journal
+        storage = open_storage(self.database, self.layout, self.keyframe_interval)
+        if storage is None:
+            sys.exit(1)
+
+        if not storage.is_available():
+            journal_entries(self.database, self.layout, self.keyframe_interval, entries)
+            print(message(get_current_func_name(),
+                          f"{self.database} is unreachable, {len(entries)} stashed to journal {JOURNAL_PATH}"))
+            return
+
+        if has_journal():
+            replayed, remaining = replay_journal(self.batch_size)
+            print(message(get_current_func_name(), f"{replayed} journaled stashes replayed, {remaining} left"))
+        if storage.stash(entries, self.batch_size) is None:
+            journal_entries(self.database, self.layout, self.keyframe_interval, entries)
+            print(message(get_current_func_name(),
+                          f"writing to {self.database} failed, {len(entries)} stashed to journal {JOURNAL_PATH}"))
+
+    def get_qualified_name(self, document: dict) -> str:
+        """Qualified name to store, or None to keep the stored one.
+
+        A bare name says nothing about where the code object lives, so it
+        does not replace a path stashed earlier.
+        """
+        if document['qualified_name'] == document['name']:
+            return None
+        return document['qualified_name']
+
+    def parse_module(self, p: Path) -> Tuple[str, ast.Module]:
+        """Read and parse a module once per run.
+
+        The module is None if the file is not valid Python.
+        """
+        key = Path(p).resolve()
+        if key not in self.modules:
+            contents = return_file_content_as_string(p)
+            try:
+                module = ast.parse(contents)
+            except (SyntaxError, ValueError):
+                module = None
+            self.modules[key] = (contents, module)
+        return self.modules[key]
+
+    def get_dependencies(self, source: str, p: Path = None) -> dict:
+        """Free names, imports and sibling dependencies of a code object.
+
+        p is the file the code object was found in. If it is not known
+        only the free names are recorded.
+        """
+        if p is None or not Path(p).is_file():
+            return get_dependencies(None, source)
+        contents, module = self.parse_module(p)
+        return get_dependencies(contents, source, module)
+
+    def build_document(self, source: str, payload: OrderedDict, p: Path = None):     
         obj_type = payload['type']
-        doc = document
-        ver = version_instance
+        doc = deepcopy(document)
+        ver = deepcopy(version_instance)
 
         doc['name'] = payload[obj_type]
+        doc['qualified_name'] = '.'.join(
+            part for part in [payload['package'], payload['module'], payload[obj_type]] if part)
         doc['type'] = obj_type
         
         ver['created'] = datetime.today().replace(microsecond=0)
         ver['version_name'] = self.version
         ver['docstring'] = get_docstring(source, payload[obj_type], obj_type)
         ver['source'] = source
+        ver['hash'] = hash_source(source)
+        ver['lines'] = len(source.splitlines())
+        ver.update(self.get_dependencies(source, p))
         
         doc['versions'] += [ver]
 
         return doc
 
 
-def main():
-    global parser
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog='squirrel',
         fromfile_prefix_chars='@',
@@ -461,7 +636,7 @@ def main():
                         action='store',
                         type=str,
                         required=False,
-                        help='specify a database')
+                        help="specify a database name or a 'sqlite:///path' file")
     
     parser.add_argument('-v', '--version',
                         action='store',
@@ -469,14 +644,362 @@ def main():
                         required=False,
                         help='specify code object version name')
 
+    parser.add_argument('--layout',
+                        action='store',
+                        choices=LAYOUTS,
+                        required=False,
+                        help='how versions are stored (default: embedded)')
+
+    parser.add_argument('--keyframe-interval',
+                        action='store',
+                        type=int,
+                        required=False,
+                        help='store versions as deltas with a full copy every N versions (default: 0, off)')
+
+    parser.add_argument('--page',
+                        action='store',
+                        type=int,
+                        required=False,
+                        help='page of search results to show (default: 1)')
+
+    parser.add_argument('--limit',
+                        action='store',
+                        type=int,
+                        required=False,
+                        help='number of search results per page (default: 10)')
+
+    parser.add_argument('--gzip',
+                        action='store_true',
+                        required=False,
+                        help='gzip an export or import file whatever its name')
+
+    parser.add_argument('--batch-size',
+                        action='store',
+                        type=int,
+                        required=False,
+                        help='documents per round trip for stash, export and import (default: 1000)')
+
+    parser.add_argument('--stat',
+                        action='store_true',
+                        required=False,
+                        help='compare line counts and hashes of versions instead of their sources')
+
+    parser.add_argument('--with-deps',
+                        action='store_true',
+                        required=False,
+                        help='plant the code objects a code object depends on as well')
+
+    parser.add_argument('--no-index',
+                        action='store_true',
+                        required=False,
+                        help='search the tree without the symbol index')
+
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        required=False,
+                        help='number of processes used to parse files (default: cpu count)')
+
+    parser.add_argument('--all-matches',
+                        action='store_true',
+                        required=False,
+                        help='use every match in the tree instead of stopping at the first')
+
+    parser.add_argument('--no-daemon',
+                        action='store_true',
+                        required=False,
+                        help='run here even if a squirrel server is listening')
+
     parser.add_argument('commands',
                            nargs='+',
                            help="squirrel stash -f function")
 
+    return parser
+
+
+def run_request(request: dict) -> dict:
+    """Run options forwarded to the server and capture what they print.
+
+    Parameters
+    ----------
+    request : dict
+        Parsed command line options and the client's working directory.
+
+    Returns
+    -------
+    dict
+        Exit status, stdout and stderr of the run.
+    """
+    global parser
+    parser = build_parser()
+    out = io.StringIO()
+    err = io.StringIO()
+    status = 0
+
+    options = request['options']
+    options['directory'] = str(PurePath(request['cwd'], options['directory'] or ''))
+    from squirrel.storage import resolve_database
+    options['database'] = resolve_database(options['database'], request['cwd'])
+
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            Squirrel(parser, options)
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(error(get_current_func_name(), f"{type(e)} {e}"), file=sys.stderr)
+            status = 1
+
+    return {'status': status, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+
+def run_db_command(parser: argparse.ArgumentParser, options: dict):
+    """Run a database maintenance command, e.g. 'squirrel db ensure-indexes'."""
+    db_commands = [
+        'ensure-indexes',
+        'flush'
+    ]
+
+    cmds = options['commands']
+    if len(cmds) < 2 or cmds[1] not in db_commands:
+        parser.error(f"{ERROR.bad_db_command} try {', '.join(db_commands)}")
+    database = options['database'] or DATABASE
+    from squirrel.storage import open_storage
+    from squirrel.journal import replay_journal
+
+    if cmds[1] == 'ensure-indexes':
+        storage = open_storage(database, options.get('layout'))
+        names = storage.ensure_indexes() if storage is not None else None
+        if names is None:
+            sys.exit(1)
+        print(message(get_current_func_name(), f"{len(names)} indexes ensured on {database}"))
+
+    if cmds[1] == 'flush':
+        replayed, remaining = replay_journal(get_batch_size(parser, options))
+        print(message(get_current_func_name(), f"{replayed} journaled stashes replayed, {remaining} left"))
+        if remaining:
+            sys.exit(1)
+
+
+def run_find_command(parser: argparse.ArgumentParser, options: dict):
+    """Print one page of the code objects best matching the search terms."""
+    terms = options['commands'][1:]
+    if terms == []:
+        parser.error(f"{ERROR.no_arg} to find")
+    page = options.get('page') or 1
+    limit = options.get('limit') or FIND_PAGE_SIZE
+    if page < 1 or limit < 1:
+        parser.error(ERROR.bad_page)
+
+    from squirrel.storage import open_storage
+    storage = open_storage(options['database'] or DATABASE, options.get('layout'))
+    if storage is None:
+        sys.exit(1)
+    matches = storage.find(terms, limit, (page - 1) * limit)
+    if matches is None:
+        sys.exit(1)
+    if matches == []:
+        print(f"no matches for {' '.join(terms)}")
+
+    for match in matches:
+        print(f"{match['name']} ({match['type']}, {match['version_name']})")
+        for line in match['snippet'].splitlines():
+            print(f"    {line}")
+
+
+def get_batch_size(parser: argparse.ArgumentParser, options: dict) -> int:
+    batch_size = options.get('batch_size') or BATCH_SIZE
+    if batch_size < 1:
+        parser.error(ERROR.bad_batch_size)
+    return batch_size
+
+
+def run_export_command(parser: argparse.ArgumentParser, options: dict):
+    """Stream the whole library to an NDJSON file, e.g. 'squirrel export library.ndjson.gz'."""
+    if len(options['commands']) < 2:
+        parser.error(f"{ERROR.no_path} to export")
+    path = options['commands'][1]
+    batch_size = get_batch_size(parser, options)
+    from squirrel.storage import open_storage, dump_records
+    storage = open_storage(options['database'] or DATABASE, options.get('layout'))
+    if storage is None:
+        sys.exit(1)
+
+    try:
+        count = dump_records(storage.export_documents(batch_size), path, options.get('gzip'))
+    except Exception as e:
+        print(error(get_current_func_name(), f"{type(e)} {e}", path))
+        sys.exit(1)
+    print(message(get_current_func_name(), f"{count} documents exported to {path}"))
+
+
+def run_import_command(parser: argparse.ArgumentParser, options: dict):
+    """Add the documents of an NDJSON export to the library, batch by batch."""
+    if len(options['commands']) < 2:
+        parser.error(f"{ERROR.no_path} to import")
+    path = options['commands'][1]
+    batch_size = get_batch_size(parser, options)
+    from squirrel.storage import open_storage, load_records
+    storage = open_storage(options['database'] or DATABASE, options.get('layout'))
+    if storage is None:
+        sys.exit(1)
+
+    try:
+        count = storage.import_documents(load_records(path, options.get('gzip')), batch_size)
+    except Exception as e:
+        print(error(get_current_func_name(), f"{type(e)} {e}", path))
+        sys.exit(1)
+    if count is None:
+        sys.exit(1)
+    print(message(get_current_func_name(), f"{count} documents imported from {path}"))
+
+
+def run_plant_command(parser: argparse.ArgumentParser, options: dict):
+    """Write stashed code objects into a Python file, e.g. 'squirrel plant module.py FUNCTION'.
+
+    Names given with -f or -c are looked up as functions or classes, other
+    names as either. Each collection is queried once for all its names.
+    With --with-deps the code objects they depend on are planted too.
+    """
+    if len(options['commands']) < 2:
+        parser.error(f"{ERROR.no_path} to plant into")
+    path = Path(PurePath(options['directory'] or os.getcwd(), options['commands'][1]))
+    version = options['version'] or 'default'
+    bare = options['commands'][2:]
+    wanted = {
+        'function': bare + (options['functions'] or []),
+        'class': bare + (options['classes'] or []),
+    }
+    if not any(wanted.values()):
+        parser.error(f"{ERROR.no_arg} to plant")
+
+    from squirrel.storage import open_storage
+    storage = open_storage(options['database'] or DATABASE, options.get('layout'))
+    if storage is None:
+        sys.exit(1)
+    if options.get('with_deps'):
+        found = storage.get_closure(list(OrderedDict.fromkeys(sum(wanted.values(), []))), version)
+    else:
+        found = OrderedDict()
+        for citizen, names in wanted.items():
+            names = list(OrderedDict.fromkeys(names))
+            versions = storage.get_versions_of(COLLECTIONS[citizen], names, version) if names else {}
+            if versions is None:
+                found = None
+                break
+            found.update(((name, citizen), versions[name]) for name in names if name in versions)
+    if found is None:
+        sys.exit(1)
+
+    planted = {name for name, _ in found}
+    for citizen, names in wanted.items():
+        for name in OrderedDict.fromkeys(names):
+            if name not in planted and (name not in bare or citizen == 'class'):
+                print(f"{citizen if name not in bare else 'code object'} {name} not found!")
+
+    objects = [
+        (name, citizen, ver['source'], ver.get('imports') or [])
+        for (name, citizen), ver in found.items() if ver.get('source') is not None
+    ]
+    if objects == []:
+        sys.exit(1)
+    try:
+        plant(path, objects)
+    except (OSError, SyntaxError) as e:
+        print(error(get_current_func_name(), f"{type(e)} {e}", path))
+        sys.exit(1)
+    print(message(get_current_func_name(), f"{len(objects)} code objects planted in {path}"))
+
+
+def run_diff_command(parser: argparse.ArgumentParser, options: dict):
+    """Show how two versions of a code object differ, e.g. 'squirrel diff FUNCTION v1 v2'.
+
+    Only the two versions are sent by the server, and with --stat only
+    their line counts and hashes.
+    """
+    # -f and -c take every value after them, so 'diff -f NAME v1 v2' reaches
+    # here as functions ['NAME', 'v1', 'v2']
+    args = options['commands'][1:]
+    citizens = ['function', 'class']
+    for citizen, given in [('function', options['functions']), ('class', options['classes'])]:
+        if given:
+            citizens = [citizen]
+            args = given + args
+    if len(args) != 3 or (options['functions'] and options['classes']):
+        parser.error(ERROR.bad_diff)
+    name = args.pop(0)
+    old, new = args
+    fields = ['hash', 'lines'] if options.get('stat') else ['source']
+
+    from squirrel.storage import open_storage
+    storage = open_storage(options['database'] or DATABASE, options.get('layout'))
+    if storage is None:
+        sys.exit(1)
+    for citizen in citizens:
+        versions = storage.get_named_versions(COLLECTIONS[citizen], name, [old, new], fields)
+        if versions is None:
+            sys.exit(1)
+        if versions:
+            break
+    missing = [version for version in [old, new] if version not in versions]
+    if missing:
+        print(f"{name} version {', '.join(missing)} not found!")
+        sys.exit(1)
+
+    if options.get('stat'):
+        changed = versions[old]['hash'] != versions[new]['hash']
+        lines = [versions[version].get('lines') for version in [old, new]]
+        delta = f" ({lines[1] - lines[0]:+d})" if None not in lines else ''
+        print(f"{name} {old}..{new}: {'changed' if changed else 'unchanged'},"
+              f" {lines[0]} -> {lines[1]} lines{delta}")
+        return
+
+    diff = '\n'.join(difflib.unified_diff(
+        (versions[old]['source'] or '').splitlines(),
+        (versions[new]['source'] or '').splitlines(),
+        fromfile=f"{name} ({old})",
+        tofile=f"{name} ({new})",
+        lineterm=''))
+    if diff == '':
+        print(f"{name} {old}..{new}: unchanged")
+        return
+    display_diff(diff, f"{name} {old}..{new}")
+
+
+def main():
+    global parser
+    parser = build_parser()
+
     args = parser.parse_args()
 
     options = vars(args)
 
     #pprint(options)
 
+    if options['commands'][0] == 'serve':
+        serve(run_request)
+        return
+
+    library_commands = {
+        'find': run_find_command,
+        'db': run_db_command,
+        'export': run_export_command,
+        'import': run_import_command,
+        'plant': run_plant_command,
+        'diff': run_diff_command
+    }
+
+    if options['commands'][0] in library_commands:
+        library_commands[options['commands'][0]](parser, options)
+        return
+
+    if options['commands'][0] in ['scope', 'stash'] and not options['no_daemon']:
+        response = forward(options)
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            sys.exit(response['status'])
+
     squirrel = Squirrel(parser, options)
@@ -0,0 +1,998 @@
+"""Storage
+
+This module contains the storage backends for the Squirrel program. Code
+objects are stashed in MongoDB by default, or in a local SQLite file when
+the database is given as a 'sqlite:///path' URL.
+
+Examples
+    squirrel stash FUNCTION
+    squirrel stash FUNCTION -s sqlite:///library.db
+    python -m unittest tests.test_storage
+"""
+import os
+import gzip
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from itertools import groupby
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path, PurePath
+from typing import Iterable, Iterator, List, Tuple
+from bson import json_util
+from bson.json_util import JSONOptions, JSONMode
+
+from squirrel.config import *
+from squirrel.queries import *
+from squirrel.schemas import version_instance
+from squirrel.cache import ObjectCache, get_cache
+
+
+class Storage(ABC):
+    """Operations the Squirrel program needs from a code library."""
+
+    def is_available(self) -> bool:
+        return True
+
+    def get_stored_fingerprints(self, entries: List[dict]) -> dict:
+        """Fetch the stored fingerprints of the objects of stash entries, one query per collection.
+
+        Returns
+        -------
+        dict
+            Fingerprint keyed by (collection, name, version_name).
+        """
+        stored = {}
+        for collection in COLLECTIONS.values():
+            names = list(OrderedDict.fromkeys(
+                entry['name'] for entry in entries if entry['collection'] == collection))
+            if names != []:
+                hashes = self.get_version_hashes(collection, names, 'fingerprint') or {}
+                stored.update({(collection, *key): value for key, value in hashes.items()})
+        return stored
+
+    def stash(self, entries: List[dict], batch_size: int = BATCH_SIZE) -> int:
+        """Stash versions of code objects together, skipping unchanged ones.
+
+        Stored fingerprints are fetched with one query per collection, and
+        the versions of which any stored field changed are written in one
+        batch.
+
+        Parameters
+        ----------
+        entries : List[dict]
+            Collection, name, type, version and qualified_name of each
+            version to stash.
+        batch_size : int, optional
+            Number of writes sent together.
+
+        Returns
+        -------
+        int
+            Number of versions written, or None if a write failed, in
+            which case any of them may be missing.
+        """
+        stored = self.get_stored_fingerprints(entries)
+        written = 0
+        failed = False
+        with self.batch(batch_size) as unit:
+            for entry in entries:
+                version = {**entry['version'], 'fingerprint': get_fingerprint(entry)}
+                if stored.get((entry['collection'], entry['name'], version['version_name'])) == version['fingerprint']:
+                    continue
+                result = self.upsert_version(
+                    collection=entry['collection'],
+                    name=entry['name'],
+                    obj_type=entry['type'],
+                    version=version,
+                    qualified_name=entry.get('qualified_name')
+                )
+                failed = failed or result is None
+                written += 1
+        if failed or getattr(unit, 'failed', False):
+            return None
+        return written
+
+    @abstractmethod
+    def ensure_indexes(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    def upsert_version(self, collection: str, name: str, obj_type: str, version: dict, qualified_name: str = None):
+        """Stash a version of a code object.
+
+        Returns
+        -------
+        Any
+            A result that is not None, unless the write failed.
+        """
+
+    @abstractmethod
+    def get_version_field(self, field: str, citizen: str, name: str, version: str):
+        pass
+
+    @abstractmethod
+    def find(self, terms: List[str], limit: int = FIND_PAGE_SIZE, skip: int = 0) -> List[dict]:
+        """Rank stashed code objects by how well they match search terms.
+
+        Parameters
+        ----------
+        terms : List[str]
+            Words to search for in names, docstrings and sources.
+        limit : int, optional
+            Maximum number of matches.
+        skip : int, optional
+            Number of best matches to leave out, for paging.
+
+        Returns
+        -------
+        List[dict]
+            Name, type, version name, score and snippet of each match, best
+            first, or None if the search failed.
+        """
+
+    @abstractmethod
+    def get_version_hashes(self, collection: str, names: List[str], field: str = 'hash') -> dict:
+        """Fetch the content hash of every version of several code objects at once.
+
+        Pass field='fingerprint' for the hash of every stored field instead.
+
+        Returns
+        -------
+        dict
+            Hash keyed by (name, version_name), or None if the query failed.
+        """
+
+    @abstractmethod
+    def get_versions_of(self, collection: str, names: List[str], version: str) -> dict:
+        """Fetch one version of several code objects in a single query.
+
+        Returns
+        -------
+        dict
+            Version keyed by the name of each code object that has it, with
+            its source, docstring, hash and imports, or None if the query
+            failed.
+        """
+
+    @abstractmethod
+    def get_named_versions(self, collection: str, name: str, version_names: List[str], fields: List[str]) -> dict:
+        """Fetch some fields of a few versions of a code object, and no others.
+
+        Returns
+        -------
+        dict
+            Fields keyed by version name for each version found, or None if
+            the query failed.
+        """
+
+    @abstractmethod
+    def get_closure(self, names: List[str], version: str) -> OrderedDict:
+        """Fetch code objects together with everything they depend on.
+
+        Names are looked up as functions and classes. Dependencies use their
+        version named version, or else their latest one.
+
+        Returns
+        -------
+        OrderedDict
+            Version keyed by (name, citizen), the requested code objects
+            first, or None if the query failed.
+        """
+
+    @contextmanager
+    def batch(self, batch_size: int = BATCH_SIZE):
+        """Send the writes made inside the block together, batch_size at a time.
+
+        Yields the unit of work collecting them, if the backend uses one.
+        Its failed attribute is set on exit if sending them failed.
+        """
+        yield None
+
+    @abstractmethod
+    def export_documents(self, batch_size: int = BATCH_SIZE) -> Iterator[Tuple[str, dict]]:
+        """Yield every stored document with the name of its collection.
+
+        Documents are read batch_size at a time, so memory use does not grow
+        with the size of the library.
+        """
+
+    @abstractmethod
+    def import_documents(self, records: Iterable[Tuple[str, dict]], batch_size: int = BATCH_SIZE) -> int:
+        """Add documents read from an export, batch_size per write.
+
+        Documents already in the library are left as they are.
+
+        Returns
+        -------
+        int
+            Number of documents added or None if a write failed.
+        """
+
+    def close(self):
+        pass
+
+
+class MongoStorage(Storage):
+    """Code library kept in a MongoDB database, see queries."""
+
+    def __init__(self, db_name: str, layout: str = None, keyframe_interval: int = None, cached: bool = False):
+        self.db_name = db_name
+        self.layout = layout or STORAGE_LAYOUT
+        self.keyframe_interval = KEYFRAME_INTERVAL if keyframe_interval is None else keyframe_interval
+        self.cached = cached
+        self.cache = None
+
+    def get_cache(self) -> ObjectCache:
+        """Open the local object cache on first use, if this storage is cached."""
+        if self.cache is None and self.cached:
+            self.cache = get_cache()
+        return self.cache
+
+    def is_available(self) -> bool:
+        return is_reachable()
+
+    def ensure_indexes(self) -> List[str]:
+        return ensure_indexes(self.db_name, force=True)
+
+    def upsert_version(self, collection: str, name: str, obj_type: str, version: dict, qualified_name: str = None):
+        if self.get_cache() is not None:
+            self.cache.invalidate(self.db_name, collection, name)
+        unit = get_unit_of_work(self.db_name)
+        collected = unit.collected if unit is not None else 0
+        if self.keyframe_interval:
+            result = upsert_delta_version(
+                self.db_name, collection, name, obj_type, version,
+                self.keyframe_interval, self.layout, qualified_name)
+        elif self.layout == 'split':
+            result = upsert_split_version(self.db_name, collection, name, obj_type, version, qualified_name)
+        else:
+            result = upsert_version(self.db_name, collection, name, obj_type, version, qualified_name)
+        # writes left to the unit of work fail, if at all, when it is flushed
+        if result is None and unit is not None and unit.collected > collected:
+            return unit
+        return result
+
+    def get_version_field(self, field: str, citizen: str, name: str, version: str):
+        """Read one field of a version through the local cache.
+
+        A cached field younger than the cache's ttl is returned without a
+        query. An older one is checked against the stored fingerprint of
+        the version, which covers every cached field and sends only hashes,
+        and is read again only if it changed. If the server cannot be
+        reached the cached field is returned.
+        """
+        if field not in CACHED_FIELDS or self.get_cache() is None:
+            return get_version_field(self.db_name, field, citizen, name, version, self.layout)
+
+        collection = COLLECTIONS[citizen]
+        key = (self.db_name, collection, name, version, field)
+        entry = self.cache.get(key)
+        if entry is not None and entry[2]:
+            return decode_cached(field, entry[0])
+
+        fingerprints = get_version_hashes(self.db_name, collection, [name], self.layout, 'fingerprint')
+        if fingerprints is None:
+            return decode_cached(field, entry[0]) if entry is not None else None
+        fingerprint = fingerprints.get((name, version))
+        if entry is not None and entry[1] == fingerprint:
+            self.cache.validate(key)
+            return decode_cached(field, entry[0])
+
+        value = get_version_field(self.db_name, field, citizen, name, version, self.layout)
+        if fingerprint and encode_cached(field, value) is not None:
+            self.cache.put(key, fingerprint, encode_cached(field, value))
+        return value
+
+    def read_cache(self, collection: str, keys: List[Tuple[str, str]], fields: List[str]) -> Tuple[dict, list]:
+        """Look up some fields of several versions in the local cache.
+
+        Versions whose fields are all younger than the cache's ttl are
+        served as is. The fingerprints of older ones are fetched in one
+        query, and those that are unchanged are served too. If the server
+        cannot be reached every cached version is served.
+
+        Parameters
+        ----------
+        collection : str
+            Name of the object collection.
+        keys : List[Tuple[str, str]]
+            Pairs of (name, version_name).
+        fields : List[str]
+            Fields of each version, see config.CACHED_FIELDS.
+
+        Returns
+        -------
+        Tuple[dict, list]
+            Version name, fingerprint and fields keyed by (name, version_name) for
+            the versions served, and the keys of those left to read.
+        """
+        fresh, stale, missing = {}, {}, []
+        for key in keys:
+            entries = {field: self.cache.get((self.db_name, collection, *key, field)) for field in fields}
+            if None in entries.values() or len({entry[1] for entry in entries.values()}) != 1:
+                missing.append(key)
+            elif all(entry[2] for entry in entries.values()):
+                fresh[key] = entries
+            else:
+                stale[key] = entries
+
+        if stale:
+            names = list(OrderedDict.fromkeys(name for name, _ in stale))
+            fingerprints = get_version_hashes(self.db_name, collection, names, self.layout, 'fingerprint')
+            for key, entries in stale.items():
+                if fingerprints is None:
+                    fresh[key] = entries
+                elif fingerprints.get(key) == next(iter(entries.values()))[1]:
+                    for field in fields:
+                        self.cache.validate((self.db_name, collection, *key, field))
+                    fresh[key] = entries
+                else:
+                    missing.append(key)
+
+        found = {
+            key: {
+                'version_name': key[1],
+                'fingerprint': next(iter(entries.values()))[1],
+                **{field: decode_cached(field, entry[0]) for field, entry in entries.items()}
+            }
+            for key, entries in fresh.items()
+        }
+        return found, missing
+
+    def write_cache(self, collection: str, name: str, version: dict, fields: List[str]):
+        """Cache some fields of a version read from the server, if all of them can be.
+
+        Fields are kept under the fingerprint of the version, so versions
+        stashed before fingerprints were stored are not cached.
+        """
+        values = {field: encode_cached(field, version.get(field)) for field in fields}
+        if not version.get('fingerprint') or None in values.values():
+            return
+        for field, value in values.items():
+            self.cache.put((self.db_name, collection, name, version['version_name'], field), version['fingerprint'], value)
+
+    def get_version_hashes(self, collection: str, names: List[str], field: str = 'hash') -> dict:
+        return get_version_hashes(self.db_name, collection, names, self.layout, field)
+
+    def get_versions_of(self, collection: str, names: List[str], version: str) -> dict:
+        """Fetch one version of several code objects through the local cache.
+
+        Versions served from the cache hold their source, fingerprint and imports.
+        """
+        if self.get_cache() is None:
+            return get_versions_of(self.db_name, collection, names, version, self.layout)
+
+        fields = ['source', 'imports']
+        cached, missing = self.read_cache(collection, [(name, version) for name in names], fields)
+        found = {name: ver for (name, _), ver in cached.items()}
+        if missing == []:
+            return found
+
+        fetched = get_versions_of(self.db_name, collection, [name for name, _ in missing], version, self.layout)
+        if fetched is None:
+            return None
+        for name, ver in fetched.items():
+            self.write_cache(collection, name, ver, fields)
+        return {**found, **fetched}
+
+    def get_named_versions(self, collection: str, name: str, version_names: List[str], fields: List[str]) -> dict:
+        """Fetch some fields of a few versions of a code object through the local cache.
+
+        Only fields in config.CACHED_FIELDS are cached, a request for any
+        other field goes to the server.
+        """
+        if self.get_cache() is None or not set(fields) <= set(CACHED_FIELDS):
+            return get_named_versions(self.db_name, collection, name, version_names, fields, self.layout)
+
+        cached, missing = self.read_cache(collection, [(name, version) for version in version_names], fields)
+        found = {version: ver for (_, version), ver in cached.items()}
+        if missing == []:
+            return found
+
+        fetched = get_named_versions(
+            self.db_name, collection, name, [version for _, version in missing], [*fields, 'fingerprint'], self.layout)
+        if fetched is None:
+            return None
+        for ver in fetched.values():
+            self.write_cache(collection, name, ver, fields)
+        return {**found, **fetched}
+
+    def get_closure(self, names: List[str], version: str) -> OrderedDict:
+        return get_closure(self.db_name, names, version, self.layout)
+
+    @contextmanager
+    def batch(self, batch_size: int = BATCH_SIZE):
+        with unit_of_work(self.db_name, batch_size) as unit:
+            yield unit
+
+    def find(self, terms: List[str], limit: int = FIND_PAGE_SIZE, skip: int = 0) -> List[dict]:
+        # each collection has its own text index, so the best skip + limit
+        # matches of each are merged here
+        matches = []
+        for citizen, collection in COLLECTIONS.items():
+            found = search_code(self.db_name, collection, ' '.join(terms), skip + limit, 0, self.layout)
+            if found is None:
+                return None
+            matches += [{**match, 'type': citizen} for match in found]
+        matches.sort(key=lambda match: match['score'], reverse=True)
+        return matches[skip:skip + limit]
+
+    def export_documents(self, batch_size: int = BATCH_SIZE) -> Iterator[Tuple[str, dict]]:
+        for collection in CODE_COLLECTIONS:
+            for doc in iter_collection(self.db_name, collection, batch_size):
+                yield collection, doc
+
+    def import_documents(self, records: Iterable[Tuple[str, dict]], batch_size: int = BATCH_SIZE) -> int:
+        if self.get_cache() is not None:
+            self.cache.invalidate(self.db_name)
+        inserted = 0
+        for collection, group in groupby(records, key=lambda record: record[0]):
+            batch = []
+            for _, doc in group:
+                batch.append(doc)
+                if len(batch) == batch_size:
+                    count = insert_batch(self.db_name, collection, batch)
+                    if count is None:
+                        return None
+                    inserted += count
+                    batch = []
+            count = insert_batch(self.db_name, collection, batch)
+            if count is None:
+                return None
+            inserted += count
+        return inserted
+
+
+class SQLiteStorage(Storage):
+    """Code library kept in a local SQLite file.
+
+    Objects and their versions are rows of two indexed tables. The file is
+    opened in WAL mode so readers do not wait on a stash, and every query
+    is a fixed parameterized statement, which sqlite3 prepares once per
+    connection and reuses.
+    """
+    schema = [
+        "CREATE TABLE IF NOT EXISTS objects ("
+        " id INTEGER PRIMARY KEY,"
+        " collection TEXT NOT NULL,"
+        " name TEXT NOT NULL,"
+        " qualified_name TEXT NOT NULL,"
+        " type TEXT NOT NULL,"
+        " UNIQUE (collection, name))",
+        "CREATE TABLE IF NOT EXISTS versions ("
+        " object_id INTEGER NOT NULL REFERENCES objects (id) ON DELETE CASCADE,"
+        " version_name TEXT NOT NULL,"
+        " created TEXT NOT NULL,"
+        " docstring TEXT,"
+        " source TEXT NOT NULL,"
+        " hash TEXT NOT NULL,"
+        " lines INTEGER,"
+        " imports TEXT,"
+        " free_names TEXT,"
+        " dependencies TEXT,"
+        " fingerprint TEXT,"
+        " PRIMARY KEY (object_id, version_name))",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS versions_fts USING fts5("
+        " name, docstring, source,"
+        " object_id UNINDEXED, version_name UNINDEXED)",
+    ]
+    # lists of names and statements, stored as JSON text
+    json_fields = ['imports', 'free_names', 'dependencies']
+    # columns added since the first release, with their types
+    added_columns = {
+        'lines': 'INTEGER',
+        'imports': 'TEXT',
+        'free_names': 'TEXT',
+        'dependencies': 'TEXT',
+        'fingerprint': 'TEXT'
+    }
+    indexes = {
+        'objects_qualified_name': "CREATE INDEX IF NOT EXISTS objects_qualified_name ON objects (qualified_name)",
+        'versions_created': "CREATE INDEX IF NOT EXISTS versions_created ON versions (object_id, created)",
+        'versions_hash': "CREATE INDEX IF NOT EXISTS versions_hash ON versions (hash)",
+    }
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self.batching = 0
+        self.connection = sqlite3.connect(
+            str(self.path), check_same_thread=False, cached_statements=256)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        with self.connection:
+            searchable = self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'versions_fts'").fetchone()
+            for statement in self.schema:
+                self.connection.execute(statement)
+            if searchable is None:
+                self.connection.execute(
+                    "INSERT INTO versions_fts (name, docstring, source, object_id, version_name)"
+                    " SELECT o.name, v.docstring, v.source, v.object_id, v.version_name"
+                    " FROM versions v JOIN objects o ON o.id = v.object_id")
+            columns = [row['name'] for row in self.connection.execute("PRAGMA table_info(versions)")]
+            for column, column_type in self.added_columns.items():
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE versions ADD COLUMN {column} {column_type}")
+        self.ensure_indexes()
+
+    @contextmanager
+    def transaction(self):
+        """Commit the block on exit, unless it is part of a batch."""
+        with self.lock:
+            if self.batching:
+                yield
+                return
+            with self.connection:
+                yield
+
+    @contextmanager
+    def batch(self, batch_size: int = BATCH_SIZE):
+        # a single transaction, so the file is synced once for the whole block
+        with self.transaction():
+            self.batching += 1
+            try:
+                yield None
+            finally:
+                self.batching -= 1
+
+    def ensure_indexes(self) -> List[str]:
+        with self.transaction():
+            for statement in self.indexes.values():
+                self.connection.execute(statement)
+        return list(self.indexes)
+
+    def write_object(self, collection: str, name: str, obj_type: str, qualified_name: str = None) -> int:
+        """Add a code object row if it is missing and return its row id.
+
+        Must be called inside a transaction.
+        """
+        self.connection.execute(
+            "INSERT INTO objects (collection, name, qualified_name, type) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (collection, name) DO UPDATE SET"
+            " qualified_name = coalesce(?, qualified_name)",
+            (collection, name, qualified_name or name, obj_type, qualified_name))
+        return self.connection.execute(
+            "SELECT id FROM objects WHERE collection = ? AND name = ?",
+            (collection, name)).fetchone()['id']
+
+    def write_version(self, object_id: int, name: str, version: dict, replace: bool = True) -> bool:
+        """Add a version row and its search entry.
+
+        Must be called inside a transaction. An existing version with the
+        same name is replaced, or left as is if replace is not set.
+
+        Returns
+        -------
+        bool
+            Whether the version was written.
+        """
+        created = version['created']
+        if isinstance(created, datetime):
+            created = created.isoformat()
+
+        conflict = (
+            "DO UPDATE SET docstring = excluded.docstring, source = excluded.source,"
+            " hash = excluded.hash, lines = excluded.lines, imports = excluded.imports,"
+            " free_names = excluded.free_names, dependencies = excluded.dependencies,"
+            " fingerprint = excluded.fingerprint"
+            if replace else "DO NOTHING")
+        written = self.connection.execute(
+            "INSERT INTO versions"
+            " (object_id, version_name, created, docstring, source, hash, lines,"
+            " imports, free_names, dependencies, fingerprint)"
+            f" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (object_id, version_name) {conflict}",
+            (object_id, version['version_name'], created, version.get('docstring'), version['source'],
+             version.get('hash', ''), version.get('lines', len(version['source'].splitlines())),
+             *(json.dumps(version.get(field) or []) for field in self.json_fields),
+             version.get('fingerprint'))).rowcount
+        if not written:
+            return False
+
+        self.connection.execute(
+            "DELETE FROM versions_fts WHERE object_id = ? AND version_name = ?",
+            (object_id, version['version_name']))
+        self.connection.execute(
+            "INSERT INTO versions_fts (name, docstring, source, object_id, version_name)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (name, version.get('docstring'), version['source'], object_id, version['version_name']))
+        return True
+
+    def upsert_version(self, collection: str, name: str, obj_type: str, version: dict, qualified_name: str = None):
+        """Stash a version of a code object in one transaction.
+
+        A version whose name is new is added, otherwise the source, docstring
+        and hash of the version with that name are replaced.
+
+        Returns
+        -------
+        int
+            Row id of the code object or None if the stash failed.
+        """
+        try:
+            with self.transaction():
+                object_id = self.write_object(collection, name, obj_type, qualified_name)
+                self.write_version(object_id, name, version)
+        except sqlite3.Error as e:
+            print(e)
+            return None
+        else:
+            return object_id
+
+    def get_version_hashes(self, collection: str, names: List[str], field: str = 'hash') -> dict:
+        if field not in ['hash', 'fingerprint']:
+            return None
+        hashes = {}
+        try:
+            with self.lock:
+                # one statement per chunk, within SQLite's limit on parameters
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    rows = self.connection.execute(
+                        f"SELECT o.name, v.version_name, v.{field} FROM objects o JOIN versions v ON v.object_id = o.id"
+                        f" WHERE o.collection = ? AND o.name IN ({', '.join('?' * len(chunk))})",
+                        (collection, *chunk)).fetchall()
+                    hashes.update({(row['name'], row['version_name']): row[field] for row in rows})
+        except sqlite3.Error as e:
+            print(e)
+            return None
+        return hashes
+
+    def get_version_field(self, field: str, citizen: str, name: str, version: str):
+        if field not in version_instance:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT v.* FROM objects o JOIN versions v ON v.object_id = o.id"
+                " WHERE o.collection = ? AND o.name = ? AND v.version_name = ?",
+                (COLLECTIONS[citizen], name, version)).fetchone()
+        if row is None:
+            return None
+        if field in self.json_fields:
+            return json.loads(row[field] or '[]')
+        return row[field]
+
+    def get_versions_of(self, collection: str, names: List[str], version: str) -> dict:
+        found = {}
+        try:
+            with self.lock:
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    rows = self.connection.execute(
+                        "SELECT o.name, v.* FROM objects o JOIN versions v ON v.object_id = o.id"
+                        f" WHERE o.collection = ? AND v.version_name = ? AND o.name IN ({', '.join('?' * len(chunk))})",
+                        (collection, version, *chunk)).fetchall()
+                    found.update({row['name']: self.read_version(row) for row in rows})
+        except sqlite3.Error as e:
+            print(e)
+            return None
+        return found
+
+    def read_version(self, row: sqlite3.Row) -> dict:
+        return {
+            'created': datetime.fromisoformat(row['created']),
+            'version_name': row['version_name'],
+            'docstring': row['docstring'],
+            'source': row['source'],
+            'hash': row['hash'],
+            'lines': row['lines'],
+            **{field: json.loads(row[field] or '[]') for field in self.json_fields},
+            'fingerprint': row['fingerprint']
+        }
+
+    def get_named_versions(self, collection: str, name: str, version_names: List[str], fields: List[str]) -> dict:
+        columns = {
+            field: "coalesce(v.lines, length(v.source) - length(replace(v.source, char(10), '')) + 1)"
+            if field == 'lines' else f"v.{field}"
+            for field in fields if field in version_instance
+        }
+        selected = ''.join(f", {column} AS {field}" for field, column in columns.items())
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT v.version_name{selected} FROM objects o JOIN versions v ON v.object_id = o.id"
+                    " WHERE o.collection = ? AND o.name = ?"
+                    f" AND v.version_name IN ({', '.join('?' * len(version_names))})",
+                    (collection, name, *version_names)).fetchall()
+        except sqlite3.Error as e:
+            print(e)
+            return None
+
+        found = {}
+        for row in rows:
+            ver = dict(row)
+            for field in self.json_fields:
+                if field in ver:
+                    ver[field] = json.loads(ver[field] or '[]')
+            found[row['version_name']] = ver
+        return found
+
+    def get_closure(self, names: List[str], version: str) -> OrderedDict:
+        # closure rows are (name, root), so a name is expanded at most twice
+        # and cycles end. Requested code objects must have the version,
+        # dependencies fall back to their latest one.
+        chosen = (
+            "v.rowid = (SELECT rowid FROM versions WHERE object_id = o.id"
+            " ORDER BY version_name = :version DESC, created DESC LIMIT 1)")
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    "WITH RECURSIVE closure (name, root) AS ("
+                    " SELECT value, 1 FROM json_each(:names)"
+                    " UNION"
+                    " SELECT d.value, 0 FROM closure c"
+                    " JOIN objects o ON o.name = c.name"
+                    f" JOIN versions v ON {chosen}"
+                    " JOIN json_each(coalesce(v.dependencies, '[]')) d"
+                    " WHERE c.root = 0 OR v.version_name = :version)"
+                    " SELECT o.name, o.type, v.*, c.root FROM"
+                    " (SELECT name, max(root) AS root FROM closure GROUP BY name) c"
+                    " JOIN objects o ON o.name = c.name"
+                    f" JOIN versions v ON {chosen}"
+                    " WHERE c.root = 0 OR v.version_name = :version"
+                    " ORDER BY c.root DESC, o.id",
+                    {'names': json.dumps(names), 'version': version}).fetchall()
+        except sqlite3.Error as e:
+            print(e)
+            return None
+
+        closure = OrderedDict()
+        order = {name: i for i, name in enumerate(names)}
+        for row in sorted(rows, key=lambda row: (-row['root'], order.get(row['name'], 0))):
+            closure[(row['name'], row['type'])] = self.read_version(row)
+        return closure
+
+    def find(self, terms: List[str], limit: int = FIND_PAGE_SIZE, skip: int = 0) -> List[dict]:
+        # terms are quoted so that FTS5 query syntax in them is searched for
+        # literally, and any of them may match
+        query = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        weights = ', '.join(str(TEXT_WEIGHTS[field]) for field in ['name', 'docstring', 'source'])
+        try:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT f.name, o.type, f.version_name,"
+                    f" -bm25(versions_fts, {weights}) AS score,"
+                    " substr(CASE WHEN coalesce(f.docstring, '') = '' THEN f.source ELSE f.docstring END, 1, ?) AS snippet"
+                    " FROM versions_fts f JOIN objects o ON o.id = f.object_id"
+                    " WHERE versions_fts MATCH ? ORDER BY score DESC LIMIT ? OFFSET ?",
+                    (SNIPPET_LENGTH, query, limit, skip)).fetchall()
+        except sqlite3.Error as e:
+            print(e)
+            return None
+        return [dict(row) for row in rows]
+
+    def export_documents(self, batch_size: int = BATCH_SIZE) -> Iterator[Tuple[str, dict]]:
+        # objects are yielded in the document layout of MongoDB's embedded
+        # layout, so an export can be imported into either backend
+        cursor = self.connection.execute(
+            "SELECT o.id, o.collection, o.name, o.qualified_name, o.type,"
+            " v.version_name, v.created, v.docstring, v.source, v.hash, v.lines,"
+            " v.imports, v.free_names, v.dependencies, v.fingerprint"
+            " FROM objects o LEFT JOIN versions v ON v.object_id = o.id"
+            " ORDER BY o.id, v.created, v.version_name")
+        cursor.arraysize = batch_size
+        rows = iter(lambda: cursor.fetchmany(), [])
+
+        for _, group in groupby((row for batch in rows for row in batch), key=lambda row: row['id']):
+            group = list(group)
+            first = group[0]
+            doc = {
+                'name': first['name'],
+                'qualified_name': first['qualified_name'],
+                'type': first['type'],
+                'versions': [self.read_version(row) for row in group if row['version_name'] is not None]
+            }
+            yield first['collection'], doc
+
+    def get_base_source(self, object_id: int, version: dict) -> str:
+        """Rebuild the source of a version exported as a delta from its base.
+
+        Returns None if the base is not imported yet.
+        """
+        row = self.connection.execute(
+            "SELECT source FROM versions WHERE object_id = ? AND version_name = ?",
+            (object_id, version.get('base'))).fetchone()
+        if row is None:
+            return None
+        return apply_delta(row['source'], version['delta'])
+
+    def import_documents(self, records: Iterable[Tuple[str, dict]], batch_size: int = BATCH_SIZE) -> int:
+        # versions exported from MongoDB's split layout are documents of
+        # their own, added to the object with the same name
+        citizens = {collection: citizen for citizen, collection in COLLECTIONS.items()}
+        objects = {versions: collection for collection, versions in VERSION_COLLECTIONS.items()}
+        inserted = 0
+        records = iter(records)
+        # split versions stored as deltas whose base comes later in the export
+        deferred = []
+
+        try:
+            while True:
+                batch = [record for _, record in zip(range(batch_size), records)]
+                if batch == []:
+                    break
+                with self.transaction():
+                    for collection, doc in batch:
+                        if collection in objects:
+                            object_id = self.write_object(
+                                objects[collection], doc['name'], citizens[objects[collection]])
+                            if 'source' not in doc:
+                                source = self.get_base_source(object_id, doc)
+                                if source is None:
+                                    deferred.append((object_id, doc))
+                                    continue
+                                doc = {**doc, 'source': source}
+                            inserted += self.write_version(object_id, doc['name'], doc, replace=False)
+                        elif collection in citizens:
+                            known = self.connection.execute(
+                                "SELECT 1 FROM objects WHERE collection = ? AND name = ?",
+                                (collection, doc['name'])).fetchone()
+                            object_id = self.write_object(
+                                collection, doc['name'], doc.get('type') or citizens[collection],
+                                doc.get('qualified_name') or None)
+                            inserted += known is None
+                            versions = doc.get('versions', [])
+                            for version in versions:
+                                if 'source' not in version:
+                                    version = {**version, 'source': rebuild_source(versions, version['version_name'])}
+                                if version['source'] is None:
+                                    print(error(get_current_func_name(), ERROR.missing_base,
+                                                doc['name'], version['version_name']))
+                                    continue
+                                self.write_version(object_id, doc['name'], version, replace=False)
+
+            while deferred:
+                waiting = []
+                with self.transaction():
+                    for object_id, doc in deferred:
+                        source = self.get_base_source(object_id, doc)
+                        if source is None:
+                            waiting.append((object_id, doc))
+                        else:
+                            doc = {**doc, 'source': source}
+                            inserted += self.write_version(object_id, doc['name'], doc, replace=False)
+                if len(waiting) == len(deferred):
+                    for _, doc in waiting:
+                        print(error(get_current_func_name(), ERROR.missing_base, doc['name'], doc['version_name']))
+                    break
+                deferred = waiting
+        except (sqlite3.Error, KeyError) as e:
+            print(e)
+            return None
+        return inserted
+
+    def close(self):
+        self.connection.close()
+
+
+def get_fingerprint(entry: dict) -> str:
+    """Hash every field a stash entry stores, so that a change to any of them is written.
+
+    See Storage.stash for entries.
+    """
+    version = entry['version']
+    fields = {field: version.get(field) for field in VERSION_FIELDS if field not in ['hash', 'fingerprint']}
+    fields['qualified_name'] = entry.get('qualified_name')
+    return hash_source(json.dumps(fields, sort_keys=True, default=str))
+
+
+def encode_cached(field: str, value) -> str:
+    """Text kept in the object cache for a field, or None if it cannot be cached.
+
+    Sources and docstrings are kept as they are, other fields as JSON.
+    """
+    if field in ['source', 'docstring']:
+        return value if isinstance(value, str) else None
+    return json.dumps(value)
+
+
+def decode_cached(field: str, value: str):
+    if field in ['source', 'docstring']:
+        return value
+    return json.loads(value)
+
+
+# storages already opened by this process, keyed by database and layout
+opened_storages = {}
+
+
+def is_sqlite_url(database: str) -> bool:
+    return database.startswith(SQLITE_SCHEME)
+
+
+def get_sqlite_path(database: str, cwd: Path = None) -> Path:
+    """Path of the file named by a 'sqlite:///path' URL.
+
+    Relative paths are taken from cwd, or the current working directory.
+    """
+    path = Path(database[len(SQLITE_SCHEME):])
+    if not path.is_absolute():
+        path = Path(PurePath(cwd or os.getcwd(), path))
+    return path
+
+
+def resolve_database(database: str, cwd: Path = None) -> str:
+    """Make a SQLite URL absolute so it names the same file from any directory."""
+    if database is None or not is_sqlite_url(database):
+        return database
+    return f"{SQLITE_SCHEME}{get_sqlite_path(database, cwd)}"
+
+
+def open_storage(database: str, layout: str = None, keyframe_interval: int = None) -> Storage:
+    """Return the storage for a database name or URL.
+
+    Parameters
+    ----------
+    database : str
+        Name of a MongoDB database or a 'sqlite:///path' URL.
+    layout : str, optional
+        Layout of MongoDB versions, see config.LAYOUTS.
+    keyframe_interval : int, optional
+        Store MongoDB versions as deltas with a keyframe every this many
+        versions, 0 to store every version in full.
+
+    Returns
+    -------
+    Storage
+        Storage shared by every caller in this process, or None if a
+        SQLite file cannot be opened.
+    """
+    if is_sqlite_url(database):
+        key = (str(get_sqlite_path(database)), None)
+    else:
+        key = (database, layout or STORAGE_LAYOUT,
+               KEYFRAME_INTERVAL if keyframe_interval is None else keyframe_interval)
+
+    if key not in opened_storages:
+        if is_sqlite_url(database):
+            try:
+                opened_storages[key] = SQLiteStorage(key[0])
+            except sqlite3.Error as e:
+                print(error(get_current_func_name(), ERROR.bad_database, key[0], e))
+                return None
+        else:
+            opened_storages[key] = MongoStorage(*key, cached=True)
+    return opened_storages[key]
+
+
+# dates are written as {"$date": ...} and read back as naive UTC, as stored
+JSON_OPTIONS = JSONOptions(json_mode=JSONMode.RELAXED, tz_aware=False)
+
+
+def is_gzip_path(path: Path) -> bool:
+    return Path(path).suffix == '.gz'
+
+
+def dump_records(records: Iterable[Tuple[str, dict]], path: Path, compress: bool = False) -> int:
+    """Write (collection, document) records to a file, one JSON object per line.
+
+    The file is gzipped if compress is set or its name ends with '.gz'.
+
+    Returns
+    -------
+    int
+        Number of records written.
+    """
+    opener = gzip.open if compress or is_gzip_path(path) else open
+    count = 0
+    with opener(path, 'wt', encoding='utf-8') as f:
+        for collection, doc in records:
+            f.write(json_util.dumps({'collection': collection, 'document': doc}, json_options=JSON_OPTIONS))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def load_records(path: Path, compress: bool = False) -> Iterator[Tuple[str, dict]]:
+    """Read (collection, document) records written by dump_records, one at a time."""
+    opener = gzip.open if compress or is_gzip_path(path) else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json_util.loads(line, json_options=JSON_OPTIONS)
+                yield record['collection'], record['document']
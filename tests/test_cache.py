@@ -0,0 +1,73 @@
+"""Test Cache
+
+This module contains the local object cache test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_cache
+"""
+import time
+import shutil
+import tempfile
+import unittest
+from pathlib import Path, PurePath
+
+from squirrel.config import *
+from squirrel.cache import *
+
+
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.cache = ObjectCache(PurePath(self.directory, 'cache', CACHE_NAME), max_bytes=100, ttl=60)
+        self.key = (TEST_DB, 'functions', 'dummyfunc', 'default', 'source')
+        self.source = (
+            "def dummyfunc():\n"
+            "    return 0"
+        )
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        self.assertIsNone(self.cache.get(self.key))
+        self.cache.put(self.key, 'abc', self.source)
+        self.assertEqual(self.cache.get(self.key), (self.source, 'abc', True))
+
+        self.cache.ttl = 0
+        self.assertEqual(self.cache.get(self.key), (self.source, 'abc', False))
+        self.cache.ttl = 60
+        self.cache.validate(self.key)
+        self.assertTrue(self.cache.get(self.key)[2])
+
+    def test_put_evicts_least_recently_used(self):
+        keys = [(*self.key[:2], name, *self.key[3:]) for name in ['a', 'b', 'c']]
+        for key in keys:
+            self.cache.put(key, 'abc', 'x' * 40)
+            time.sleep(0.01)
+        self.assertIsNone(self.cache.get(keys[0]))
+        self.assertIsNotNone(self.cache.get(keys[1]))
+
+        time.sleep(0.01)
+        self.cache.put(keys[0], 'abc', 'x' * 40)
+        self.assertIsNone(self.cache.get(keys[2]))
+        self.assertIsNotNone(self.cache.get(keys[1]))
+
+        self.cache.put(self.key, 'abc', 'x' * 101)
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_invalidate(self):
+        other = (self.key[0], 'classes', 'DummyClass', 'default', 'source')
+        self.cache.put(self.key, 'abc', self.source)
+        self.cache.put(other, 'abc', 'class DummyClass(): pass')
+
+        self.cache.invalidate(TEST_DB, 'functions', 'dummyfunc')
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertIsNotNone(self.cache.get(other))
+
+        self.cache.invalidate(TEST_DB)
+        self.assertIsNone(self.cache.get(other))
+
+
+if __name__ == '__main__':
+    unittest.main()
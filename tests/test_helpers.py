@@ -7,6 +7,9 @@ Examples
 """
 import os
 import io
+import ast
+import shutil
+import tempfile
 import unittest
 from pprint import pprint
 from pathlib import Path, PurePath, PosixPath
@@ -77,6 +80,13 @@ class SquirrelHelpersTest(unittest.TestCase):
             Path('/home/engineer/source/python/projects/Squirrel/tests/test_squirrel.py'),
             Path('/home/engineer/source/python/projects/Squirrel/tests/test_helpers.py'),
             Path('/home/engineer/source/python/projects/Squirrel/tests/test_queries.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_index.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_server.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_storage.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_cache.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_journal.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_plant.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/tests/test_startup.py'),
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/helpers.py'),
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/__main__.py'),
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/fragments.py'),
@@ -84,7 +94,13 @@ class SquirrelHelpersTest(unittest.TestCase):
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/__init__.py'),
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/schemas.py'),
             Path('/home/engineer/source/python/projects/Squirrel/squirrel/queries.py'),
-            Path('/home/engineer/source/python/projects/Squirrel/squirrel/config.py')
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/config.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/index.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/server.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/storage.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/cache.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/journal.py'),
+            Path('/home/engineer/source/python/projects/Squirrel/squirrel/plant.py')
         ]
 
     def tearDown(self):
@@ -158,6 +174,53 @@ class SquirrelHelpersTest(unittest.TestCase):
     def test_get_docstring(self):
         pass
     
+    def test_hash_source(self):
+        a = hash_source("def a():\n    return 1")
+        self.assertEqual(hash_source("def a():  \r\n    return 1\n\n"), a)
+        self.assertEqual(hash_source("\ndef a():\n    return 1\t\n"), a)
+        self.assertNotEqual(hash_source("def a():\n    return 2"), a)
+        self.assertNotEqual(hash_source("def a():\n  return 1"), a)
+
+    def test_make_delta(self):
+        base = "def a():\n    x = 1\n    return x\n"
+        cases = [
+            "def a():\n    x = 2\n    return x\n",
+            "def a():\n    return 1",
+            "",
+            base
+        ]
+        for target in cases:
+            self.assertEqual(apply_delta(base, make_delta(base, target)), target)
+        self.assertEqual(make_delta(base, cases[0]), [1, -1, "    x = 2\n", 1])
+        self.assertEqual(apply_delta("", make_delta("", base)), base)
+
+    def test_get_dependencies(self):
+        contents = (
+            "import os, sys as system\n"
+            "from . import sibling\n"
+            "from collections import OrderedDict as od, deque\n"
+            "\n"
+            "def helper():\n"
+            "    pass\n"
+            "\n"
+            "class Helper():\n"
+            "    pass\n"
+            "\n"
+            "def a(x, deque=None):\n"
+            "    y = [z for z in x]\n"
+            "    return os.sep, od(), sibling, helper(y), Helper, len(x), undefined\n"
+        )
+        source = contents[contents.index("def a"):]
+        self.assertEqual(get_dependencies(contents, source), {
+            'free_names': ['os', 'od', 'sibling', 'helper', 'Helper', 'undefined'],
+            'imports': ['import os', 'from . import sibling', 'from collections import OrderedDict as od'],
+            'dependencies': ['helper', 'Helper']
+        })
+        self.assertEqual(get_dependencies(None, source)['free_names'][:2], ['os', 'od'])
+        self.assertEqual(get_dependencies(None, source)['dependencies'], [])
+        self.assertEqual(get_dependencies(None, source, ast.parse(contents))['dependencies'], ['helper', 'Helper'])
+        self.assertEqual(get_dependencies(contents, "def b(:"), {'free_names': [], 'imports': [], 'dependencies': []})
+
     def test_filter_dict(self):
         a = filter_dict(self.function, lambda elem : elem[0] not in ['module', 'package'])
         b = filter_dict(self.module_function, lambda elem: elem[0] not in [
@@ -201,13 +264,30 @@ class SquirrelHelpersTest(unittest.TestCase):
         res = seek_py_files(p, d)
         self.assertCountEqual(res, self.contents)
     
+    def test_walk_py_files(self):
+        root = Path(tempfile.mkdtemp())
+        try:
+            deep = Path(PurePath(root, *[f"d{i}" for i in range(sys.getrecursionlimit() // 10)]))
+            deep.mkdir(parents=True)
+            for d in [root, deep, Path(PurePath(root, 'bin')), Path(PurePath(root, 'pkg.egg-info'))]:
+                d.mkdir(exist_ok=True)
+                Path(PurePath(d, 'mod.py')).touch()
+                Path(PurePath(d, 'notes.txt')).touch()
+            os.symlink(root, PurePath(deep, 'loop'))
+
+            res = list(walk_py_files(root))
+            self.assertCountEqual(res, [Path(PurePath(root, 'mod.py')), Path(PurePath(deep, 'mod.py'))])
+            self.assertEqual(res[0], Path(PurePath(root, 'mod.py')))
+        finally:
+            shutil.rmtree(root)
+
     def test_return_colon(self):
         self.assertEqual(return_colon(''), '')
         self.assertEqual(return_colon('notempty'), ':')
 
     def test_display_code(self):
         cases = OrderedDict({
-            ("test", "string"): highlight("\nstring:\ntest\n", PythonLexer(), TERM_FORMATTER),
+            ("test", "string"): highlight("\nstring:\ntest\n", PythonLexer(), get_term_formatter()),
             (self.dummy_class, "DummyClass"): self.dummy_class_display
         })
         for no, case in cases.items():
@@ -239,6 +319,84 @@ class SquirrelHelpersTest(unittest.TestCase):
         contents = self.DummyClassPy.read_text()
         self.assertEqual(get_code_segment_from_file_contents(contents, 'DummyClass', 'class'), self.dummy_class)
 
+    def test_find_in_file(self):
+        self.assertEqual(find_in_file(self.DummyClassPy, 'DummyClass', 'class'), self.dummy_class)
+        self.assertIsNone(find_in_file(self.DummyClassPy, 'DummyClass', 'function'))
+        self.assertIsNone(find_in_file(PurePath(Path.cwd(), 'missing.py'), 'DummyClass', 'class'))
+
+    def test_find_many_in_file(self):
+        self.assertEqual(
+            find_many_in_file(self.DummyClassPy, (('DummyClass', 'class'), ('DummyClass', 'function'))),
+            {('DummyClass', 'class'): (self.DummyClassPy, self.dummy_class)})
+
+    def test_file_might_define(self):
+        self.assertTrue(file_might_define(self.DummyClassPy, get_definition_pattern('DummyClass', 'class')))
+        self.assertFalse(file_might_define(self.DummyClassPy, get_definition_pattern('DummyClass', 'function')))
+        self.assertFalse(file_might_define(self.DummyClassPy, get_definition_pattern('Dummy', 'class')))
+        self.assertFalse(file_might_define(PurePath(Path.cwd(), 'missing.py'), get_definition_pattern('DummyClass', 'class')))
+
+        pattern = get_definition_pattern('dummyfunc')
+        cases = {
+            b"def dummyfunc():\n    pass\n": True,
+            b"async def dummyfunc():\n    pass\n": True,
+            b"class A:\n    def  dummyfunc(self):\n        pass\n": True,
+            b"def dummyfunc2():\n    pass\n": False,
+            b"dummyfunc()\n": False,
+            b"": False,
+        }
+        for contents, expected in cases.items():
+            self.DummyClassPy.write_bytes(contents)
+            self.assertEqual(file_might_define(self.DummyClassPy, pattern), expected, contents)
+
+    def test_parallel_map(self):
+        names = [f"mod{i}" for i in range(PARALLEL_THRESHOLD * 2)]
+        expected = [f"{name}.py" for name in names]
+        self.assertEqual(parallel_map(modulify, names, 1), expected)
+        self.assertEqual(parallel_map(modulify, names, 2), expected)
+        self.assertEqual(parallel_map(modulify, names[:2], 4), expected[:2])
+
+    def test_get_code_segments_from_file_contents(self):
+        contents = (
+            "def a():\n"
+            "    return 1\n"
+            "\n"
+            "class B():\n"
+            "    pass\n"
+        )
+        self.assertEqual(
+            get_code_segments_from_file_contents(contents, [('a', 'function'), ('B', 'class'), ('B', 'function'), ('c', 'function')]),
+            {('a', 'function'): "def a():\n    return 1", ('B', 'class'): "class B():\n    pass"})
+
+    def test_get_qualified_names(self):
+        contents = (
+            "class A():\n"
+            "    def method(self):\n"
+            "        def inner():\n"
+            "            pass\n"
+            "\n"
+            "    class B():\n"
+            "        async def run(self):\n"
+            "            pass\n"
+            "\n"
+            "def method():\n"
+            "    pass\n"
+        )
+        table = get_qualified_names(ast.parse(contents))
+        self.assertCountEqual(table.keys(), [
+            ('A', 'class'),
+            ('A.method', 'function'),
+            ('A.method.inner', 'function'),
+            ('A.B', 'class'),
+            ('A.B.run', 'function'),
+            ('method', 'function')
+        ])
+        self.assertEqual(
+            get_code_segment_from_file_contents(contents, 'A.B.run'),
+            "async def run(self):\n    pass")
+        self.assertEqual(
+            get_code_segment_from_file_contents(contents, 'A.method'),
+            "def method(self):\n    def inner():\n        pass")
+
     def test_return_file_content_as_string(self):
         self.assertEqual(return_file_content_as_string(self.DummyClassPy), self.dummy_class)
     
@@ -334,6 +492,13 @@ class SquirrelHelpersTest(unittest.TestCase):
         for case in bad_cases:
             res = return_argument_parts(case, 'module')
             self.assertEqual(res, None)
+
+        self.assertEqual(
+            return_argument_parts('package.module.Class.method', 'function'),
+            OrderedDict({"package": "package", "module": "module", "function": "Class.method"}))
+        self.assertEqual(
+            return_argument_parts('package/module/Class/method', 'function'),
+            OrderedDict({"package": "package", "module": "module", "function": "Class.method"}))
     
 
 if __name__ == '__main__':
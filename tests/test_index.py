@@ -0,0 +1,188 @@
+"""Test Index
+
+This module contains the symbol index test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_index
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path, PurePath
+
+from squirrel import index
+from squirrel.index import *
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.index_dir = index.INDEX_DIR
+        index.INDEX_DIR = Path(PurePath(self.directory, 'cache', 'indexes'))
+        self.package = Path(PurePath(self.directory, 'package'))
+        self.package.mkdir()
+        Path(PurePath(self.package, '__init__.py')).touch()
+
+        self.module = Path(PurePath(self.package, 'module.py'))
+        self.module.write_text(
+            "import os\n"
+            "\n"
+            "def dummyfunc(word: str):\n"
+            "    \"\"\"I say hi\"\"\"\n"
+            "    return word\n"
+            "\n"
+            "\n"
+            "class DummyClass():\n"
+            "    async def method(self):\n"
+            "        pass\n"
+        )
+
+    def tearDown(self):
+        index.INDEX_DIR = self.index_dir
+        shutil.rmtree(self.directory)
+
+    def test_get_symbols_from_file_contents(self):
+        symbols = get_symbols_from_file_contents(self.module.read_text())
+        self.assertEqual(
+            [(s['name'], s['type'], s['lineno'], s['end_lineno']) for s in symbols],
+            [('dummyfunc', 'function', 3, 5), ('DummyClass', 'class', 8, 10), ('DummyClass.method', 'function', 9, 10)])
+        self.assertEqual(get_symbols_from_file_contents('def broken(:'), [])
+
+    def test_refresh_index(self):
+        idx = refresh_index(self.directory)
+        self.assertTrue(get_index_path(self.directory).is_file())
+        self.assertEqual(get_index_path(self.directory).parent, index.INDEX_DIR)
+        self.assertEqual(list(self.directory.glob('*.json')), [])
+        self.assertCountEqual(idx['files'].keys(), ['package/__init__.py', 'package/module.py'])
+        self.assertEqual(load_index(self.directory), idx)
+
+        os.remove(self.module)
+        idx = refresh_index(self.directory)
+        self.assertEqual(list(idx['files'].keys()), ['package/__init__.py'])
+
+    def test_find_symbols_in_index_all_matches(self):
+        other = Path(PurePath(self.directory, 'other.py'))
+        other.write_text(
+            "def dummyfunc():\n"
+            "    return 2\n"
+        )
+        found = find_symbols_in_index(
+            self.directory, [('dummyfunc', 'function'), ('missing', 'function')], all_matches=True)
+        self.assertEqual(found, {
+            ('dummyfunc', 'function'): [
+                (other,
+                 "def dummyfunc():\n"
+                 "    return 2"),
+                (self.module,
+                 "def dummyfunc(word: str):\n"
+                 "    \"\"\"I say hi\"\"\"\n"
+                 "    return word")
+            ],
+            ('missing', 'function'): []
+        })
+
+    def test_find_symbols_in_index(self):
+        found = find_symbols_in_index(
+            self.directory,
+            [('dummyfunc', 'function'), ('DummyClass', 'class'), ('DummyClass', 'function'), ('missing', 'class')])
+        self.assertEqual(found, {
+            ('dummyfunc', 'function'): [(
+                self.module,
+                "def dummyfunc(word: str):\n"
+                "    \"\"\"I say hi\"\"\"\n"
+                "    return word"
+            )],
+            ('DummyClass', 'class'): [(
+                self.module,
+                "class DummyClass():\n"
+                "    async def method(self):\n"
+                "        pass"
+            )],
+            ('DummyClass', 'function'): [],
+            ('missing', 'class'): []
+        })
+
+    def test_find_symbol_in_file(self):
+        self.assertEqual(
+            find_symbol_in_file(self.directory, self.module, 'DummyClass.method'),
+            "async def method(self):\n"
+            "    pass")
+        self.assertIsNone(find_symbol_in_file(self.directory, self.module, 'method'))
+        self.assertIn('package/module.py', load_index(self.directory)['files'])
+
+        self.module.write_text(
+            "class DummyClass():\n"
+            "    def method(self):\n"
+            "        return 1\n"
+        )
+        self.assertEqual(
+            find_symbol_in_file(self.directory, self.module, 'DummyClass.method'),
+            "def method(self):\n"
+            "    return 1")
+
+    def test_find_symbols_in_index_after_change(self):
+        find_symbols_in_index(self.directory, [('dummyfunc', 'function')])
+        self.module.write_text(
+            "def otherfunc():\n"
+            "    return 1\n"
+            "\n"
+            "def dummyfunc():\n"
+            "    return 2\n"
+        )
+        found = find_symbols_in_index(self.directory, [('dummyfunc', 'function'), ('otherfunc', 'function')])
+        self.assertEqual(found, {
+            ('dummyfunc', 'function'): [(
+                self.module,
+                "def dummyfunc():\n"
+                "    return 2"
+            )],
+            ('otherfunc', 'function'): [(
+                self.module,
+                "def otherfunc():\n"
+                "    return 1"
+            )]
+        })
+
+    def test_get_changed_files(self):
+        idx = refresh_index(self.directory)
+        self.assertEqual(get_changed_files(self.directory, idx), {})
+
+        self.module.write_text("def otherfunc():\n    return 1\n")
+        init = 'package/__init__.py'
+        os.remove(PurePath(self.directory, init))
+        Path(PurePath(self.directory, 'new.py')).write_text("def newfunc():\n    pass\n")
+        changes = get_changed_files(self.directory, idx)
+        self.assertEqual(sorted(changes), [init, 'package/module.py'])
+        self.assertIsNone(changes[init][1])
+
+        apply_changed_files(self.directory, idx, changes)
+        self.assertEqual(list(idx['files']), ['package/module.py'])
+        self.assertEqual([key for key, _ in lookup_symbol(idx, 'otherfunc')], ['package/module.py'])
+        self.assertEqual(list(json.loads(get_index_path(self.directory).read_text())['files']), ['package/module.py'])
+
+        # entries a lookup refreshed meanwhile are kept
+        self.module.write_text("def thirdfunc():\n    return 3\n")
+        changes = get_changed_files(self.directory, idx)
+        refresh_index(self.directory, idx)
+        fresh = idx['files']['package/module.py']
+        apply_changed_files(self.directory, idx, changes)
+        self.assertIs(idx['files']['package/module.py'], fresh)
+
+    def test_find_symbols_in_index_after_change_in_first_match(self):
+        first = Path(PurePath(self.directory, 'a.py'))
+        second = Path(PurePath(self.directory, 'b.py'))
+        first.write_text("def foo():\n    return 'a'\n")
+        second.write_text("def foo():\n    return 'b'\n")
+        target = ('foo', 'function')
+        found = find_symbols_in_index(self.directory, [target])[target]
+        self.assertEqual(found, [(first, "def foo():\n    return 'a'")])
+
+        first.write_text("def foo():\n    return 'edited a'\n")
+        found = find_symbols_in_index(self.directory, [target])[target]
+        self.assertEqual(found, [(first, "def foo():\n    return 'edited a'")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""Test Journal
+
+This module contains the offline stash journal test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_journal
+"""
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path, PurePath
+
+from squirrel.config import *
+from squirrel.helpers import hash_source
+from squirrel.journal import *
+from squirrel.storage import opened_storages
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.journal = Journal(PurePath(self.directory, 'state', 'journal.ndjson'))
+        self.database = f"{SQLITE_SCHEME}{PurePath(self.directory, 'library.db')}"
+        source = (
+            "def dummyfunc():\n"
+            "    return 0"
+        )
+        self.entry = {
+            'collection': 'functions',
+            'name': 'dummyfunc',
+            'type': 'function',
+            'version': {
+                'created': datetime.today().replace(microsecond=0),
+                'version_name': 'default',
+                'docstring': None,
+                'source': source,
+                'hash': hash_source(source)
+            },
+            'qualified_name': None
+        }
+
+    def tearDown(self):
+        for storage in opened_storages.values():
+            storage.close()
+        opened_storages.clear()
+        shutil.rmtree(self.directory)
+
+    def test_journal_entries(self):
+        self.assertFalse(has_journal(self.journal))
+        journal_entries(self.database, None, 0, [self.entry], self.journal)
+        journal_entries(self.database, None, 0, [self.entry, self.entry], self.journal)
+        self.assertTrue(has_journal(self.journal))
+        self.assertEqual(len(self.journal.path.read_text().splitlines()), 3)
+
+    def test_replay_journal(self):
+        self.assertEqual(replay_journal(journal=self.journal), (0, 0))
+
+        changed = {**self.entry, 'version': {**self.entry['version'], 'source': 'def dummyfunc(): pass'}}
+        changed['version']['hash'] = hash_source(changed['version']['source'])
+        other = {**self.entry, 'version': {**self.entry['version'], 'version_name': 'v2'}}
+        journal_entries(self.database, None, 0, [self.entry, other, changed], self.journal)
+
+        self.assertEqual(replay_journal(journal=self.journal), (3, 0))
+        self.assertFalse(has_journal(self.journal))
+
+        storage = open_storage(self.database)
+        self.assertEqual(
+            storage.get_version_field('source', 'function', 'dummyfunc', 'default'),
+            changed['version']['source'])
+        self.assertEqual(
+            storage.get_version_field('created', 'function', 'dummyfunc', 'v2'),
+            self.entry['version']['created'].isoformat())
+
+    def test_get_unconfirmed(self):
+        storage = open_storage(self.database)
+        self.assertEqual(get_unconfirmed(storage, [self.entry]), [self.entry])
+        storage.stash([self.entry])
+        self.assertEqual(get_unconfirmed(storage, [self.entry]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
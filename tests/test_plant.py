@@ -0,0 +1,82 @@
+"""Test Plant
+
+This module contains the plant command test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_plant
+"""
+import ast
+import shutil
+import tempfile
+import unittest
+from pathlib import Path, PurePath
+
+from squirrel.plant import *
+
+
+class PlantTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.target = Path(PurePath(self.directory, 'target.py'))
+        self.contents = (
+            '"""Target."""\n'
+            "import os\n"
+            "\n"
+            "\n"
+            "class DummyClass():\n"
+            "    @staticmethod\n"
+            "    def zero():\n"
+            "        return 0\n"
+            "\n"
+            "\n"
+            "def dummyfunc():\n"
+            "    return os.sep\n"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_import_line(self):
+        self.assertEqual(get_import_line(ast.parse(self.contents)), 2)
+        self.assertEqual(get_import_line(ast.parse('"""Doc."""\n\nx = 1\n')), 1)
+        self.assertEqual(get_import_line(ast.parse("x = 1\n")), 0)
+
+    def test_plant_sources(self):
+        objects = [
+            ('dummyfunc', 'function', "def dummyfunc():\n    return sys.argv", ['import sys', 'import os']),
+            ('DummyClass.zero', 'function', "def zero():\n    return 1\n", []),
+            ('otherfunc', 'function', "def otherfunc():\n    pass", ['from . import sibling']),
+        ]
+        self.assertEqual(plant_sources(self.contents, objects), (
+            '"""Target."""\n'
+            "import os\n"
+            "import sys\n"
+            "from . import sibling\n"
+            "\n"
+            "\n"
+            "class DummyClass():\n"
+            "    @staticmethod\n"
+            "    def zero():\n"
+            "        return 1\n"
+            "\n"
+            "\n"
+            "def dummyfunc():\n"
+            "    return sys.argv\n"
+            "\n"
+            "\n"
+            "def otherfunc():\n"
+            "    pass\n"
+        ))
+
+    def test_plant(self):
+        objects = [('dummyfunc', 'function', "def dummyfunc():\n    return os.sep", ['import os'])]
+        planted = plant(self.target, objects)
+        self.assertEqual(planted, "import os\n\n\ndef dummyfunc():\n    return os.sep\n")
+        self.assertEqual(self.target.read_text(), planted)
+
+        self.assertEqual(plant(self.target, objects), planted)
+        self.assertEqual(list(self.directory.iterdir()), [self.target])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -138,6 +138,35 @@ class QueriesTest(unittest.TestCase):
     def test_has_client(self):
         self.assertTrue(has_client())
 
+    def test_is_reachable(self):
+        self.assertTrue(is_reachable())
+        self.assertTrue(health['available'])
+
+        set_health(False)
+        self.assertFalse(is_reachable())
+        self.assertFalse(has_client())
+
+        forget_health()
+        self.assertTrue(is_reachable())
+
+    def test_has_database_cached(self):
+        create_database(TEST_DB, 'pets', self.initial_item)
+        self.assertTrue(has_database(TEST_DB))
+        self.delete_test_db(TEST_DB)
+        self.assertTrue(has_database(TEST_DB))
+        forget_health()
+        self.assertFalse(has_database(TEST_DB))
+
+    def test_get_client(self):
+        a = get_client()
+        self.assertIs(get_client(), a)
+        self.assertIs(get_collection(TEST_DB, 'functions').database.client, a)
+
+        configure_client(pool_size=5)
+        b = get_client()
+        self.assertIsNot(b, a)
+        self.assertEqual(b.options.pool_options.max_pool_size, 5)
+
     def test_create_database(self):
         case = [
             {"name": "a", "number": 1}
@@ -388,47 +417,211 @@ class QueriesTest(unittest.TestCase):
 
         self.delete_test_db('deleteme')
     
-    def test_handle_code_change(self):
-        create_database('deleteme', 'functions', self.function)
-        #insert_item('deleteme', 'functions', self.function)
-        latest = get_item(
-            'deleteme',
-            'functions', 
-            {'name': 'dummyfunc'},
-            **{'name': 1, 'type': 1, 'versions': {"$slice": -1}})
-        new_docstring = {
-            'name': 'dummyfunc',
-            'versions': [
-                {
-                    'docstring': 'Returns Success',
-                    'source': (
-                        "def dummyfunc():\n"
-                        "    return 1"
-                    ),
-                    'created': datetime.today().replace(microsecond=0)
-                }
-            ]
-        }
-        new_source = {
-            'name': 'dummyfunc',
-            'versions': [
-                {
-                    'docstring': 'Returns True always',
-                    'source': (
-                        "def dummyfunc():\n"
-                        "    return 2"
-                    ),
-                    'created': datetime.today().replace(microsecond=0)
-                }
-            ]
-        }
-        #handle_code_change('functions', new_docstring, latest)
-        #handle_code_change('functions', new_source, latest)
-        #self.delete_test_db('deleteme')
-        pass
-
     def test_get_version_field(self):
-        pass
+        create_database(TEST_DB, 'functions', self.function)
+        self.assertEqual(
+            get_version_field(TEST_DB, 'source', 'function', 'dummyfunc', 'dummyfunc-non-zero', 'embedded'),
+            self.function['versions'][1]['source'])
+        self.assertIsNone(get_version_field(TEST_DB, 'source', 'function', 'dummyfunc', 'missing', 'embedded'))
+        self.assertIsNone(get_version_field(TEST_DB, 'source', 'function', 'missing', 'default', 'embedded'))
+
+    def test_get_versions_of(self):
+        create_database(TEST_DB, 'functions', self.function)
+        found = get_versions_of(TEST_DB, 'functions', ['dummyfunc', 'missing'], 'dummyfunc-non-zero', 'embedded')
+        self.assertEqual(list(found), ['dummyfunc'])
+        self.assertEqual(found['dummyfunc']['source'], self.function['versions'][1]['source'])
+        self.assertEqual(get_versions_of(TEST_DB, 'functions', ['dummyfunc'], 'missing', 'embedded'), {})
+
+    def test_get_named_versions(self):
+        create_database(TEST_DB, 'functions', self.function)
+        versions = get_named_versions(
+            TEST_DB, 'functions', 'dummyfunc', ['default', 'dummyfunc-non-zero', 'missing'], ['lines'], 'embedded')
+        self.assertEqual(sorted(versions), ['default', 'dummyfunc-non-zero'])
+        self.assertEqual(versions['default']['lines'], len(self.function['versions'][0]['source'].split('\n')))
+        self.assertNotIn('source', versions['default'])
+
+        versions = get_named_versions(TEST_DB, 'functions', 'dummyfunc', ['dummyfunc-non-zero'], ['source'], 'embedded')
+        self.assertEqual(versions['dummyfunc-non-zero']['source'], self.function['versions'][1]['source'])
+
+    def test_get_closure(self):
+        create_database(TEST_DB, 'functions', self.function)
+        helper = {**self.function['versions'][0], 'source': 'def helper(): pass'}
+        upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', {
+            **self.function['versions'][1], 'dependencies': ['helper']})
+        upsert_version(TEST_DB, 'functions', 'helper', 'function', {**helper, 'dependencies': ['dummyfunc']})
+
+        closure = get_closure(TEST_DB, ['dummyfunc'], 'dummyfunc-non-zero', 'embedded')
+        self.assertEqual(list(closure), [('dummyfunc', 'function'), ('helper', 'function')])
+        self.assertEqual(closure[('helper', 'function')]['source'], helper['source'])
+        self.assertEqual(get_closure(TEST_DB, ['helper'], 'dummyfunc-non-zero', 'embedded'), OrderedDict())
+
+    def test_ensure_indexes(self):
+        names = ensure_indexes(TEST_DB, force=True)
+        self.assertIn('name_1', names)
+        self.assertIn('qualified_name_1', names)
+        self.assertIn('name_1_versions.version_name_1', names)
+        self.assertIn('object_id_1_version_name_1', names)
+
+        indexes = get_collection(TEST_DB, 'functions').index_information()
+        self.assertTrue(indexes['name_1']['unique'])
+        self.assertEqual(ensure_indexes(TEST_DB), [])
+
+    def test_search_code(self):
+        create_database(TEST_DB, 'functions', self.function)
+        ensure_indexes(TEST_DB, force=True)
+
+        matches = search_code(TEST_DB, 'functions', 'non zero', 10)
+        self.assertEqual([m['name'] for m in matches], ['dummyfunc'])
+        self.assertEqual(matches[0]['version_name'], self.function['versions'][-1]['version_name'])
+        self.assertNotIn('versions', matches[0])
+        self.assertEqual(search_code(TEST_DB, 'functions', 'non zero', 10, skip=1), [])
+        self.assertEqual(search_code(TEST_DB, 'functions', 'missing', 10), [])
+
+    def test_search_code_split(self):
+        for version in self.function['versions']:
+            upsert_split_version(TEST_DB, 'functions', 'dummyfunc', 'function', version)
+        ensure_indexes(TEST_DB, force=True)
+
+        matches = search_code(TEST_DB, 'functions', 'dummyfunc zero', 10, layout='split')
+        self.assertEqual([m['name'] for m in matches], ['dummyfunc'])
+        self.assertEqual(matches[0]['version_name'], 'dummyfunc-non-zero')
+        self.assertEqual(search_code(TEST_DB, 'functions', 'dummyfunc zero', 10, skip=1, layout='split'), [])
+
+    def test_iter_collection(self):
+        self.assertEqual(insert_batch(TEST_DB, 'pets', [{'name': str(i)} for i in range(5)]), 5)
+        self.assertEqual(insert_batch(TEST_DB, 'pets', []), 0)
+        docs = list(iter_collection(TEST_DB, 'pets', batch_size=2))
+        self.assertEqual([d['name'] for d in docs], [str(i) for i in range(5)])
+
+        self.assertEqual(insert_batch(TEST_DB, 'pets', [docs[0], {'name': '5'}]), 1)
+        self.assertEqual(len(list(iter_collection(TEST_DB, 'pets'))), 6)
+
+    def test_rebuild_source(self):
+        sources = [
+            "def dummyfunc():\n"
+            "    \"\"\"Returns a number\"\"\"\n"
+            f"    return {i}\n"
+            for i in range(5)
+        ]
+        versions = []
+        for i, source in enumerate(sources):
+            previous = versions[-1] if versions else None
+            previous_source = rebuild_source(versions, previous['version_name']) if previous else None
+            version = {'version_name': f"v{i}", 'source': source, 'docstring': ''}
+            versions.append(encode_version(version, previous, previous_source, 3))
+
+        self.assertEqual([v['depth'] for v in versions], [0, 1, 2, 0, 1])
+        self.assertNotIn('source', versions[1])
+        self.assertEqual(versions[2]['base'], 'v1')
+        for i, source in enumerate(sources):
+            self.assertEqual(rebuild_source(versions, f"v{i}"), source)
+        self.assertIsNone(rebuild_source(versions, 'missing'))
+        self.assertIsNone(rebuild_source(versions[1:], 'v2'))
+
+    def test_upsert_delta_version(self):
+        for layout in LAYOUTS:
+            collection = 'functions' if layout == 'embedded' else 'classes'
+            citizen = 'function' if layout == 'embedded' else 'class'
+            sources = {}
+            for i in range(4):
+                source = (
+                    "def dummyfunc():\n"
+                    "    \"\"\"Returns a number\"\"\"\n"
+                    f"    return {i}\n"
+                )
+                sources[f"v{i}"] = source
+                version = {**self.new_version, 'version_name': f"v{i}", 'source': source}
+                upsert_delta_version(TEST_DB, collection, 'dummyfunc', citizen, version, 3, layout)
+
+            stored = get_versions(TEST_DB, collection, 'dummyfunc', layout)
+            self.assertEqual([v.get('depth') for v in stored], [0, 1, 2, 0])
+            # only keyframes and the latest version keep their source
+            self.assertEqual(['source' in v for v in stored], [True, False, False, True])
+
+            # changing v1 in place turns v2, which was a delta of it, into a keyframe
+            sources['v1'] = "def dummyfunc():\n    return 'one'\n"
+            upsert_delta_version(
+                TEST_DB, collection, 'dummyfunc', citizen,
+                {**self.new_version, 'version_name': 'v1', 'source': sources['v1']}, 3, layout)
+
+            for name, source in sources.items():
+                self.assertEqual(get_version_field(TEST_DB, 'source', citizen, 'dummyfunc', name, layout), source)
+            self.assertEqual(
+                [v['version_name'] for v in get_versions(TEST_DB, collection, 'dummyfunc', layout)],
+                list(sources))
+
+    def test_unit_of_work(self):
+        default = {**self.function['versions'][0], 'hash': hash_source(self.function['versions'][0]['source'])}
+        with unit_of_work(TEST_DB) as unit:
+            upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', default)
+            upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', self.new_version)
+            upsert_split_version(TEST_DB, 'classes', 'DummyClass', 'class', default)
+            with unit_of_work(TEST_DB) as inner:
+                self.assertIs(inner, unit)
+            self.assertEqual(get_all_items_in_collection(TEST_DB, 'functions'), [])
+        self.assertIsNone(get_unit_of_work(TEST_DB))
+
+        document = get_item(TEST_DB, 'functions', {'name': 'dummyfunc'})
+        self.assertEqual(len(document['versions']), 2)
+        self.assertEqual(
+            get_version_hashes(TEST_DB, 'functions', ['dummyfunc'], 'embedded'),
+            {('dummyfunc', 'default'): default['hash'], ('dummyfunc', 'dummyfunc-non-zero-42'): None})
+        self.assertEqual(
+            get_version_field(TEST_DB, 'source', 'class', 'DummyClass', 'default', 'split'),
+            default['source'])
+
+        with unit_of_work(TEST_DB, batch_size=2) as unit:
+            for name in ['a', 'b', 'c']:
+                upsert_version(TEST_DB, 'functions', name, 'function', default)
+            self.assertEqual(unit.pending, 1)
+
+    def test_upsert_split_version(self):
+        default = {**self.function['versions'][0], 'hash': hash_source(self.function['versions'][0]['source'])}
+        upsert_split_version(TEST_DB, 'functions', 'dummyfunc', 'function', default)
+        upsert_split_version(TEST_DB, 'functions', 'dummyfunc', 'function', self.new_version)
+
+        objects = get_all_items_in_collection(TEST_DB, 'functions')
+        self.assertEqual(len(objects), 1)
+        self.assertNotIn('versions', objects[0])
+
+        versions = get_all_items_in_collection(TEST_DB, 'function_versions')
+        self.assertEqual(len(versions), 2)
+        self.assertTrue(all(ver['object_id'] == objects[0]['_id'] for ver in versions))
+
+        self.assertEqual(
+            get_version_hashes(TEST_DB, 'functions', ['dummyfunc'], 'split')[('dummyfunc', 'default')], default['hash'])
+        self.assertEqual(
+            get_version_field(TEST_DB, 'source', 'function', 'dummyfunc', 'dummyfunc-non-zero-42', 'split'),
+            self.new_version['source'])
+
+        changed = {**default, 'source': 'def dummyfunc():\n    return 3'}
+        upsert_split_version(TEST_DB, 'functions', 'dummyfunc', 'function', changed)
+        self.assertEqual(len(get_all_items_in_collection(TEST_DB, 'function_versions')), 2)
+        self.assertEqual(
+            get_version_field(TEST_DB, 'source', 'function', 'dummyfunc', 'default', 'split'),
+            changed['source'])
+
+    def test_upsert_version(self):
+        default = self.function['versions'][0]
+        upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', default)
+        state = get_all_items_in_collection(TEST_DB, 'functions')
+        self.assertEqual(len(state), 1)
+        self.assertEqual(state[0]['type'], 'function')
+        self.assertEqual(state[0]['versions'], [default])
+
+        upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', self.new_version)
+        state = get_all_items_in_collection(TEST_DB, 'functions')
+        self.assertEqual(
+            [ver['version_name'] for ver in state[0]['versions']],
+            ['default', 'dummyfunc-non-zero-42'])
+
+        changed = {**default, 'docstring': '$not a field path', 'source': 'def dummyfunc():\n    return 3'}
+        upsert_version(TEST_DB, 'functions', 'dummyfunc', 'function', changed)
+        state = get_all_items_in_collection(TEST_DB, 'functions')
+        self.assertEqual(len(state[0]['versions']), 2)
+        self.assertEqual(state[0]['versions'][0]['docstring'], '$not a field path')
+        self.assertEqual(state[0]['versions'][0]['source'], changed['source'])
+        self.assertEqual(state[0]['versions'][0]['created'], default['created'])
 
 if __name__ == '__main__':
     unittest.main()
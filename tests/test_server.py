@@ -0,0 +1,109 @@
+"""Test Server
+
+This module contains the lookup server test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_server
+"""
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path, PurePath
+
+from squirrel import index
+from squirrel.config import *
+from squirrel.server import *
+from squirrel.squirrel import run_request
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.index_dir = index.INDEX_DIR
+        index.INDEX_DIR = Path(PurePath(self.directory, 'indexes'))
+        self.socket = Path(PurePath(self.directory, 'squirrel.sock'))
+        Path(PurePath(self.directory, 'module.py')).write_text(
+            "def dummyfunc():\n"
+            "    return 0\n"
+        )
+        self.options = {
+            'commands': ['scope', 'dummyfunc'],
+            'packages': None,
+            'classes': None,
+            'functions': None,
+            'module': None,
+            'directory': str(self.directory),
+            'database': None,
+            'version': None,
+            'no_index': False,
+            'jobs': None,
+            'all_matches': False,
+            'no_daemon': False
+        }
+
+    def tearDown(self):
+        index.INDEX_DIR = self.index_dir
+        shutil.rmtree(self.directory)
+
+    def test_forward_without_server(self):
+        self.assertIsNone(forward(self.options, self.socket))
+        self.assertFalse(is_server_running(self.socket))
+
+    def test_forward(self):
+        server = SquirrelServer(self.socket, run_request)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            self.assertTrue(is_server_running(self.socket))
+
+            response = forward(self.options, self.socket)
+            self.assertEqual(response['status'], 0)
+            self.assertIn('scopeing function: dummyfunc', response['stdout'])
+
+            response = forward({**self.options, 'commands': ['scope', 'missing']}, self.socket)
+            self.assertEqual(response['status'], 0)
+            self.assertIn('function missing not found!', response['stdout'])
+
+            response = forward({**self.options, 'commands': ['bogus', 'missing']}, self.socket)
+            self.assertEqual(response['status'], 2)
+            self.assertIn(ERROR.bad_command, response['stderr'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_socket_is_private(self):
+        server = SquirrelServer(self.socket, run_request)
+        try:
+            self.assertTrue(is_own_socket(self.socket))
+            self.assertEqual(os.stat(self.socket).st_mode & 0o077, 0)
+        finally:
+            server.server_close()
+
+    def test_make_private_directory(self):
+        private = Path(PurePath(self.directory, 'run', 'squirrel'))
+        self.assertTrue(make_private_directory(private))
+        self.assertEqual(private.stat().st_mode & 0o777, 0o700)
+        private.chmod(0o755)
+        self.assertFalse(make_private_directory(private))
+
+    @unittest.skipUnless(hasattr(os, 'getuid') and os.getuid() == 0, 'needs root to give the socket away')
+    def test_forward_to_other_users_socket(self):
+        server = SquirrelServer(self.socket, run_request)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            os.chown(self.socket, 65534, -1)
+            with redirect_stdout(io.StringIO()) as out:
+                self.assertIsNone(forward(self.options, self.socket))
+            self.assertIn(ERROR.untrusted_socket, out.getvalue())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Test Startup
+
+This module contains the command line startup time test case for the
+Squirrel program. Commands that do not use a library must not load pymongo,
+bson or pygments, and 'squirrel --help' must start within a time budget.
+
+Examples
+    python -m unittest tests.test_startup
+    SQUIRREL_STARTUP_BUDGET=0.2 python -m unittest tests.test_startup
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import unittest
+from pathlib import Path
+
+
+class StartupTest(unittest.TestCase):
+    # seconds 'squirrel --help' may take over a bare interpreter
+    budget = float(os.getenv('SQUIRREL_STARTUP_BUDGET', '0.075'))
+    heavy_modules = ['pymongo', 'bson', 'pygments']
+
+    def setUp(self):
+        root = str(Path(__file__).resolve().parents[1])
+        self.env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.getenv('PYTHONPATH')]))}
+
+    def run_python(self, *args) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            [sys.executable, *args], env=self.env, capture_output=True, text=True, check=True)
+
+    def best_time(self, *args, runs: int = 5) -> float:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            self.run_python(*args)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def test_heavy_modules_not_imported(self):
+        script = (
+            "import sys, json\n"
+            "sys.argv = ['squirrel', '--help']\n"
+            "from squirrel.squirrel import main\n"
+            "try:\n"
+            "    main()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(json.dumps(sorted({m.split('.')[0] for m in sys.modules})), file=sys.stderr)\n"
+        )
+        loaded = json.loads(self.run_python('-c', script).stderr)
+        self.assertEqual([m for m in self.heavy_modules if m in loaded], [])
+
+    def test_help_startup_budget(self):
+        baseline = self.best_time('-c', 'pass')
+        startup = self.best_time('-m', 'squirrel', '--help')
+        self.assertLess(startup - baseline, self.budget)
+
+
+if __name__ == '__main__':
+    unittest.main()
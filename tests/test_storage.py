@@ -0,0 +1,406 @@
+"""Test Storage
+
+This module contains the storage backend test case for the Squirrel program.
+
+Examples
+    python -m unittest tests.test_storage
+"""
+import io
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path, PurePath
+
+from squirrel.config import *
+from squirrel.helpers import hash_source
+from squirrel.storage import *
+from squirrel import queries
+
+
+class SQLiteStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.url = f"{SQLITE_SCHEME}{PurePath(self.directory, 'library.db')}"
+        self.storage = open_storage(self.url)
+        self.version = {
+            'created': datetime.today().replace(microsecond=0),
+            'version_name': 'default',
+            'docstring': 'Returns zero',
+            'source': (
+                "def dummyfunc():\n"
+                "    return 0"
+            )
+        }
+        self.version['hash'] = hash_source(self.version['source'])
+
+    def tearDown(self):
+        self.storage.close()
+        for storage in opened_storages.values():
+            storage.close()
+        opened_storages.clear()
+        shutil.rmtree(self.directory)
+
+    def test_open_storage(self):
+        self.assertIsInstance(self.storage, SQLiteStorage)
+        self.assertIs(open_storage(self.url), self.storage)
+        self.assertIsInstance(open_storage(TEST_DB), MongoStorage)
+        self.assertEqual(
+            self.storage.connection.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertRaises(TypeError, Storage)
+
+    def test_open_storage_unopenable(self):
+        for path in [PurePath(self.directory, 'missing', 'library.db'), self.directory]:
+            with redirect_stdout(io.StringIO()) as out:
+                self.assertIsNone(open_storage(f"{SQLITE_SCHEME}{path}"))
+            self.assertIn(ERROR.bad_database, out.getvalue())
+            self.assertIn(str(path), out.getvalue())
+
+    def test_resolve_database(self):
+        self.assertEqual(resolve_database('sqlite:///library.db', '/tmp'), 'sqlite:////tmp/library.db')
+        self.assertEqual(resolve_database(self.url, '/tmp'), self.url)
+        self.assertEqual(resolve_database(TEST_DB, '/tmp'), TEST_DB)
+        self.assertIsNone(resolve_database(None, '/tmp'))
+
+    def test_upsert_version(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version, 'module.dummyfunc')
+        self.assertEqual(
+            self.storage.get_version_hashes('functions', ['dummyfunc']),
+            {('dummyfunc', 'default'): self.version['hash']})
+
+        changed = {**self.version, 'source': "def dummyfunc():\n    return 1"}
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', changed)
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {**self.version, 'version_name': 'v2'})
+
+        self.assertEqual(
+            self.storage.get_version_field('source', 'function', 'dummyfunc', 'default'),
+            changed['source'])
+        self.assertEqual(
+            self.storage.get_version_field('docstring', 'function', 'dummyfunc', 'v2'),
+            'Returns zero')
+        self.assertIsNone(self.storage.get_version_field('source', 'function', 'dummyfunc', 'missing'))
+        self.assertIsNone(self.storage.get_version_field('source', 'class', 'dummyfunc', 'default'))
+
+        rows = self.storage.connection.execute("SELECT qualified_name FROM objects").fetchall()
+        self.assertEqual([row[0] for row in rows], ['module.dummyfunc'])
+
+    def test_stash(self):
+        entry = {
+            'collection': 'functions',
+            'name': 'dummyfunc',
+            'type': 'function',
+            'version': self.version,
+            'qualified_name': None
+        }
+        self.assertEqual(self.storage.stash([entry]), 1)
+        self.assertEqual(self.storage.stash([entry]), 0)
+
+        qualified = {**entry, 'qualified_name': 'pkg.mod.dummyfunc',
+                     'version': {**self.version, 'dependencies': ['helper']}}
+        self.assertEqual(self.storage.stash([qualified]), 1)
+        self.assertEqual(self.storage.stash([qualified]), 0)
+        self.assertEqual(
+            self.storage.get_version_field('dependencies', 'function', 'dummyfunc', 'default'), ['helper'])
+        rows = self.storage.connection.execute("SELECT qualified_name FROM objects").fetchall()
+        self.assertEqual([row[0] for row in rows], ['pkg.mod.dummyfunc'])
+
+    def test_batch(self):
+        with self.storage.batch():
+            self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version)
+            self.storage.upsert_version('functions', 'otherfunc', 'function', self.version)
+            self.assertTrue(self.storage.connection.in_transaction)
+        self.assertFalse(self.storage.connection.in_transaction)
+
+        self.assertEqual(
+            self.storage.get_version_hashes('functions', ['dummyfunc', 'otherfunc', 'missing']),
+            {('dummyfunc', 'default'): self.version['hash'], ('otherfunc', 'default'): self.version['hash']})
+        self.assertEqual(self.storage.get_version_hashes('classes', ['dummyfunc']), {})
+
+        with self.assertRaises(ValueError):
+            with self.storage.batch():
+                self.storage.upsert_version('functions', 'thirdfunc', 'function', self.version)
+                raise ValueError
+        self.assertEqual(self.storage.get_version_hashes('functions', ['thirdfunc']), {})
+
+    def test_get_versions_of(self):
+        imports = ['import os']
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {**self.version, 'imports': imports})
+        self.storage.upsert_version('functions', 'otherfunc', 'function', {**self.version, 'version_name': 'v2'})
+
+        found = self.storage.get_versions_of('functions', ['dummyfunc', 'otherfunc', 'missing'], 'default')
+        self.assertEqual(list(found), ['dummyfunc'])
+        self.assertEqual(found['dummyfunc']['source'], self.version['source'])
+        self.assertEqual(found['dummyfunc']['imports'], imports)
+        self.assertEqual(self.storage.get_version_field('imports', 'function', 'dummyfunc', 'default'), imports)
+        self.assertEqual(self.storage.get_versions_of('classes', ['dummyfunc'], 'default'), {})
+
+    def test_get_closure(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {
+            **self.version, 'dependencies': ['helper', 'DummyClass']})
+        self.storage.upsert_version('functions', 'helper', 'function', {
+            **self.version, 'version_name': 'v2', 'dependencies': ['dummyfunc']})
+        self.storage.upsert_version('classes', 'DummyClass', 'class', {
+            **self.version, 'source': 'class DummyClass(): pass'})
+
+        closure = self.storage.get_closure(['dummyfunc'], 'default')
+        self.assertEqual(list(closure), [('dummyfunc', 'function'), ('helper', 'function'), ('DummyClass', 'class')])
+        self.assertEqual(closure[('helper', 'function')]['version_name'], 'v2')
+        self.assertEqual(closure[('dummyfunc', 'function')]['dependencies'], ['helper', 'DummyClass'])
+
+        self.assertEqual(self.storage.get_closure(['helper'], 'default'), OrderedDict())
+        self.assertEqual(list(self.storage.get_closure(['DummyClass', 'missing'], 'default')), [('DummyClass', 'class')])
+
+    def test_get_named_versions(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version)
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {
+            **self.version, 'version_name': 'v2', 'source': "def dummyfunc():\n    x = 1\n    return x"})
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {**self.version, 'version_name': 'v3'})
+
+        versions = self.storage.get_named_versions('functions', 'dummyfunc', ['default', 'v2'], ['hash', 'lines'])
+        self.assertEqual(versions, {
+            'default': {'version_name': 'default', 'hash': self.version['hash'], 'lines': 2},
+            'v2': {'version_name': 'v2', 'hash': self.version['hash'], 'lines': 3}
+        })
+        versions = self.storage.get_named_versions('functions', 'dummyfunc', ['v2', 'missing'], ['source'])
+        self.assertEqual(list(versions), ['v2'])
+        self.assertTrue(versions['v2']['source'].endswith('return x'))
+        self.assertEqual(self.storage.get_named_versions('classes', 'dummyfunc', ['default'], ['source']), {})
+
+    def test_added_columns(self):
+        self.storage.connection.executescript(
+            "DROP TABLE versions;"
+            "CREATE TABLE versions (object_id INTEGER NOT NULL, version_name TEXT NOT NULL,"
+            " created TEXT NOT NULL, docstring TEXT, source TEXT NOT NULL, hash TEXT NOT NULL,"
+            " PRIMARY KEY (object_id, version_name))")
+        self.storage.close()
+        opened_storages.clear()
+
+        self.storage = open_storage(self.url)
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version)
+        self.assertEqual(self.storage.get_version_field('imports', 'function', 'dummyfunc', 'default'), [])
+        self.assertEqual(self.storage.get_version_field('lines', 'function', 'dummyfunc', 'default'), 2)
+
+    def test_find(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version)
+        self.storage.upsert_version('classes', 'DummyClass', 'class', {
+            **self.version,
+            'docstring': '',
+            'source': (
+                "class DummyClass():\n"
+                "    def zero(self):\n"
+                "        return 0"
+            )
+        })
+
+        matches = self.storage.find(['dummyfunc', 'zero'])
+        self.assertEqual([m['name'] for m in matches], ['dummyfunc', 'DummyClass'])
+        self.assertEqual(matches[0]['snippet'], 'Returns zero')
+        self.assertEqual(matches[1]['type'], 'class')
+        self.assertTrue(matches[1]['snippet'].startswith('class DummyClass'))
+        self.assertNotIn('source', matches[0])
+
+        self.assertEqual([m['name'] for m in self.storage.find(['zero'], limit=1, skip=1)], ['DummyClass'])
+        self.assertEqual(self.storage.find(['missing']), [])
+        self.assertEqual(self.storage.find(['"NEAR(']), [])
+
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {**self.version, 'docstring': 'Returns one'})
+        self.assertEqual(len(self.storage.find(['returns'])), 1)
+
+    def test_find_in_existing_library(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version)
+        with self.storage.connection:
+            self.storage.connection.execute("DROP TABLE versions_fts")
+        self.storage.close()
+        opened_storages.clear()
+
+        self.storage = open_storage(self.url)
+        self.assertEqual([m['name'] for m in self.storage.find(['zero'])], ['dummyfunc'])
+
+    def test_export_import(self):
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', self.version, 'module.dummyfunc')
+        self.storage.upsert_version('functions', 'dummyfunc', 'function', {**self.version, 'version_name': 'v2'})
+        self.storage.upsert_version('classes', 'DummyClass', 'class', {**self.version, 'source': 'class DummyClass(): pass'})
+
+        path = Path(PurePath(self.directory, 'library.ndjson.gz'))
+        self.assertEqual(dump_records(self.storage.export_documents(batch_size=1), path), 2)
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+        records = list(load_records(path))
+        self.assertEqual([collection for collection, _ in records], ['functions', 'classes'])
+        self.assertEqual(records[0][1]['qualified_name'], 'module.dummyfunc')
+        self.assertEqual(records[0][1]['versions'][0]['created'], self.version['created'])
+        self.assertEqual([v['version_name'] for v in records[0][1]['versions']], ['default', 'v2'])
+
+        other = open_storage(f"{SQLITE_SCHEME}{PurePath(self.directory, 'other.db')}")
+        self.assertEqual(other.import_documents(load_records(path), batch_size=1), 2)
+        self.assertEqual(other.import_documents(load_records(path)), 0)
+        self.assertEqual(list(other.export_documents()), records)
+        self.assertEqual([m['name'] for m in other.find(['DummyClass'])], ['DummyClass'])
+
+    def test_import_split_versions(self):
+        records = [
+            ('functions', {'name': 'dummyfunc', 'type': 'function'}),
+            ('function_versions', {'name': 'dummyfunc', **self.version})
+        ]
+        self.assertEqual(self.storage.import_documents(records), 2)
+        self.assertEqual(
+            self.storage.get_version_field('source', 'function', 'dummyfunc', 'default'),
+            self.version['source'])
+
+    def test_import_delta_versions(self):
+        sources = [f"def dummyfunc():\n    return {i}\n" for i in range(3)]
+        versions = []
+        for i, source in enumerate(sources):
+            previous = versions[-1] if versions else None
+            previous_source = sources[i - 1] if previous else None
+            versions.append(encode_version(
+                {**self.version, 'version_name': f"v{i}", 'source': source}, previous, previous_source, 8))
+        self.assertNotIn('source', versions[2])
+
+        records = [
+            ('classes', {'name': 'DummyClass', 'type': 'class', 'versions': versions}),
+            ('function_versions', {'name': 'dummyfunc', **versions[2]}),
+            ('function_versions', {'name': 'dummyfunc', **versions[0]}),
+            ('function_versions', {'name': 'dummyfunc', **versions[1]}),
+            ('function_versions', {'name': 'dummyfunc', **{**versions[1], 'version_name': 'orphan', 'base': 'missing'}})
+        ]
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(self.storage.import_documents(records, batch_size=2), 4)
+        self.assertIn('orphan', out.getvalue())
+        for citizen, name in [('class', 'DummyClass'), ('function', 'dummyfunc')]:
+            for i, source in enumerate(sources):
+                self.assertEqual(self.storage.get_version_field('source', citizen, name, f"v{i}"), source)
+        self.assertIsNone(self.storage.get_version_field('source', 'function', 'dummyfunc', 'orphan'))
+
+
+
+class UnreachableMongoStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.timeout = queries.MONGO_TIMEOUT_MS
+        queries.MONGO_TIMEOUT_MS = 50
+        queries.configure_client('mongodb://127.0.0.1:1')
+        self.entry = {
+            'collection': 'functions',
+            'name': 'dummyfunc',
+            'type': 'function',
+            'version': {
+                'created': datetime.today().replace(microsecond=0),
+                'version_name': 'default',
+                'docstring': None,
+                'source': "def dummyfunc():\n    return 0",
+                'hash': hash_source("def dummyfunc():\n    return 0")
+            },
+            'qualified_name': None
+        }
+
+    def tearDown(self):
+        queries.MONGO_TIMEOUT_MS = self.timeout
+        queries.configure_client(MONGO_URI)
+
+    def test_stash_reports_failed_writes(self):
+        for layout in LAYOUTS:
+            with redirect_stdout(io.StringIO()):
+                self.assertIsNone(MongoStorage(TEST_DB, layout).stash([self.entry]))
+        with redirect_stdout(io.StringIO()):
+            self.assertIsNone(MongoStorage(TEST_DB, keyframe_interval=4).stash([self.entry]))
+
+    def test_lazy_indexes_are_quiet(self):
+        queries.indexed_databases.discard(TEST_DB)
+        queries.failed_indexes.pop(TEST_DB, None)
+        with redirect_stdout(io.StringIO()) as out:
+            self.assertIsNone(queries.get_versions_of(TEST_DB, 'functions', ['dummyfunc'], 'default'))
+        self.assertEqual(len(out.getvalue().splitlines()), 1)
+        self.assertIn(TEST_DB, queries.failed_indexes)
+
+    def test_cached_reads(self):
+        directory = Path(tempfile.mkdtemp())
+        storage = MongoStorage(TEST_DB, cached=True)
+        storage.cache = ObjectCache(PurePath(directory, CACHE_NAME))
+        version = {**self.entry['version'], 'imports': ['import os']}
+        version['fingerprint'] = get_fingerprint({**self.entry, 'version': version})
+        storage.write_cache('functions', 'dummyfunc', version, ['source', 'imports'])
+        expected = {key: version[key] for key in ['version_name', 'fingerprint', 'source', 'imports']}
+        try:
+            with redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(
+                    storage.get_versions_of('functions', ['dummyfunc'], 'default'), {'dummyfunc': expected})
+                self.assertEqual(
+                    storage.get_named_versions('functions', 'dummyfunc', ['default'], ['source'])['default']['source'],
+                    version['source'])
+            self.assertEqual(out.getvalue(), '')
+
+            # stale entries are served while the server cannot be reached
+            storage.cache.ttl = 0
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(
+                    storage.get_versions_of('functions', ['dummyfunc'], 'default'), {'dummyfunc': expected})
+                self.assertIsNone(storage.get_versions_of('functions', ['dummyfunc', 'missing'], 'default'))
+        finally:
+            storage.cache.close()
+            shutil.rmtree(directory)
+
+    def test_failed_indexes_not_retried(self):
+        queries.indexed_databases.discard(TEST_DB)
+        queries.failed_indexes.pop(TEST_DB, None)
+        with redirect_stdout(io.StringIO()) as out:
+            queries.get_collection(TEST_DB, 'functions')
+        self.assertEqual(out.getvalue(), '')
+        self.assertIn(TEST_DB, queries.failed_indexes)
+
+        start = time.monotonic()
+        with redirect_stdout(io.StringIO()) as out:
+            queries.get_collection(TEST_DB, 'classes')
+        self.assertEqual(out.getvalue(), '')
+        self.assertLess(time.monotonic() - start, queries.MONGO_TIMEOUT_MS / 1000)
+
+
+class MongoStorageTest(unittest.TestCase):
+    def setUp(self):
+        if not queries.is_reachable():
+            self.skipTest('MongoDB server not reachable')
+        self.directory = Path(tempfile.mkdtemp())
+        self.storage = MongoStorage(TEST_DB, cached=True)
+        self.storage.cache = ObjectCache(PurePath(self.directory, CACHE_NAME))
+        self.entry = {
+            'collection': 'functions',
+            'name': 'dummyfunc',
+            'type': 'function',
+            'version': {
+                'created': datetime.today().replace(microsecond=0),
+                'version_name': 'default',
+                'docstring': None,
+                'source': "def dummyfunc():\n    return os.getcwd()",
+                'hash': hash_source("def dummyfunc():\n    return os.getcwd()"),
+                'imports': ['import os']
+            },
+            'qualified_name': None
+        }
+
+    def tearDown(self):
+        self.storage.cache.close()
+        shutil.rmtree(self.directory)
+        queries.get_client().drop_database(TEST_DB)
+
+    def test_cached_imports_after_restash(self):
+        self.assertEqual(self.storage.stash([self.entry]), 1)
+        found = self.storage.get_versions_of('functions', ['dummyfunc'], 'default')
+        self.assertEqual(found['dummyfunc']['imports'], ['import os'])
+
+        # same source, other imports: the cached entry must not be served
+        entry = {**self.entry, 'version': {**self.entry['version'], 'imports': ['import os.path as os']}}
+        self.assertEqual(self.storage.stash([entry]), 1)
+        self.storage.cache.ttl = 0
+        found = self.storage.get_versions_of('functions', ['dummyfunc'], 'default')
+        self.assertEqual(found['dummyfunc']['imports'], ['import os.path as os'])
+        self.assertEqual(
+            self.storage.get_named_versions('functions', 'dummyfunc', ['default'], ['imports']),
+            {'default': {'version_name': 'default', 'fingerprint': get_fingerprint(entry),
+                         'imports': ['import os.path as os']}})
+
+
+if __name__ == '__main__':
+    unittest.main()